@@ -0,0 +1,123 @@
+"""
+Approximate nearest-neighbour index for large face galleries
+IVF (inverted file) index with a spherical k-means coarse quantizer, implemented on NumPy
+"""
+
+from typing import Optional
+
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted-file index over L2-normalized embeddings.
+
+    Gallery rows are clustered with spherical k-means. A query is compared with the
+    cluster centroids first and only the rows of the nprobe closest clusters are
+    returned as a shortlist, which the caller re-ranks exactly.
+    """
+
+    def __init__(self, nlist: Optional[int] = None, nprobe: int = 8, iterations: int = 10,
+                 train_size: int = 65536, seed: int = 0):
+        """
+        Args:
+            nlist: Number of clusters (defaults to 4 * sqrt(rows))
+            nprobe: Number of clusters searched per query
+            iterations: k-means iterations
+            train_size: Maximum number of rows sampled to train the centroids
+            seed: Random seed for centroid initialisation and sampling
+        """
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.list_rows: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+
+    @staticmethod
+    def default_nlist(num_rows: int) -> int:
+        """Cluster count heuristic: about 4 * sqrt(N)"""
+        return max(1, int(4 * np.sqrt(num_rows)))
+
+    @staticmethod
+    def _assign(rows: np.ndarray, centroids: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+        """Index of the most similar centroid for every row (chunked to bound memory)"""
+        assignment = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), chunk_size):
+            block = rows[start:start + chunk_size] @ centroids.T
+            assignment[start:start + chunk_size] = np.argmax(block, axis=1)
+        return assignment
+
+    def _train(self, matrix: np.ndarray) -> np.ndarray:
+        """Run spherical k-means on a sample of the gallery and return the centroids"""
+        rng = np.random.default_rng(self.seed)
+        num_rows = len(matrix)
+        nlist = min(self.nlist or self.default_nlist(num_rows), num_rows)
+
+        if num_rows > self.train_size:
+            train = matrix[rng.choice(num_rows, self.train_size, replace=False)]
+        else:
+            train = matrix
+
+        centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+
+        for _ in range(self.iterations):
+            assignment = self._assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+
+            # Re-seed clusters that lost all their members
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                sums[empty] = train[rng.choice(len(train), len(empty))]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+
+        return centroids
+
+    def build(self, matrix: np.ndarray, centroids: Optional[np.ndarray] = None) -> 'IVFIndex':
+        """
+        Build the inverted lists for a gallery matrix.
+
+        Args:
+            matrix: L2-normalized float32 gallery matrix (rows x dim)
+            centroids: Existing centroids to reuse instead of retraining k-means
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if centroids is None or centroids.shape[1] != matrix.shape[1]:
+            centroids = self._train(matrix)
+
+        assignment = self._assign(matrix, centroids)
+        counts = np.bincount(assignment, minlength=len(centroids))
+
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_rows = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(counts)
+        return self
+
+    def search(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """
+        Return the gallery row indices in the clusters closest to a normalized query.
+
+        The result is a shortlist, not a ranking; scores must be computed by the caller.
+        """
+        if self.centroids is None:
+            return np.arange(0)
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+
+        if nprobe < len(centroid_scores):
+            probes = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        else:
+            probes = np.arange(len(centroid_scores))
+
+        return np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes
+        ])
@@ -0,0 +1,39 @@
+"""
+Backfill stored face embeddings
+
+Computes face_embeddings rows for every face image that has no embedding for the
+current SFace model / preprocessing version, so workers never re-embed photos at startup.
+
+Usage (from project root):
+  python -m facerec.backfill_embeddings [batch_size]
+"""
+
+import sys
+
+from facerec.facial_recognition_controller import recognition_system
+
+
+def main() -> int:
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    if recognition_system.face_recognizer.recognizer is None:
+        print("✗ Face recognition model not loaded - cannot compute embeddings")
+        return 1
+
+    face_database = recognition_system.face_database
+    print("=" * 60)
+    print("Backfilling face embeddings")
+    print(f"Model: {face_database.embedding_store.model_version}")
+    print(f"Preprocessing: {face_database.embedding_store.preprocess_version}")
+    print("=" * 60)
+
+    computed, failed = face_database.backfill_embeddings(batch_size=batch_size)
+
+    print(f"\n✓ Computed {computed} embedding(s)")
+    if failed:
+        print(f"✗ {failed} image(s) could not be embedded")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+ANN vs exact gallery search benchmark
+
+Builds synthetic galleries of L2-normalized 128-d embeddings, then compares exact
+matrix search with the IVF index on recall (same top match as exact search),
+match-decision agreement (threshold + confidence gap), and per-query latency.
+
+With --storage, compares gallery storage instead: memory of the legacy
+known_faces dict, the float32 gallery and the int8 gallery (saving is int8
+against float32), plus how often the int8 gallery (codes only, scored after
+dequantization) reaches the same decision as float32.
+
+Usage (from project root):
+  python -m facerec.benchmark_ann [gallery sizes...] [--queries N] [--nprobe N] [--storage]
+  python -m facerec.benchmark_ann 1000 10000 100000 --nprobe 16
+  python -m facerec.benchmark_ann 10000 100000 --storage
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from facerec.facial_recognition_controller import FaceDatabase, FaceGallery
+
+EMBEDDING_DIM = 128
+THRESHOLD = 0.25
+MIN_CONFIDENCE_GAP = 0.02
+
+
+def make_gallery(num_students: int, rng: np.random.Generator) -> np.ndarray:
+    """Synthetic students grouped around latent 'look-alike' clusters, like real face embeddings"""
+    num_groups = max(1, num_students // 50)
+    groups = rng.normal(size=(num_groups, EMBEDDING_DIM))
+    students = groups[rng.integers(0, num_groups, num_students)] + rng.normal(size=(num_students, EMBEDDING_DIM)) * 1.2
+    return students / np.linalg.norm(students, axis=1, keepdims=True)
+
+
+def make_queries(students: np.ndarray, num_queries: int, rng: np.random.Generator) -> np.ndarray:
+    """Noisy captures of randomly chosen students"""
+    targets = students[rng.integers(0, len(students), num_queries)]
+    queries = targets + rng.normal(size=targets.shape) * 0.09
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def run(size: int, num_queries: int, nprobe: int) -> None:
+    rng = np.random.default_rng(size)
+    students = make_gallery(size, rng)
+    queries = make_queries(students, num_queries, rng)
+    known_faces = {f"S{i:07d}": {'name': f"Student {i}", 'encoding': vec} for i, vec in enumerate(students)}
+
+    build_start = time.perf_counter()
+    gallery = FaceGallery.from_known_faces(
+        known_faces,
+        index_params={'type': 'ivf', 'min_size': 0, 'nprobe': nprobe}
+    )
+    build_seconds = time.perf_counter() - build_start
+
+    top, latency_ms, decisions = {}, {}, {}
+    for mode, exact in (('exact', True), ('ivf', False)):
+        start = time.perf_counter()
+        top[mode] = [gallery.top2(query, exact=exact) for query in queries]
+        latency_ms[mode] = (time.perf_counter() - start) * 1000 / num_queries
+
+        # find_match logs every decision; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            decisions[mode] = [
+                FaceDatabase._match_in_gallery(gallery, query, THRESHOLD, MIN_CONFIDENCE_GAP, exact=exact)
+                for query in queries
+            ]
+
+    recall = np.mean([ivf[0][0] == exact[0][0] for exact, ivf in zip(top['exact'], top['ivf'])])
+    agreement = np.mean([
+        (exact[0] if exact else None) == (ivf[0] if ivf else None)
+        for exact, ivf in zip(decisions['exact'], decisions['ivf'])
+    ])
+
+    print(f"{size:>9} {len(gallery.index.centroids):>6} {nprobe:>6} {build_seconds:>9.2f} "
+          f"{latency_ms['exact']:>9.3f} {latency_ms['ivf']:>9.3f} {recall:>8.3f} {agreement:>9.3f}")
+
+
+def known_faces_bytes(known_faces: dict) -> int:
+    """Approximate memory of a known_faces dict (dicts, float64 arrays, id and name strings)"""
+    total = sys.getsizeof(known_faces)
+    for student_id, data in known_faces.items():
+        total += sys.getsizeof(student_id) + sys.getsizeof(data)
+        total += sys.getsizeof(data['name']) + sys.getsizeof(data['encoding'])
+    return total
+
+
+def decide(gallery: FaceGallery, queries: np.ndarray) -> list:
+    # find_match logs every decision; keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        matches = [
+            FaceDatabase._match_in_gallery(gallery, query, THRESHOLD, MIN_CONFIDENCE_GAP, exact=True)
+            for query in queries
+        ]
+    return [match[0] if match else None for match in matches]
+
+
+def run_storage(size: int, num_queries: int) -> None:
+    rng = np.random.default_rng(size)
+    students = make_gallery(size, rng)
+    queries = make_queries(students, num_queries, rng)
+    known_faces = {
+        f"S{i:07d}": {'name': f"Student {i}", 'encoding': vec.astype(np.float64), 'num_samples': 3}
+        for i, vec in enumerate(students)
+    }
+
+    galleries = {storage: FaceGallery.from_known_faces(known_faces, storage=storage) for storage in ('float32', 'int8')}
+
+    latency_ms, decisions = {}, {}
+    for storage, gallery in galleries.items():
+        start = time.perf_counter()
+        for query in queries:
+            gallery.top2(query, exact=True)
+        latency_ms[storage] = (time.perf_counter() - start) * 1000 / num_queries
+        decisions[storage] = decide(gallery, queries)
+
+    agreement = np.mean([a == b for a, b in zip(decisions['float32'], decisions['int8'])])
+    legacy_mb = known_faces_bytes(known_faces) / 1e6
+    float32_mb = galleries['float32'].memory_bytes() / 1e6
+    int8_mb = galleries['int8'].memory_bytes() / 1e6
+
+    print(f"{size:>9} {legacy_mb:>10.1f} {float32_mb:>10.1f} {int8_mb:>9.1f} "
+          f"{float32_mb / int8_mb:>7.1f}x {latency_ms['float32']:>9.3f} {latency_ms['int8']:>9.3f} {agreement:>9.3f}")
+
+
+def main() -> int:
+    args = sys.argv[1:]
+    num_queries = 500
+    nprobe = 8
+    storage = False
+    sizes = []
+
+    i = 0
+    while i < len(args):
+        if args[i] == '--queries':
+            num_queries = int(args[i + 1])
+            i += 2
+        elif args[i] == '--nprobe':
+            nprobe = int(args[i + 1])
+            i += 2
+        elif args[i] == '--storage':
+            storage = True
+            i += 1
+        else:
+            sizes.append(int(args[i]))
+            i += 1
+
+    sizes = sizes or [1000, 10000, 100000]
+
+    if storage:
+        print("=" * 86)
+        print(f"Gallery storage benchmark ({num_queries} queries per size)")
+        print("=" * 86)
+        print(f"{'students':>9} {'legacy_mb':>10} {'float32_mb':>10} {'int8_mb':>9} {'vs_f32':>8} "
+              f"{'f32_ms':>9} {'int8_ms':>9} {'decisions':>9}")
+        for size in sizes:
+            run_storage(size, num_queries)
+        return 0
+
+    print("=" * 78)
+    print(f"Gallery search benchmark ({num_queries} queries per size)")
+    print("=" * 78)
+    print(f"{'students':>9} {'nlist':>6} {'nprobe':>6} {'build_s':>9} {'exact_ms':>9} {'ivf_ms':>9} "
+          f"{'recall@1':>8} {'decisions':>9}")
+
+    for size in sizes:
+        run(size, num_queries, nprobe)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
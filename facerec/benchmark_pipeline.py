@@ -0,0 +1,88 @@
+"""
+Headless recognition pipeline benchmark
+
+Replays a recorded video file or a directory of stills through the same
+detection / recognition / tracking code the live camera uses and reports
+throughput. No camera, browser or Flask server is needed, and no attendance
+is written (--module only limits matching to that module's roster).
+
+Usage (from project root):
+  python -m facerec.benchmark_pipeline <video file | image directory> [--realtime] [--frames N] [--module ID]
+  python -m facerec.benchmark_pipeline recordings/lecture.mp4 --frames 600
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+from facerec.facial_recognition_controller import recognition_system
+from facerec.frame_sources import create_frame_source
+
+
+def main() -> int:
+    args = sys.argv[1:]
+    if not args:
+        print(__doc__)
+        return 1
+
+    path = args[0]
+    pacing = 'realtime' if '--realtime' in args else 'fast'
+    max_frames = int(args[args.index('--frames') + 1]) if '--frames' in args else None
+    module_id = int(args[args.index('--module') + 1]) if '--module' in args else None
+
+    if os.path.isdir(path):
+        source = create_frame_source({'type': 'images', 'path': path})
+    else:
+        source = create_frame_source({'type': 'file', 'path': path, 'pacing': pacing})
+
+    if not source.open():
+        print(f"✗ Could not open {source.describe()}")
+        return 1
+
+    if not recognition_system.initialize():
+        print("✗ Models or faces failed to load")
+        return 1
+
+    # A benchmark must never mark students present: no attendance writes at all
+    recognition_system.attendance_writer = None
+    recognition_system.session.start(module_id=module_id)
+    recognition_system.scanning_active = True
+
+    frames = 0
+    analyze_seconds = 0.0
+    start = time.perf_counter()
+    while max_frames is None or frames < max_frames:
+        success, frame = source.read()
+        if not success:
+            if source.exhausted:
+                break
+            if source.disconnected:
+                source.reconnect()
+            continue
+
+        analyze_start = time.perf_counter()
+        # find_match logs every decision; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            recognition_system.analyze_frame(frame)
+        analyze_seconds += time.perf_counter() - analyze_start
+        frames += 1
+    elapsed = time.perf_counter() - start
+    source.release()
+
+    stats = recognition_system.recognition_stats
+    print("=" * 60)
+    print(f"Pipeline benchmark: {source.describe()}")
+    print("=" * 60)
+    print(f"Frames:               {frames}")
+    print(f"Wall time:            {elapsed:.2f}s ({frames / elapsed if elapsed else 0:.1f} fps)")
+    print(f"Recognition per frame: {analyze_seconds / frames * 1000 if frames else 0:.1f} ms")
+    print(f"Faces recognised:     {stats['recognized']}")
+    print(f"Faces from track cache: {stats['cached']}")
+    print(f"Students marked:      {len(recognition_system.session.get_data()['recognized_students'])}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,413 @@
+"""
+Face models
+YuNet face detection (with the resolution/tiling policy) and SFace feature extraction.
+Kept apart from the controller so inference worker processes can load the models
+without building the whole recognition system
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+# How FaceDetector.detect spends its pixels (override per system with CONFIG['detection_policy'])
+DEFAULT_DETECTION_POLICY = {
+    'working_width': 640,  # First pass runs at most this wide; boxes are mapped back to full resolution (0 = full res)
+    'sharpen': True,  # Sharpen each detection input (helps far faces)
+    'tiles': True,  # Second pass over overlapping tiles when the first pass finds nothing
+    'tile_size': 1280,  # Largest detector input side; bigger regions are split into overlapping tiles
+    'tile_overlap': 0.2,  # Fraction of a tile shared with its neighbour (must exceed the largest face it should catch)
+    # Tiles are resized by this before detection; tiling only runs if it beats the first pass's scale.
+    # None = full resolution for frames the first pass shrank, SMALL_FRAME_TILE_SCALE for the rest
+    'tile_scale': None,
+    'tile_always': False  # Also tile when the first pass found faces (far rows behind near ones)
+}
+
+# Upscale of the tile pass for frames already at (or below) the working width
+SMALL_FRAME_TILE_SCALE = 1.5
+
+# Sharpening kernel applied before detection
+SHARPEN_KERNEL = np.array([[-1, -1, -1],
+                           [-1, 9, -1],
+                           [-1, -1, -1]])
+
+
+class FaceDetector:
+    """
+    Handles face detection using YuNet.
+
+    detect() first runs YuNet at a reduced working resolution and, when that finds
+    nothing, over overlapping tiles at tile_scale for faces too small for the first
+    pass (see DEFAULT_DETECTION_POLICY). A region of interest mask (fractions of the
+    frame, e.g. a camera's doorway) limits both passes to those regions. Boxes and
+    landmarks are always returned in full-resolution frame coordinates, so alignment
+    crops from the original frame.
+    """
+
+    def __init__(self, model_path: str, score_threshold: float = 0.6, policy: Optional[Dict] = None):
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        self.policy = {**DEFAULT_DETECTION_POLICY, **(policy or {})}
+        self.detector = None
+        self.initialize()
+
+    def initialize(self) -> bool:
+        """Initialize the YuNet face detector"""
+        try:
+            if os.path.exists(self.model_path):
+                self.detector = cv2.FaceDetectorYN.create(
+                    self.model_path,
+                    "",
+                    (640, 640),  # Increased input size for better small face detection
+                    self.score_threshold,
+                    0.3,  # NMS threshold
+                    5000,  # Top K
+                    cv2.dnn.DNN_BACKEND_DEFAULT,
+                    cv2.dnn.DNN_TARGET_CPU
+                )
+                print("✓ YuNet face detector loaded successfully")
+                return True
+            else:
+                print(f"⚠ YuNet model not found at {self.model_path}")
+                return False
+        except Exception as e:
+            print(f"✗ Error initializing face detector: {e}")
+            return False
+
+    def detect(self, frame: np.ndarray, roi: Optional[List[List[float]]] = None) -> Optional[np.ndarray]:
+        """
+        Detect faces in a frame following the detection policy.
+
+        Args:
+            frame: Full-resolution BGR frame
+            roi: Optional [[x, y, w, h], ...] regions as fractions of the frame; only these are searched
+
+        Returns:
+            YuNet face rows (box, landmarks, score) in frame coordinates, or None
+        """
+        if self.detector is None:
+            return None
+
+        height, width = frame.shape[:2]
+        policy = self.policy
+        regions = self._regions(width, height, roi)
+
+        # First pass at the working resolution
+        scale = min(1.0, policy['working_width'] / width) if policy['working_width'] else 1.0
+        found = [faces for faces in (self._detect_region(frame, region, scale) for region in regions)
+                 if faces is not None]
+
+        # Small faces: overlapping tiles, only where they see more pixels than the first pass
+        tile_scale = policy['tile_scale'] or (1.0 if scale < 1.0 else SMALL_FRAME_TILE_SCALE)
+        if policy['tiles'] and tile_scale > scale and (not found or policy['tile_always']):
+            for region in regions:
+                for tile in self._tiles(region, int(policy['tile_size'] / tile_scale), policy['tile_overlap']):
+                    faces = self._detect_region(frame, tile, tile_scale)
+                    if faces is not None:
+                        found.append(faces)
+
+        if not found:
+            return None
+        if len(found) == 1:
+            return found[0]
+
+        # Regions and tiles overlap, so the same face can be found more than once
+        faces = np.concatenate(found)
+        keep = cv2.dnn.NMSBoxes(faces[:, :4].tolist(), faces[:, 14].tolist(), self.score_threshold, 0.3)
+        return faces[np.array(keep, dtype=int).reshape(-1)]
+
+    @staticmethod
+    def _regions(width: int, height: int, roi: Optional[List[List[float]]]) -> List[Tuple[int, int, int, int]]:
+        """Pixel (x, y, w, h) rectangles to search: the ROI mask clipped to the frame, or the whole frame"""
+        if not roi:
+            return [(0, 0, width, height)]
+        regions = []
+        for fx, fy, fw, fh in roi:
+            x0, y0 = max(0, int(fx * width)), max(0, int(fy * height))
+            x1, y1 = min(width, int((fx + fw) * width)), min(height, int((fy + fh) * height))
+            if x1 > x0 and y1 > y0:
+                regions.append((x0, y0, x1 - x0, y1 - y0))
+        return regions
+
+    @staticmethod
+    def _tiles(region: Tuple[int, int, int, int], size: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+        """Overlapping size x size tiles covering a region (the last row/column is aligned to its far edge)"""
+        x0, y0, width, height = region
+        tile_w, tile_h = min(size, width), min(size, height)
+        step = max(1, int(size * (1 - overlap)))
+
+        def starts(origin, extent, tile):
+            positions = list(range(origin, origin + extent - tile, step))
+            return positions + [origin + extent - tile]
+
+        return [(x, y, tile_w, tile_h) for y in starts(y0, height, tile_h) for x in starts(x0, width, tile_w)]
+
+    def _detect_region(self, frame: np.ndarray, region: Tuple[int, int, int, int],
+                       scale: float) -> Optional[np.ndarray]:
+        """Run YuNet on one region resized by scale; face rows mapped back to frame coordinates"""
+        x0, y0, width, height = region
+        image = frame[y0:y0 + height, x0:x0 + width]
+        if scale != 1.0:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR)
+        if min(image.shape[:2]) < 32:
+            return None
+        if self.policy['sharpen']:
+            image = cv2.filter2D(image, -1, SHARPEN_KERNEL)
+
+        self.detector.setInputSize((image.shape[1], image.shape[0]))
+        _, faces = self.detector.detect(image)
+        if faces is None or len(faces) == 0:
+            return None
+
+        # Boxes and landmarks back to full-resolution frame coordinates
+        faces[:, :14] /= scale
+        faces[:, [0, 4, 6, 8, 10, 12]] += x0
+        faces[:, [1, 5, 7, 9, 11, 13]] += y0
+        return faces
+
+    @staticmethod
+    def is_valid_face(face_box: np.ndarray, frame_width: int, frame_height: int) -> bool:
+        """
+        Validate if detected box is likely a real face (not hand, arm, etc.)
+
+        Args:
+            face_box: Detected face coordinates [x, y, w, h, ...]
+            frame_width: Frame width for relative size check
+            frame_height: Frame height for relative size check
+
+        Returns:
+            True if detection passes face validation criteria
+        """
+        x, y, w, h = face_box[:4].astype(int)
+
+        # Check aspect ratio: faces are typically 0.6 to 1.6 (height/width)
+        # Very relaxed for different angles, distances, and head positions
+        aspect_ratio = h / max(w, 1)
+        if aspect_ratio < 0.6 or aspect_ratio > 1.6:
+            return False
+
+        # Check relative size: face should be reasonable size of frame
+        # Very wide range for near (large faces) and far (small faces) detection
+        face_area = w * h
+        frame_area = frame_width * frame_height
+        relative_size = face_area / frame_area
+
+        # Allow 0.4% to 85% of frame (very wide range for far distance detection)
+        # 0.4% = person standing 5-7 meters away
+        # 85% = person very close to camera
+        if relative_size < 0.004 or relative_size > 0.85:
+            return False
+
+        # Very small minimum for far detection (30x30 pixels)
+        # This allows detection of faces much farther away
+        if w < 30 or h < 30:
+            return False
+
+        return True
+
+
+class FaceRecognizer:
+    """Handles face recognition and feature extraction"""
+
+    # Bump whenever extract_features_from_image changes how a photo is prepared,
+    # so stored embeddings computed the old way are treated as stale
+    PREPROCESS_VERSION = 'resize112-clahe2-l2-v1'
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.model_version = os.path.splitext(os.path.basename(model_path))[0]
+        self.recognizer = None
+        self.batch_net = None  # Same SFace model through cv2.dnn, for N x 3 x 112 x 112 batches
+        self.initialize()
+
+    def initialize(self) -> bool:
+        """Initialize the face recognition model"""
+        try:
+            if os.path.exists(self.model_path):
+                self.recognizer = cv2.FaceRecognizerSF.create(
+                    self.model_path,
+                    ""
+                )
+                print("✓ Face recognizer loaded successfully")
+
+                try:
+                    self.batch_net = cv2.dnn.readNetFromONNX(self.model_path)
+                except Exception as e:
+                    print(f"⚠ Batched face recognition unavailable, using one face at a time: {e}")
+                return True
+            else:
+                print(f"⚠ Face recognition model not found at {self.model_path}")
+                return False
+        except Exception as e:
+            print(f"✗ Error initializing face recognizer: {e}")
+            return False
+
+    def extract_features(self, frame: np.ndarray, face_coords: np.ndarray) -> Optional[np.ndarray]:
+        """Extract face features from detected face with preprocessing for better accuracy"""
+        if self.recognizer is None:
+            return None
+
+        try:
+            aligned_face = self.recognizer.alignCrop(frame, face_coords)
+
+            # Enhance image quality for better feature extraction
+            aligned_face = self._enhance_face_image(aligned_face)
+
+            feature = self.recognizer.feature(aligned_face)
+            feature_vector = feature.flatten()
+
+            # L2 normalization for better matching consistency
+            norm = np.linalg.norm(feature_vector)
+            if norm > 0:
+                feature_vector = feature_vector / norm
+
+            return feature_vector
+        except Exception as e:
+            print(f"Error extracting features: {e}")
+            return None
+
+    def extract_features_batch(self, frame: np.ndarray, faces: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+        """
+        Extract features for several detected faces of one frame.
+
+        All faces are aligned and enhanced, then run through SFace as one
+        N x 3 x 112 x 112 blob. Falls back to one face at a time if the batched
+        network is unavailable or rejects the batch.
+        """
+        if self.recognizer is None or not faces:
+            return [None] * len(faces)
+
+        aligned_faces = []
+        for face_coords in faces:
+            try:
+                aligned_face = self.recognizer.alignCrop(frame, face_coords)
+                aligned_faces.append(self._enhance_face_image(aligned_face))
+            except Exception as e:
+                print(f"Error aligning face: {e}")
+                aligned_faces.append(None)
+
+        valid = [i for i, aligned_face in enumerate(aligned_faces) if aligned_face is not None]
+        features: List[Optional[np.ndarray]] = [None] * len(faces)
+        if not valid:
+            return features
+
+        matrix = self._feature_matrix([aligned_faces[i] for i in valid])
+        if matrix is None:
+            return features
+        for row, i in enumerate(valid):
+            features[i] = matrix[row]
+        return features
+
+    def extract_features_from_images(self, images: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+        """
+        Batch variant of extract_features_from_image for several pre-cropped faces
+        (from any number of frames): resized, enhanced and embedded as one batch.
+        """
+        if self.recognizer is None or not images:
+            return [None] * len(images)
+
+        prepared = []
+        for image in images:
+            try:
+                prepared.append(self._enhance_face_image(cv2.resize(image, (112, 112))))
+            except Exception as e:
+                print(f"Error preparing face image: {e}")
+                prepared.append(None)
+
+        valid = [i for i, image in enumerate(prepared) if image is not None]
+        features: List[Optional[np.ndarray]] = [None] * len(images)
+        matrix = self._feature_matrix([prepared[i] for i in valid]) if valid else None
+        if matrix is None:
+            return features
+        for row, i in enumerate(valid):
+            features[i] = matrix[row]
+        return features
+
+    def _feature_matrix(self, faces: List[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        L2-normalised SFace features of 112 x 112 face images, one row per face.
+
+        Runs them through SFace as one N x 3 x 112 x 112 blob; falls back to one face
+        at a time if the batched network is unavailable or rejects the batch.
+        """
+        matrix = None
+        if self.batch_net is not None and len(faces) > 1:
+            try:
+                # Same preprocessing as FaceRecognizerSF.feature: scale 1, RGB, no crop
+                blob = cv2.dnn.blobFromImages(faces, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+                self.batch_net.setInput(blob)
+                matrix = self.batch_net.forward().reshape(len(faces), -1)
+            except Exception as e:
+                print(f"⚠ Batched face recognition failed, using one face at a time: {e}")
+                self.batch_net = None
+
+        try:
+            if matrix is None:
+                matrix = np.stack([self.recognizer.feature(face).flatten() for face in faces])
+        except Exception as e:
+            print(f"Error extracting features: {e}")
+            return None
+
+        # L2 normalization for better matching consistency
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    @staticmethod
+    def _enhance_face_image(face_img: np.ndarray) -> np.ndarray:
+        """
+        Enhance face image quality for better feature extraction
+        Uses CLAHE to improve contrast and normalize lighting
+        """
+        try:
+            # Convert to LAB color space for better lighting normalization
+            lab = cv2.cvtColor(face_img, cv2.COLOR_BGR2LAB)
+            l, a, b = cv2.split(lab)
+
+            # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) to L channel
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            l = clahe.apply(l)
+
+            # Merge channels and convert back to BGR
+            enhanced_lab = cv2.merge([l, a, b])
+            enhanced = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
+
+            return enhanced
+        except Exception as e:
+            # If enhancement fails, return original
+            return face_img
+
+    def extract_features_from_image(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Extract features from a pre-cropped face image with preprocessing"""
+        if self.recognizer is None:
+            return None
+
+        try:
+            # Resize to expected input size
+            img_resized = cv2.resize(image, (112, 112))
+
+            # Enhance image quality for better feature extraction
+            img_resized = self._enhance_face_image(img_resized)
+
+            feature = self.recognizer.feature(img_resized)
+            feature_vector = feature.flatten()
+
+            # L2 normalization for better matching consistency
+            norm = np.linalg.norm(feature_vector)
+            if norm > 0:
+                feature_vector = feature_vector / norm
+
+            return feature_vector
+        except Exception as e:
+            print(f"Error extracting features from image: {e}")
+            return None
+
+    @staticmethod
+    def cosine_similarity(feat1: np.ndarray, feat2: np.ndarray) -> float:
+        """Calculate cosine similarity between two feature vectors"""
+        feat1 = feat1.flatten()
+        feat2 = feat2.flatten()
+        return np.dot(feat1, feat2) / (np.linalg.norm(feat1) * np.linalg.norm(feat2))
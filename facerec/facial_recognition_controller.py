@@ -9,241 +9,762 @@ import sys
 import os
 import cv2
 import numpy as np
+import atexit
 import base64
+import bisect
+import contextlib
 from datetime import datetime, date, timedelta
 import threading
 import time
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import mysql.connector
 from mysql.connector import errors as mysql_errors
 
 # Add parent directory to path for imports
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common import db_utils
+from facerec.ann_index import IVFIndex
+from facerec.face_models import DEFAULT_DETECTION_POLICY, FaceDetector, FaceRecognizer
+from facerec.frame_sources import FrameSource, create_frame_source
 
+# Optional Hungarian assignment for the face tracker
+try:
+    from scipy.optimize import linear_sum_assignment
+    HUNGARIAN_SUPPORT = True
+except ImportError:
+    HUNGARIAN_SUPPORT = False
 
-class FaceDetector:
-    """Handles face detection using YuNet"""
 
-    def __init__(self, model_path: str, score_threshold: float = 0.6):
-        self.model_path = model_path
-        self.score_threshold = score_threshold
-        self.detector = None
-        self.initialize()
+class ModelPool:
+    """
+    Bounded pool of (FaceDetector, FaceRecognizer) pairs for concurrent callers.
 
-    def initialize(self) -> bool:
-        """Initialize the YuNet face detector"""
-        try:
-            if os.path.exists(self.model_path):
-                self.detector = cv2.FaceDetectorYN.create(
-                    self.model_path,
-                    "",
-                    (640, 640),  # Increased input size for better small face detection
-                    self.score_threshold,
-                    0.3,  # NMS threshold
-                    5000,  # Top K
-                    cv2.dnn.DNN_BACKEND_DEFAULT,
-                    cv2.dnn.DNN_TARGET_CPU
-                )
-                print("✓ YuNet face detector loaded successfully")
-                return True
-            else:
-                print(f"⚠ YuNet model not found at {self.model_path}")
-                return False
-        except Exception as e:
-            print(f"✗ Error initializing face detector: {e}")
-            return False
+    The OpenCV models keep per-call state (FaceDetector.detect resizes the network
+    input before every frame), so one pair must never be used by two threads at
+    once. checkout() lends a pair exclusively; pairs are loaded lazily, up to size,
+    the first time every existing pair is busy. Time spent waiting for a free pair
+    is recorded so an undersized pool shows up in stats().
 
-    def detect(self, frame: np.ndarray) -> Optional[np.ndarray]:
-        """Detect faces in a frame with multi-scale detection for far distances"""
-        if self.detector is None:
-            return None
+    OpenCV's thread count is process-wide: opencv_threads is applied with
+    cv2.setNumThreads, and defaults to the CPU count divided by the pool size so
+    that concurrent inferences do not oversubscribe the cores.
+    """
+
+    def __init__(self, detector: FaceDetector, recognizer: FaceRecognizer, size: int = 1,
+                 opencv_threads: Optional[int] = None):
+        self.size = max(1, int(size))
+        self.opencv_threads = int(opencv_threads) if opencv_threads else max(1, (os.cpu_count() or 1) // self.size)
+        cv2.setNumThreads(self.opencv_threads)
+
+        # Further pairs are loaded from the same model files as the first one
+        self._detector_path = detector.model_path
+        self._score_threshold = detector.score_threshold
+        self._detection_policy = detector.policy
+        self._recognizer_path = recognizer.model_path
+
+        self.idle: List[Tuple[FaceDetector, FaceRecognizer]] = [(detector, recognizer)]
+        self.created = 1
+        self.condition = threading.Condition()
+        self.stats_data = {
+            'checkouts': 0, 'waited': 0, 'timeouts': 0,
+            'wait_ms_total': 0.0, 'wait_ms_max': 0.0
+        }
 
-        height, width = frame.shape[:2]
+    def acquire(self, timeout: Optional[float] = None) -> Tuple[FaceDetector, FaceRecognizer]:
+        """Take a pair out of the pool; raises TimeoutError if none frees up within timeout"""
+        start = time.perf_counter()
+        grow = False
+        with self.condition:
+            if not self.idle and self.created < self.size:
+                # Reserve the slot now, load the models outside the lock
+                self.created += 1
+                grow = True
+            elif not self.condition.wait_for(lambda: self.idle, timeout):
+                self.stats_data['timeouts'] += 1
+                raise TimeoutError(f"No face model instance free within {timeout}s")
+            else:
+                models = self.idle.pop()
 
-        # Preprocess: Sharpen image for better far detection
-        kernel = np.array([[-1,-1,-1],
-                          [-1, 9,-1],
-                          [-1,-1,-1]])
-        sharpened = cv2.filter2D(frame, -1, kernel)
+            wait_ms = (time.perf_counter() - start) * 1000
+            self.stats_data['checkouts'] += 1
+            if not grow:
+                if wait_ms >= 1.0:
+                    self.stats_data['waited'] += 1
+                self.stats_data['wait_ms_total'] += wait_ms
+                self.stats_data['wait_ms_max'] = max(self.stats_data['wait_ms_max'], wait_ms)
 
-        # Primary detection on original frame
-        self.detector.setInputSize((width, height))
-        _, faces = self.detector.detect(sharpened)
+        if grow:
+            try:
+                models = (FaceDetector(self._detector_path, self._score_threshold, self._detection_policy),
+                          FaceRecognizer(self._recognizer_path))
+            except Exception:
+                with self.condition:
+                    self.created -= 1
+                raise
+        return models
+
+    def release(self, models: Tuple[FaceDetector, FaceRecognizer]):
+        with self.condition:
+            self.idle.append(models)
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def checkout(self, timeout: Optional[float] = None):
+        """with pool.checkout() as (detector, recognizer): ..."""
+        models = self.acquire(timeout)
+        try:
+            yield models
+        finally:
+            self.release(models)
+
+    def stats(self) -> Dict:
+        with self.condition:
+            checkouts = self.stats_data['checkouts']
+            return {
+                'size': self.size,
+                'loaded': self.created,
+                'in_use': self.created - len(self.idle),
+                'opencv_threads': self.opencv_threads,
+                'checkouts': checkouts,
+                'waited': self.stats_data['waited'],
+                'timeouts': self.stats_data['timeouts'],
+                'avg_wait_ms': round(self.stats_data['wait_ms_total'] / checkouts, 2) if checkouts else 0.0,
+                'max_wait_ms': round(self.stats_data['wait_ms_max'], 2)
+            }
 
-        # Multi-scale detection: Try upscaled frame for far/small faces
-        # This helps detect faces that are too small in the original resolution
-        if faces is None or len(faces) == 0:
-            # Upscale by 1.5x for better small face detection
-            scale_factor = 1.5
-            upscaled = cv2.resize(frame, None, fx=scale_factor, fy=scale_factor,
-                                interpolation=cv2.INTER_CUBIC)
-            upscaled_sharp = cv2.filter2D(upscaled, -1, kernel)
 
-            h_up, w_up = upscaled.shape[:2]
-            self.detector.setInputSize((w_up, h_up))
-            _, faces_upscaled = self.detector.detect(upscaled_sharp)
+class FaceEmbeddingStore:
+    """
+    Persistent cache of face embeddings in the face_embeddings table.
 
-            # Scale coordinates back to original frame size
-            if faces_upscaled is not None and len(faces_upscaled) > 0:
-                faces_upscaled[:, :4] /= scale_factor  # Scale x, y, w, h
-                faces = faces_upscaled
+    Rows are keyed by (face_image_id, model_version, preprocess_version), so a
+    photo is only run through SFace once per model/preprocessing combination.
+    Vectors are stored as raw float32 bytes.
+    """
 
-        return faces
+    def __init__(self, model_version: str, preprocess_version: str):
+        self.model_version = model_version
+        self.preprocess_version = preprocess_version
 
     @staticmethod
-    def is_valid_face(face_box: np.ndarray, frame_width: int, frame_height: int) -> bool:
-        """
-        Validate if detected box is likely a real face (not hand, arm, etc.)
+    def pack(vector: np.ndarray) -> bytes:
+        """Serialize an embedding to float32 bytes"""
+        return np.asarray(vector, dtype=np.float32).ravel().tobytes()
 
-        Args:
-            face_box: Detected face coordinates [x, y, w, h, ...]
-            frame_width: Frame width for relative size check
-            frame_height: Frame height for relative size check
+    @staticmethod
+    def unpack(data: bytes) -> np.ndarray:
+        """Deserialize float32 bytes back to an embedding"""
+        return np.frombuffer(bytes(data), dtype=np.float32)
 
-        Returns:
-            True if detection passes face validation criteria
+    def ensure_table(self) -> None:
+        """Create face_embeddings table if it does not exist"""
+        try:
+            db_utils.execute(
+                """
+                CREATE TABLE IF NOT EXISTS face_embeddings (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    face_image_id INT NOT NULL,
+                    student_id INT NOT NULL,
+                    model_version VARCHAR(64) NOT NULL,
+                    preprocess_version VARCHAR(64) NOT NULL,
+                    dim SMALLINT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE KEY uq_face_embedding_version (face_image_id, model_version, preprocess_version),
+                    KEY idx_face_embeddings_student (student_id),
+                    CONSTRAINT fk_face_embeddings_image FOREIGN KEY (face_image_id)
+                        REFERENCES face_images(id) ON DELETE CASCADE
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+        except Exception as e:
+            print(f"✗ Failed to ensure face_embeddings table exists: {e}")
+
+    def load_for_student(self, student_internal_id: int) -> List[Dict]:
+        """
+        List a student's face images with their stored embedding for the current
+        versions. Image bytes are not fetched; 'embedding' is None when missing or stale.
         """
-        x, y, w, h = face_box[:4].astype(int)
+        rows = db_utils.query_all(
+            """SELECT fi.id AS face_image_id, fi.image_number, fe.embedding
+                   FROM face_images fi
+                   LEFT JOIN face_embeddings fe
+                     ON fe.face_image_id = fi.id
+                    AND fe.model_version = %s
+                    AND fe.preprocess_version = %s
+                   WHERE fi.student_id = %s
+                   ORDER BY fi.image_number""",
+            (self.model_version, self.preprocess_version, student_internal_id)
+        )
+        for row in rows:
+            if row['embedding'] is not None:
+                row['embedding'] = self.unpack(row['embedding'])
+        return rows
 
-        # Check aspect ratio: faces are typically 0.6 to 1.6 (height/width)
-        # Very relaxed for different angles, distances, and head positions
-        aspect_ratio = h / max(w, 1)
-        if aspect_ratio < 0.6 or aspect_ratio > 1.6:
-            return False
+    def stream_active(self, conn, student_ids: Optional[set] = None):
+        """
+        Yield every active student's face images, ordered by student, on an unbuffered
+        cursor. Image bytes are only sent for rows without a current embedding.
+        student_ids optionally restricts the stream to those students.
+        """
+        params = [self.model_version, self.preprocess_version]
+        student_filter = ''
+        if student_ids is not None:
+            student_ids = sorted(student_ids)
+            student_filter = f"AND fi.student_id IN ({', '.join(['%s'] * len(student_ids))})"
+            params.extend(student_ids)
+
+        cur = conn.cursor(dictionary=True, buffered=False)
+        try:
+            cur.execute(
+                """SELECT fi.student_id, fi.id AS face_image_id, fi.image_number, fe.embedding,
+                          CASE WHEN fe.id IS NULL THEN fi.image_data END AS image_data
+                       FROM face_images fi
+                       JOIN students s ON s.id = fi.student_id
+                       LEFT JOIN face_embeddings fe
+                         ON fe.face_image_id = fi.id
+                        AND fe.model_version = %s
+                        AND fe.preprocess_version = %s
+                       WHERE s.is_active = TRUE {student_filter}
+                       ORDER BY fi.student_id, fi.image_number""".format(student_filter=student_filter),
+                tuple(params)
+            )
+            for row in cur:
+                if row['embedding'] is not None:
+                    row['embedding'] = self.unpack(row['embedding'])
+                yield row
+        finally:
+            cur.close()
+
+    def find_missing(self, after_id: int = 0, limit: int = 100) -> List[Dict]:
+        """Return the next batch of face images without an embedding for the current versions"""
+        return db_utils.query_all(
+            """SELECT fi.id AS face_image_id, fi.student_id, fi.image_number, fi.image_data
+                   FROM face_images fi
+                   LEFT JOIN face_embeddings fe
+                     ON fe.face_image_id = fi.id
+                    AND fe.model_version = %s
+                    AND fe.preprocess_version = %s
+                   WHERE fe.id IS NULL AND fi.id > %s
+                   ORDER BY fi.id
+                   LIMIT %s""",
+            (self.model_version, self.preprocess_version, after_id, limit)
+        )
 
-        # Check relative size: face should be reasonable size of frame
-        # Very wide range for near (large faces) and far (small faces) detection
-        face_area = w * h
-        frame_area = frame_width * frame_height
-        relative_size = face_area / frame_area
+    def save(self, face_image_id: int, student_internal_id: int, vector: np.ndarray) -> None:
+        """Insert or replace the embedding for a face image"""
+        db_utils.execute(
+            """INSERT INTO face_embeddings
+                   (face_image_id, student_id, model_version, preprocess_version, dim, embedding)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE
+                   student_id = VALUES(student_id),
+                   dim = VALUES(dim),
+                   embedding = VALUES(embedding),
+                   created_at = CURRENT_TIMESTAMP""",
+            (face_image_id, student_internal_id, self.model_version, self.preprocess_version,
+             int(np.asarray(vector).size), self.pack(vector))
+        )
 
-        # Allow 0.4% to 85% of frame (very wide range for far distance detection)
-        # 0.4% = person standing 5-7 meters away
-        # 85% = person very close to camera
-        if relative_size < 0.004 or relative_size > 0.85:
-            return False
+    def save_many(self, rows: List[Tuple[int, int, np.ndarray]], batch_size: int = 500) -> None:
+        """Insert or replace embeddings for (face_image_id, student_internal_id, vector) rows"""
+        conn = db_utils.get_connection()
+        try:
+            with conn.cursor() as cur:
+                for start in range(0, len(rows), batch_size):
+                    cur.executemany(
+                        """INSERT INTO face_embeddings
+                               (face_image_id, student_id, model_version, preprocess_version, dim, embedding)
+                           VALUES (%s, %s, %s, %s, %s, %s)
+                           ON DUPLICATE KEY UPDATE
+                               student_id = VALUES(student_id),
+                               dim = VALUES(dim),
+                               embedding = VALUES(embedding),
+                               created_at = CURRENT_TIMESTAMP""",
+                        [(face_image_id, student_internal_id, self.model_version, self.preprocess_version,
+                          int(np.asarray(vector).size), self.pack(vector))
+                         for face_image_id, student_internal_id, vector in rows[start:start + batch_size]]
+                    )
+                conn.commit()
+        finally:
+            conn.close()
 
-        # Very small minimum for far detection (30x30 pixels)
-        # This allows detection of faces much farther away
-        if w < 30 or h < 30:
-            return False
 
-        return True
+class FaceGallery:
+    """
+    Immutable matrix view of the known faces used for matching.
 
+    Encodings are stored as one contiguous, L2-normalized float32 matrix with
+    parallel id/name arrays, so a query is scored against every student with a
+    single matrix-vector product instead of a Python loop.
 
-class FaceRecognizer:
-    """Handles face recognition and feature extraction"""
+    A gallery is never modified after it is built. Reloads build a new one and
+    swap it in, and the version tells callers which gallery served a match.
 
-    def __init__(self, model_path: str):
-        self.model_path = model_path
-        self.recognizer = None
-        self.initialize()
+    Large galleries can carry an IVF index; the index only produces a shortlist,
+    which is re-ranked exactly against the stored rows.
 
-    def initialize(self) -> bool:
-        """Initialize the face recognition model"""
-        try:
-            if os.path.exists(self.model_path):
-                self.recognizer = cv2.FaceRecognizerSF.create(
-                    self.model_path,
-                    ""
-                )
-                print("✓ Face recognizer loaded successfully")
-                return True
-            else:
-                print(f"⚠ Face recognition model not found at {self.model_path}")
-                return False
-        except Exception as e:
-            print(f"✗ Error initializing face recognizer: {e}")
-            return False
+    With 'int8' storage only int8 codes with a per-row scale are kept (no float
+    matrix); queries are scored against the codes dequantized block by block into
+    a small float32 buffer, so a quarter of the float32 memory is held.
 
-    def extract_features(self, frame: np.ndarray, face_coords: np.ndarray) -> Optional[np.ndarray]:
-        """Extract face features from detected face with preprocessing for better accuracy"""
-        if self.recognizer is None:
-            return None
+    A student can own several rows (prototypes, e.g. one per pose or lighting
+    condition). Rows are packed by owner, offsets[i]:offsets[i + 1] being the rows
+    of student i, and a student's score is the max over its prototypes. With one
+    row per student owners and offsets are None and rows are students.
+    """
 
-        try:
-            aligned_face = self.recognizer.alignCrop(frame, face_coords)
+    # Rows of int8 codes dequantized per step when scoring
+    DEQUANT_BLOCK = 2048
+
+    def __init__(self, student_ids: List[str], names: List[str], num_samples: np.ndarray,
+                 matrix: Optional[np.ndarray], version: int = 0, index: Optional[IVFIndex] = None,
+                 rosters: Optional[Dict[int, np.ndarray]] = None,
+                 codes: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None,
+                 owners: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        self.student_ids = student_ids
+        self.names = names
+        self.num_samples = num_samples
+        self.matrix = matrix  # None with int8 storage
+        self.version = version
+        self.index = index
+        # module_id -> row indices of the enrolled students in matrix
+        self.rosters = rosters or {}
+        self.codes = codes
+        self.scales = scales
+        # row -> student index, and per-student row ranges (None with one row per student)
+        self.owners = owners
+        self.offsets = offsets
+        self.max_prototypes = int(np.diff(offsets).max()) if offsets is not None and len(student_ids) else 1
+
+    @classmethod
+    def build(cls, student_ids: List[str], names: List[str], num_samples: List[int],
+              vectors: List[np.ndarray], version: int = 0,
+              index_params: Optional[Dict] = None,
+              previous: Optional['FaceGallery'] = None,
+              module_rosters: Optional[Dict[int, List[str]]] = None,
+              storage: str = 'float32') -> 'FaceGallery':
+        """
+        Build a gallery from parallel student id / name / sample count / encoding lists
+
+        Args:
+            vectors: One encoding per student, or a (k x dim) array of prototypes
+            index_params: ANN settings ({'type': 'ivf', 'min_size', 'nlist', 'nprobe'});
+                          None or a gallery smaller than min_size uses exact search only
+            previous: Gallery being replaced; its IVF centroids are reused when the
+                      gallery size has not changed much, to avoid retraining k-means
+            module_rosters: module_id -> enrolled student_ids, turned into per-module
+                            row index arrays so matching can be limited to a class roster
+            storage: 'float32', or 'int8' for the compact quantized representation
+        """
+        # Intern ids and names so repeated reloads share one copy of each string
+        student_ids = [sys.intern(str(sid)) for sid in student_ids]
+        names = [sys.intern(str(name)) for name in names]
+        num_samples = np.asarray(num_samples, dtype=np.int32)
+
+        if not student_ids:
+            return cls([], [], num_samples, np.zeros((0, 0), dtype=np.float32), version,
+                       rosters={module_id: np.zeros(0, dtype=np.int64) for module_id in (module_rosters or {})})
+
+        blocks = [np.asarray(vector, dtype=np.float32).reshape(-1, np.asarray(vector).shape[-1]) for vector in vectors]
+        matrix = np.ascontiguousarray(np.concatenate(blocks), dtype=np.float32)
+
+        owners = offsets = None
+        counts = np.array([len(block) for block in blocks], dtype=np.int64)
+        if (counts > 1).any():
+            offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(counts)
+            owners = np.repeat(np.arange(len(blocks), dtype=np.int32), counts)
+
+        # Pre-normalize rows so scoring is a plain dot product
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+
+        index = None
+        if index_params and index_params.get('type') == 'ivf' and len(matrix) >= index_params.get('min_size', 20000):
+            centroids = None
+            if previous is not None and previous.index is not None and \
+                    abs(len(matrix) - previous.row_count) <= 0.2 * previous.row_count:
+                centroids = previous.index.centroids
+            index = IVFIndex(
+                nlist=index_params.get('nlist'),
+                nprobe=index_params.get('nprobe', 8)
+            ).build(matrix, centroids=centroids)
+
+        rosters = {}
+        if module_rosters:
+            row_of = {sid: row for row, sid in enumerate(student_ids)}
+            for module_id, enrolled in module_rosters.items():
+                rosters[module_id] = cls._expand_rows(offsets, np.array(
+                    sorted(row_of[sid] for sid in enrolled if sid in row_of),
+                    dtype=np.int64
+                ))
 
-            # Enhance image quality for better feature extraction
-            aligned_face = self._enhance_face_image(aligned_face)
+        codes = scales = None
+        if storage == 'int8':
+            codes, scales = cls.quantize(matrix)
+            matrix = None
+
+        return cls(student_ids, names, num_samples, matrix, version, index, rosters, codes, scales,
+                   owners=owners, offsets=offsets)
+
+    @classmethod
+    def from_known_faces(cls, known_faces: Dict[str, Dict], version: int = 0, **kwargs) -> 'FaceGallery':
+        """Build a gallery from a known_faces dict (student_id -> {'name', 'encoding', 'num_samples'})"""
+        student_ids = list(known_faces.keys())
+        return cls.build(
+            student_ids,
+            [known_faces[sid]['name'] for sid in student_ids],
+            [known_faces[sid].get('num_samples', 1) for sid in student_ids],
+            [known_faces[sid].get('prototypes', known_faces[sid]['encoding']) for sid in student_ids],
+            version,
+            **kwargs
+        )
+
+    @staticmethod
+    def cluster_prototypes(encodings: List[np.ndarray], max_prototypes: int, iterations: int = 10) -> np.ndarray:
+        """
+        Reduce a student's photo encodings to at most max_prototypes normalized prototypes.
 
-            feature = self.recognizer.feature(aligned_face)
-            feature_vector = feature.flatten()
+        Spherical k-means, seeded deterministically with the encoding closest to the
+        mean and then the encodings least similar to the prototypes chosen so far.
+        """
+        encodings = np.stack([np.asarray(encoding, dtype=np.float32).ravel() for encoding in encodings])
+        norms = np.linalg.norm(encodings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        encodings /= norms
+
+        if len(encodings) <= max_prototypes:
+            return encodings
+
+        seeds = [int(np.argmax(encodings @ encodings.mean(axis=0)))]
+        while len(seeds) < max_prototypes:
+            closest = (encodings @ encodings[seeds].T).max(axis=1)
+            seeds.append(int(np.argmin(closest)))
+        prototypes = encodings[seeds].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(encodings @ prototypes.T, axis=1)
+            for k in range(len(prototypes)):
+                members = encodings[assignment == k]
+                if len(members):
+                    centre = members.sum(axis=0)
+                    prototypes[k] = centre / (np.linalg.norm(centre) or 1.0)
+
+        return prototypes
 
-            # L2 normalization for better matching consistency
-            norm = np.linalg.norm(feature_vector)
-            if norm > 0:
-                feature_vector = feature_vector / norm
+    @staticmethod
+    def _expand_rows(offsets: Optional[np.ndarray], students: np.ndarray) -> np.ndarray:
+        """Rows owned by the given (sorted) student indices"""
+        if offsets is None or not len(students):
+            return students
+        counts = offsets[students + 1] - offsets[students]
+        starts = np.repeat(offsets[students] - (np.cumsum(counts) - counts), counts)
+        return starts + np.arange(counts.sum(), dtype=np.int64)
+
+    def students_of(self, rows: np.ndarray) -> np.ndarray:
+        """Sorted unique student indices owning the given rows (prototype rows or student indices)"""
+        return np.unique(rows if self.owners is None else self.owners[rows])
 
-            return feature_vector
-        except Exception as e:
-            print(f"Error extracting features: {e}")
-            return None
+    @staticmethod
+    def _segment_max(owners: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Best score per owner along the last axis of scores: (unique owners, max score of each)"""
+        if len(owners) > 1 and (owners[1:] < owners[:-1]).any():
+            order = np.argsort(owners, kind='stable')
+            owners, scores = owners[order], scores[..., order]
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        return owners[starts].astype(np.int64), np.maximum.reduceat(scores, starts, axis=-1)
 
     @staticmethod
-    def _enhance_face_image(face_img: np.ndarray) -> np.ndarray:
+    def quantize(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Symmetric per-row int8 quantization: row ~= codes * scale"""
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(matrix / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.student_ids)
+
+    @property
+    def row_count(self) -> int:
+        """Rows (prototypes) in the gallery"""
+        return len(self.matrix if self.codes is None else self.codes)
+
+    def _rows(self, start: int, stop: int) -> np.ndarray:
+        """float32 rows start:stop (dequantized with int8 storage)"""
+        if self.codes is None:
+            return self.matrix[start:stop]
+        return self.codes[start:stop].astype(np.float32) * self.scales[start:stop, None]
+
+    def _row_scores(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
         """
-        Enhance face image quality for better feature extraction
-        Uses CLAHE to improve contrast and normalize lighting
+        Dot products of normalized queries (dim,) or (n x dim) with all rows, or the given rows.
+
+        float32 galleries use one matrix product. int8 codes are converted DEQUANT_BLOCK
+        rows at a time into a reused float32 buffer and scaled afterwards, so no
+        float copy of the gallery is ever materialized.
         """
-        try:
-            # Convert to LAB color space for better lighting normalization
-            lab = cv2.cvtColor(face_img, cv2.COLOR_BGR2LAB)
-            l, a, b = cv2.split(lab)
+        if self.codes is None:
+            matrix = self.matrix if rows is None else self.matrix[rows]
+            return queries @ matrix.T
+
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        scores = np.empty(queries.shape[:-1] + (len(codes),), dtype=np.float32)
+        block = np.empty((min(self.DEQUANT_BLOCK, len(codes)), codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), self.DEQUANT_BLOCK):
+            chunk = block[:len(codes[start:start + self.DEQUANT_BLOCK])]
+            np.copyto(chunk, codes[start:start + self.DEQUANT_BLOCK], casting='unsafe')
+            scores[..., start:start + len(chunk)] = queries @ chunk.T
+        return scores * scales
+
+    def prototypes(self, student: int) -> np.ndarray:
+        """Normalized float32 prototypes (k x dim) of one student"""
+        if self.offsets is None:
+            return self._rows(student, student + 1).astype(np.float32)
+        return self._rows(self.offsets[student], self.offsets[student + 1]).astype(np.float32)
+
+    def prototype_count(self, student: int) -> int:
+        """Number of prototypes one student owns"""
+        if self.offsets is None:
+            return 1
+        return int(self.offsets[student + 1] - self.offsets[student])
+
+    def to_known_faces(self) -> Dict[str, Dict]:
+        """Expand the gallery back into a known_faces dict (allocates per-student objects)"""
+        known_faces = {}
+        for student, sid in enumerate(self.student_ids):
+            prototypes = self.prototypes(student)
+            encoding = prototypes.mean(axis=0)
+            known_faces[sid] = {
+                'name': self.names[student],
+                'encoding': encoding / (np.linalg.norm(encoding) or 1.0),
+                'prototypes': prototypes,
+                'num_samples': int(self.num_samples[student])
+            }
+        return known_faces
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by this gallery (arrays, id/name table, rosters)"""
+        arrays = (self.matrix, self.num_samples, self.codes, self.scales, self.owners, self.offsets)
+        total = sum(array.nbytes for array in arrays if array is not None)
+        total += sys.getsizeof(self.student_ids) + sys.getsizeof(self.names)
+        total += sum(sys.getsizeof(value) for value in set(self.student_ids) | set(self.names))
+        total += sum(rows.nbytes for rows in self.rosters.values())
+        if self.index is not None:
+            total += self.index.centroids.nbytes + self.index.list_rows.nbytes + self.index.list_offsets.nbytes
+        return total
 
-            # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) to L channel
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            l = clahe.apply(l)
+    @staticmethod
+    def _normalize_query(feature: np.ndarray) -> Optional[np.ndarray]:
+        """Flatten and L2-normalize a query as float32 (None for a zero vector)"""
+        query = np.asarray(feature, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        return query / norm
 
-            # Merge channels and convert back to BGR
-            enhanced_lab = cv2.merge([l, a, b])
-            enhanced = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
+    def scores(self, feature: np.ndarray) -> Optional[np.ndarray]:
+        """Cosine similarity of a feature against every gallery row / prototype (None for a zero vector)"""
+        query = self._normalize_query(feature)
+        if query is None:
+            return None
+        return self._row_scores(query)
 
-            return enhanced
-        except Exception as e:
-            # If enhancement fails, return original
-            return face_img
+    def top2(self, feature: np.ndarray, exact: bool = False,
+             rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Return up to two (student_index, similarity) pairs, best first.
 
-    def extract_features_from_image(self, image: np.ndarray) -> Optional[np.ndarray]:
-        """Extract features from a pre-cropped face image with preprocessing"""
-        if self.recognizer is None:
-            return None
+        Uses argpartition so the full score vector is never sorted. When rows is
+        given (e.g. a module roster) only those rows are scored; otherwise, when the
+        gallery has an IVF index (and exact is False) only the index shortlist is scored.
+        Prototype scores are reduced to one score per student with a segment max.
+        """
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return []
+
+        query = self._normalize_query(feature)
+        if query is None:
+            return []
+
+        if rows is None and self.index is not None and not exact:
+            rows = self.index.search(query)
+            # Fewer than two students in the shortlist (rows may all be prototypes of
+            # one student) leave no runner-up for the confidence gap - use exact search
+            owners = rows if self.owners is None else self.owners[rows]
+            if not len(owners) or owners.min() == owners.max():
+                rows = None
+
+        scores = self._row_scores(query, rows)
+
+        if self.owners is not None:
+            if rows is None:
+                scores = np.maximum.reduceat(scores, self.offsets[:-1])
+            else:
+                rows, scores = self._segment_max(self.owners[rows], scores)
 
-        try:
-            # Resize to expected input size
-            img_resized = cv2.resize(image, (112, 112))
+        if len(scores) > 2:
+            candidates = np.argpartition(scores, -2)[-2:]
+        else:
+            candidates = np.arange(len(scores))
 
-            # Enhance image quality for better feature extraction
-            img_resized = self._enhance_face_image(img_resized)
+        ranked = sorted(candidates, key=lambda i: scores[i], reverse=True)
+        if rows is not None:
+            return [(int(rows[i]), float(scores[i])) for i in ranked]
+        return [(int(i), float(scores[i])) for i in ranked]
 
-            feature = self.recognizer.feature(img_resized)
-            feature_vector = feature.flatten()
+    def top2_batch(self, features: np.ndarray, exact: bool = False,
+                   rows: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """
+        top2 for several queries at once (one list per query).
 
-            # L2 normalization for better matching consistency
-            norm = np.linalg.norm(feature_vector)
-            if norm > 0:
-                feature_vector = feature_vector / norm
+        Exact searches score every query in a single matrix product (block by block
+        for int8 storage); IVF shortlists are per query, so those fall back to top2.
+        """
+        if len(features) == 0:
+            return []
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return [[] for _ in features]
+        if rows is None and self.index is not None and not exact:
+            return [self.top2(feature, exact=exact, rows=rows) for feature in features]
+
+        queries = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        zero = norms[:, 0] == 0
+        norms[zero] = 1.0
+        queries = queries / norms
+
+        scores = self._row_scores(queries, rows)
+
+        if self.owners is not None:
+            if rows is None:
+                scores = np.maximum.reduceat(scores, self.offsets[:-1], axis=1)
+            else:
+                rows, scores = self._segment_max(self.owners[rows], scores)
 
-            return feature_vector
-        except Exception as e:
-            print(f"Error extracting features from image: {e}")
-            return None
+        if scores.shape[1] > 2:
+            candidates = np.argpartition(scores, -2, axis=1)[:, -2:]
+        else:
+            candidates = np.broadcast_to(np.arange(scores.shape[1]), (len(scores), scores.shape[1]))
 
-    @staticmethod
-    def cosine_similarity(feat1: np.ndarray, feat2: np.ndarray) -> float:
-        """Calculate cosine similarity between two feature vectors"""
-        feat1 = feat1.flatten()
-        feat2 = feat2.flatten()
-        return np.dot(feat1, feat2) / (np.linalg.norm(feat1) * np.linalg.norm(feat2))
+        results = []
+        for q, query_scores in enumerate(scores):
+            if zero[q]:
+                results.append([])
+                continue
+            ranked = sorted(candidates[q], key=lambda i: query_scores[i], reverse=True)
+            labels = rows if rows is not None else range(len(query_scores))
+            results.append([(int(labels[i]), float(query_scores[i])) for i in ranked])
+        return results
 
 
 class FaceDatabase:
     """Manages the database of known faces"""
 
-    def __init__(self, face_recognizer: FaceRecognizer):
+    def __init__(self, face_recognizer: FaceRecognizer, index_params: Optional[Dict] = None,
+                 storage: str = 'float32', max_prototypes: int = 1):
+        """
+        Args:
+            face_recognizer: Recognizer used to embed face photos
+            index_params: Optional ANN index settings for large galleries, e.g.
+                          {'type': 'ivf', 'min_size': 20000, 'nprobe': 8}
+            storage: Gallery storage, 'float32' or 'int8' (quantized codes only)
+            max_prototypes: Prototypes kept per student; 1 averages all photos into one
+                            encoding, more clusters the photos (pose, lighting) instead
+        """
         self.face_recognizer = face_recognizer
-        self.known_faces: Dict[str, Dict] = {}
+        self.model_pool: Optional[ModelPool] = None  # When set, photos are embedded on a checked-out recognizer
+        self.index_params = index_params
+        self.storage = storage
+        self.max_prototypes = max(1, int(max_prototypes or 1))
+        self.gallery = FaceGallery.from_known_faces({})
+        self.last_load_stats: Dict = {}
+
+        # Bulk-load threads outlive a single load, so their recognizers (one per thread,
+        # cv2.dnn nets are not safe to share) are created once and not on every refresh
+        self._loader_pool: Optional[ThreadPoolExecutor] = None
+        self._loader_workers = 0
+        self._loader_state = threading.local()
+        self._loader_lock = threading.Lock()
+        self.embedding_store = FaceEmbeddingStore(
+            face_recognizer.model_version,
+            FaceRecognizer.PREPROCESS_VERSION
+        )
+
+        # Refresh bookkeeping: what the current gallery was built from
+        self.watermark: Dict = {'max_face_image_id': 0, 'max_created_at': None, 'active_students': 0}
+        self._image_signatures: Dict[int, Tuple] = {}
+        self._active_student_ids: set = set()
+        self._load_lock = threading.Lock()
+
+        # module_id -> student_ids enrolled in it (from student_enrollments)
+        self.module_rosters: Dict[int, List[str]] = {}
+
+    @property
+    def known_faces(self) -> Dict[str, Dict]:
+        """Faces of the gallery currently used for matching (expanded on demand)"""
+        return self.gallery.to_known_faces()
+
+    @property
+    def version(self) -> int:
+        """Version of the gallery currently used for matching"""
+        return self.gallery.version
+
+    def rebuild_gallery(self, student_ids: Optional[List[str]] = None, names: Optional[List[str]] = None,
+                        num_samples: Optional[List[int]] = None,
+                        vectors: Optional[List[np.ndarray]] = None) -> None:
+        """Build a new gallery off to the side and swap it in with one assignment"""
+        previous = self.gallery
+        if student_ids is None:
+            student_ids, names, num_samples = previous.student_ids, previous.names, previous.num_samples
+            vectors = [previous.prototypes(student) for student in range(len(previous))]
+        self.gallery = FaceGallery.build(
+            student_ids, names, num_samples, vectors,
+            previous.version + 1,
+            index_params=self.index_params,
+            previous=previous,
+            module_rosters=self.module_rosters,
+            storage=self.storage
+        )
+
+    def _load_module_rosters(self) -> Dict[int, List[str]]:
+        """Active students enrolled in each module, from student_enrollments"""
+        try:
+            rows = db_utils.query_all(
+                """SELECT se.module_id, s.student_id
+                   FROM student_enrollments se
+                   JOIN students s ON s.id = se.student_id
+                   WHERE s.is_active = TRUE
+                   ORDER BY se.module_id, s.student_id"""
+            )
+        except Exception as e:
+            print(f"⚠ Could not load module rosters, keeping previous ones: {e}")
+            return self.module_rosters
+
+        rosters: Dict[int, List[str]] = {}
+        for row in rows:
+            rosters.setdefault(row['module_id'], []).append(row['student_id'])
+        return rosters
+
+    def _load_image_signatures(self) -> Dict[int, Tuple]:
+        """Per-student (image count, max image id, latest created_at) for active students"""
+        rows = db_utils.query_all(
+            """SELECT fi.student_id, COUNT(*) AS image_count,
+                      MAX(fi.id) AS max_id, MAX(fi.created_at) AS max_created_at
+                   FROM face_images fi
+                   JOIN students s ON s.id = fi.student_id
+                   WHERE s.is_active = TRUE
+                   GROUP BY fi.student_id"""
+        )
+        return {
+            row['student_id']: (row['image_count'], row['max_id'], row['max_created_at'])
+            for row in rows
+        }
 
     def _ensure_face_images_table(self) -> None:
         """Create face_images table if it does not exist to prevent init failures."""
@@ -265,98 +786,225 @@ class FaceDatabase:
         except Exception as e:
             print(f"✗ Failed to ensure face_images table exists: {e}")
 
-    def load_from_database(self) -> bool:
-        """Load all student face encodings from database"""
+    def _embed_image_data(self, img_data) -> Optional[np.ndarray]:
+        """Decode a stored face photo (raw bytes or base64) and extract its feature vector"""
+        # Check if it's a base64 string or raw bytes
+        if isinstance(img_data, str):
+            img_data = base64.b64decode(img_data)
+
+        # Convert bytes to numpy array
+        nparr = np.frombuffer(img_data, np.uint8)
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+        if img is None:
+            return None
+
+        # Extract features from pre-cropped face image
+        if self.model_pool is None:
+            return self.face_recognizer.extract_features_from_image(img)
+        with self.model_pool.checkout() as (_, recognizer):
+            return recognizer.extract_features_from_image(img)
+
+    def add_face_image(self, student_internal_id: int, image_data: bytes, image_number: Optional[int] = None) -> Optional[int]:
+        """
+        Store an uploaded face photo and its embedding.
+
+        Returns:
+            The new face_images id, or None if the photo could not be embedded
+        """
+        feature = self._embed_image_data(image_data)
+        if feature is None:
+            return None
+
+        self._ensure_face_images_table()
+        self.embedding_store.ensure_table()
+
+        conn = db_utils.get_connection()
+        try:
+            with conn.cursor() as cur:
+                if image_number is None:
+                    cur.execute(
+                        "SELECT COALESCE(MAX(image_number), 0) + 1 FROM face_images WHERE student_id = %s",
+                        (student_internal_id,)
+                    )
+                    image_number = cur.fetchone()[0]
+
+                cur.execute(
+                    """INSERT INTO face_images (student_id, image_data, image_number)
+                       VALUES (%s, %s, %s)""",
+                    (student_internal_id, image_data, image_number)
+                )
+                face_image_id = cur.lastrowid
+                conn.commit()
+        finally:
+            conn.close()
+
+        self.embedding_store.save(face_image_id, student_internal_id, feature)
+        return face_image_id
+
+    def backfill_embeddings(self, batch_size: int = 100) -> Tuple[int, int]:
+        """
+        Compute stored embeddings for every face image that is missing one for the
+        current model/preprocessing versions.
+
+        Returns:
+            (computed, failed) counts
+        """
+        self._ensure_face_images_table()
+        self.embedding_store.ensure_table()
+
+        computed = 0
+        failed = 0
+        last_id = 0
+
+        while True:
+            batch = self.embedding_store.find_missing(after_id=last_id, limit=batch_size)
+            if not batch:
+                break
+
+            for row in batch:
+                last_id = row['face_image_id']
+                try:
+                    feature = self._embed_image_data(row['image_data'])
+                except Exception as e:
+                    print(f"  ✗ face_image {last_id} - error: {e}")
+                    feature = None
+
+                if feature is None:
+                    failed += 1
+                    continue
+
+                self.embedding_store.save(last_id, row['student_id'], feature)
+                computed += 1
+
+            print(f"  → Backfilled {computed} embedding(s), {failed} failed (up to face_image {last_id})")
+
+        return computed, failed
+
+    def load_from_database(self, bulk: bool = True, workers: Optional[int] = None,
+                           incremental: bool = False) -> bool:
+        """
+        Load all student face encodings from database
+
+        The new gallery is built off to the side and swapped in with a single
+        assignment, so matching keeps using the previous gallery until it is ready.
+
+        Args:
+            bulk: Stream every active student's images in one ordered query and embed
+                  missing ones on a thread pool. False falls back to one query per student.
+            workers: Size of the decode/feature-extraction pool in bulk mode
+                     (defaults to the CPU count, capped at 8)
+            incremental: Only reload students whose face images changed (or who were
+                         activated) since the last load, and drop deactivated students.
+                         Falls back to a full load when nothing has been loaded yet.
+        """
+        with self._load_lock:
+            return self._load(bulk, workers, incremental and self.gallery.version > 0)
+
+    def _load(self, bulk: bool, workers: Optional[int], incremental: bool) -> bool:
         try:
+            load_start = time.perf_counter()
+            timings: Dict[str, float] = {}
+            counters = {'from_store': 0, 'computed': 0}
+
             # Ensure the face_images table exists so initialization does not crash on fresh DBs
             self._ensure_face_images_table()
+            self.embedding_store.ensure_table()
 
             # Get all active students
+            phase_start = time.perf_counter()
             students = db_utils.query_all(
                 """SELECT id, student_id, first_name, last_name
                    FROM students
                    WHERE is_active = TRUE"""
             )
+            signatures = self._load_image_signatures()
+            module_rosters = self._load_module_rosters()
+            timings['students_query'] = time.perf_counter() - phase_start
+
+            previous = self.gallery
+            previous_rows = {sid: row for row, sid in enumerate(previous.student_ids)}
+            active_ids = {student['id'] for student in students}
+
+            if incremental:
+                # Re-embed only students whose images changed or who were (re)activated
+                changed_ids = {
+                    student['id'] for student in students
+                    if student['id'] not in self._active_student_ids
+                    or signatures.get(student['id']) != self._image_signatures.get(student['id'])
+                }
+                removed_count = len(self._active_student_ids - active_ids)
+                names_changed = any(
+                    student['student_id'] in previous_rows
+                    and previous.names[previous_rows[student['student_id']]] != f"{student['first_name']} {student['last_name']}"
+                    for student in students
+                )
 
-            print(f"\n{'='*60}")
-            print(f"Loading student faces from database")
-            print(f"Total students in database: {len(students)}")
-            print(f"{'='*60}")
+                rosters_changed = module_rosters != self.module_rosters
+
+                if not changed_ids and not removed_count and not names_changed and not rosters_changed:
+                    print(f"✓ Face gallery v{self.gallery.version} is up to date")
+                    return True
 
-            self.known_faces = {}
+                print(f"\n{'='*60}")
+                print(f"Refreshing student faces (incremental): {len(changed_ids)} changed, {removed_count} removed")
+                print(f"{'='*60}")
+            else:
+                changed_ids = active_ids
+
+                print(f"\n{'='*60}")
+                print(f"Loading student faces from database ({'bulk' if bulk else 'per-student'} mode)")
+                print(f"Total students in database: {len(students)}")
+                print(f"{'='*60}")
+
+            if not changed_ids:
+                student_images = {}
+            elif bulk:
+                student_images = self._collect_encodings_bulk(
+                    workers, timings, counters,
+                    student_ids=changed_ids if incremental else None
+                )
+            else:
+                student_images = self._collect_encodings_per_student(
+                    [student for student in students if student['id'] in changed_ids], counters
+                )
+
+            phase_start = time.perf_counter()
+            # Columnar gallery inputs - no per-student dicts are kept around
+            gallery_ids, gallery_names, gallery_samples, gallery_vectors = [], [], [], []
             loaded_count = 0
             failed_students = []
 
             for student in students:
-                student_internal_id = student['id']
                 student_id = student['student_id']
                 first_name = student['first_name']
                 last_name = student['last_name']
 
-                print(f"\n[{student_id}] {first_name} {last_name}")
+                if student['id'] not in changed_ids:
+                    # Unchanged since the last load - carry the existing encoding over
+                    row = previous_rows.get(student_id)
+                    if row is not None:
+                        gallery_ids.append(student_id)
+                        gallery_names.append(f"{first_name} {last_name}")
+                        gallery_samples.append(int(previous.num_samples[row]))
+                        gallery_vectors.append(previous.prototypes(row))
+                        loaded_count += 1
+                    continue
 
-                # Get face images from database
-                try:
-                    face_images = db_utils.query_all(
-                        """SELECT image_data, image_number
-                               FROM face_images
-                               WHERE student_id = %s
-                               ORDER BY image_number""",
-                        (student_internal_id,)
-                    )
-                except mysql_errors.ProgrammingError as e:
-                    if getattr(e, 'errno', None) == 1146:
-                        print("  ⚠ face_images table missing, creating now...")
-                        self._ensure_face_images_table()
-                        face_images = db_utils.query_all(
-                            """SELECT image_data, image_number
-                                   FROM face_images
-                                   WHERE student_id = %s
-                                   ORDER BY image_number""",
-                            (student_internal_id,)
-                        )
-                    else:
-                        print(f"  ✗ DB error loading face_images: {e}")
-                        continue
+                entry = student_images.get(student['id'])
 
-                if not face_images:
+                if not entry or not entry['images']:
                     failed_students.append(f"{student_id} ({first_name} {last_name}) - no face images in database")
-                    print(f"  ✗ No face images found in database")
                     continue
 
-                print(f"  → Processing {len(face_images)} face image(s) from database")
-
-                face_encodings = []
-
-                for face_img in face_images:
-                    try:
-                        img_data = face_img['image_data']
-                        image_number = face_img['image_number']
-
-                        # Check if it's a base64 string or raw bytes
-                        if isinstance(img_data, str):
-                            img_data = base64.b64decode(img_data)
-
-                        # Convert bytes to numpy array
-                        nparr = np.frombuffer(img_data, np.uint8)
-                        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-                        if img is None:
-                            print(f"    ✗ Image {image_number} - could not decode")
-                            continue
-
-                        # Extract features from pre-cropped face image
-                        feature = self.face_recognizer.extract_features_from_image(img)
-                        if feature is not None:
-                            face_encodings.append(feature)
-                            print(f"    ✓ Image {image_number} - feature extracted")
-
-                    except Exception as e:
-                        print(f"    ✗ Image {image_number} - error: {e}")
-
+                face_encodings = entry['encodings']
                 if not face_encodings:
                     failed_students.append(f"{student_id} ({first_name} {last_name}) - no faces detected in images")
-                    print(f"  ✗ No valid face encodings extracted")
+                    continue
+
+                if self.max_prototypes > 1:
+                    # Keep up to max_prototypes clustered encodings instead of one average
+                    avg_encoding = FaceGallery.cluster_prototypes(face_encodings, self.max_prototypes)
                 else:
                     # Average all encodings for this student and normalize
                     avg_encoding = np.mean(face_encodings, axis=0)
@@ -366,18 +1014,45 @@ class FaceDatabase:
                     if norm > 0:
                         avg_encoding = avg_encoding / norm
 
-                    self.known_faces[student_id] = {
-                        'name': f"{first_name} {last_name}",
-                        'encoding': avg_encoding,
-                        'num_samples': len(face_encodings)
-                    }
-                    loaded_count += 1
-                    print(f"  ✓ SUCCESS - Loaded {len(face_encodings)} face encoding(s)")
+                gallery_ids.append(student_id)
+                gallery_names.append(f"{first_name} {last_name}")
+                gallery_samples.append(len(face_encodings))
+                gallery_vectors.append(avg_encoding)
+                loaded_count += 1
+            timings['aggregate'] = time.perf_counter() - phase_start
+
+            phase_start = time.perf_counter()
+            self.module_rosters = module_rosters
+            self.rebuild_gallery(gallery_ids, gallery_names, gallery_samples, gallery_vectors)
+            timings['gallery'] = time.perf_counter() - phase_start
+            timings['total'] = time.perf_counter() - load_start
+
+            self._image_signatures = signatures
+            self._active_student_ids = active_ids
+            self.watermark = {
+                'max_face_image_id': max((sig[1] for sig in signatures.values()), default=0),
+                'max_created_at': max((sig[2] for sig in signatures.values() if sig[2] is not None), default=None),
+                'active_students': len(active_ids)
+            }
+
+            self.last_load_stats = {
+                'mode': ('incremental' if incremental else 'full') + ('' if bulk else '_per_student'),
+                'version': self.gallery.version,
+                'students': len(students),
+                'reloaded_students': len(changed_ids),
+                'loaded': loaded_count,
+                'embeddings_from_store': counters['from_store'],
+                'embeddings_computed': counters['computed'],
+                'module_rosters': len(module_rosters),
+                'timings': {phase: round(seconds, 3) for phase, seconds in timings.items()}
+            }
 
             print(f"\n{'='*60}")
-            print(f"SUMMARY")
+            print(f"SUMMARY (gallery v{self.gallery.version})")
             print(f"{'='*60}")
             print(f"✓ Successfully loaded: {loaded_count}/{len(students)} students")
+            print(f"  Embeddings: {counters['from_store']} from store, {counters['computed']} computed")
+            print("  Timings: " + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in timings.items()))
 
             if failed_students:
                 print(f"\n✗ Failed to load {len(failed_students)} student(s):")
@@ -393,7 +1068,200 @@ class FaceDatabase:
             traceback.print_exc()
             return False
 
-    def find_match(self, feature: np.ndarray, threshold: float = 0.28, min_confidence_gap: float = 0.020) -> Optional[Tuple[str, str, float]]:
+    def _collect_encodings_bulk(self, workers: Optional[int], timings: Dict[str, float],
+                                counters: Dict[str, int], student_ids: Optional[set] = None) -> Dict[int, Dict]:
+        """
+        Stream all active students' face images in one unbuffered query and embed the
+        ones without a stored vector on a bounded thread pool.
+        When student_ids is given only those students are streamed.
+
+        Returns:
+            Dict of student internal id -> {'images': count, 'encodings': [vectors]}
+        """
+        workers = workers or min(8, os.cpu_count() or 1)
+        max_in_flight = workers * 4
+        student_images: Dict[int, Dict] = {}
+        new_embeddings: List[Tuple[int, int, np.ndarray]] = []
+        work_times = {'decode': 0.0, 'extract': 0.0}
+        model_path = self.face_recognizer.model_path
+        can_embed = self.face_recognizer.recognizer is not None
+        thread_state = self._loader_state
+
+        def embed_row(row: Dict) -> Tuple[Dict, Optional[np.ndarray], float, float]:
+            # cv2.dnn nets are not safe to share between threads, so each worker keeps its own
+            recognizer = getattr(thread_state, 'recognizer', None)
+            if recognizer is None or recognizer.model_path != model_path:
+                recognizer = FaceRecognizer(model_path)
+                thread_state.recognizer = recognizer
+
+            decode_start = time.perf_counter()
+            img_data = row['image_data']
+            if isinstance(img_data, str):
+                img_data = base64.b64decode(img_data)
+            img = cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
+            decode_seconds = time.perf_counter() - decode_start
+
+            if img is None:
+                return row, None, decode_seconds, 0.0
+
+            extract_start = time.perf_counter()
+            feature = recognizer.extract_features_from_image(img)
+            return row, feature, decode_seconds, time.perf_counter() - extract_start
+
+        def collect(done) -> None:
+            for future in done:
+                try:
+                    row, feature, decode_seconds, extract_seconds = future.result()
+                except Exception as e:
+                    print(f"  ✗ Embedding error: {e}")
+                    continue
+
+                work_times['decode'] += decode_seconds
+                work_times['extract'] += extract_seconds
+                if feature is None:
+                    print(f"  ✗ face_image {row['face_image_id']} - could not decode")
+                    continue
+
+                student_images[row['student_id']]['encodings'].append(feature)
+                new_embeddings.append((row['face_image_id'], row['student_id'], feature))
+                counters['computed'] += 1
+
+        pending = set()
+        pool = self._loader_executor(workers)
+        phase_start = time.perf_counter()
+        conn = db_utils.get_connection()
+        try:
+            for row in self.embedding_store.stream_active(conn, student_ids):
+                entry = student_images.setdefault(row['student_id'], {'images': 0, 'encodings': []})
+                entry['images'] += 1
+
+                if row['embedding'] is not None:
+                    entry['encodings'].append(row['embedding'])
+                    counters['from_store'] += 1
+                    continue
+
+                if not can_embed:
+                    continue
+
+                pending.add(pool.submit(embed_row, row))
+                # Bound the number of image blobs held in memory at once
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+        finally:
+            conn.close()
+        timings['stream'] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        done, _ = wait(pending)
+        collect(done)
+        timings['embed_drain'] = time.perf_counter() - phase_start
+
+        # Cumulative worker time (spread across the pool, overlaps with streaming)
+        timings['decode_cpu'] = work_times['decode']
+        timings['extract_cpu'] = work_times['extract']
+
+        phase_start = time.perf_counter()
+        if new_embeddings:
+            try:
+                self.embedding_store.save_many(new_embeddings)
+            except Exception as e:
+                print(f"  ⚠ Could not store {len(new_embeddings)} new embedding(s): {e}")
+        timings['store'] = time.perf_counter() - phase_start
+
+        return student_images
+
+    def _loader_executor(self, workers: int) -> ThreadPoolExecutor:
+        """Bulk-load thread pool, kept between loads (replaced only when the worker count changes)"""
+        with self._loader_lock:
+            if self._loader_pool is None or self._loader_workers != workers:
+                if self._loader_pool is not None:
+                    self._loader_pool.shutdown(wait=False)
+                self._loader_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='face-loader')
+                self._loader_workers = workers
+            return self._loader_pool
+
+    def _collect_encodings_per_student(self, students: List[Dict], counters: Dict[str, int]) -> Dict[int, Dict]:
+        """
+        Load face images one student at a time (one query per student).
+
+        Returns:
+            Dict of student internal id -> {'images': count, 'encodings': [vectors]}
+        """
+        student_images: Dict[int, Dict] = {}
+
+        for student in students:
+            student_internal_id = student['id']
+            student_id = student['student_id']
+            first_name = student['first_name']
+            last_name = student['last_name']
+
+            print(f"\n[{student_id}] {first_name} {last_name}")
+
+            # Get face images (with any stored embedding) from database
+            try:
+                face_images = self.embedding_store.load_for_student(student_internal_id)
+            except mysql_errors.ProgrammingError as e:
+                if getattr(e, 'errno', None) == 1146:
+                    print("  ⚠ face_images table missing, creating now...")
+                    self._ensure_face_images_table()
+                    self.embedding_store.ensure_table()
+                    face_images = self.embedding_store.load_for_student(student_internal_id)
+                else:
+                    print(f"  ✗ DB error loading face_images: {e}")
+                    continue
+
+            if not face_images:
+                print(f"  ✗ No face images found in database")
+                continue
+
+            print(f"  → Processing {len(face_images)} face image(s) from database")
+
+            face_encodings = []
+            student_images[student_internal_id] = {'images': len(face_images), 'encodings': face_encodings}
+
+            for face_img in face_images:
+                image_number = face_img['image_number']
+
+                if face_img['embedding'] is not None:
+                    face_encodings.append(face_img['embedding'])
+                    counters['from_store'] += 1
+                    continue
+
+                # Missing or stale embedding - decode the photo and store a fresh one
+                try:
+                    image_row = db_utils.query_one(
+                        "SELECT image_data FROM face_images WHERE id = %s",
+                        (face_img['face_image_id'],)
+                    )
+                    feature = self._embed_image_data(image_row['image_data']) if image_row else None
+
+                    if feature is None:
+                        print(f"    ✗ Image {image_number} - could not decode")
+                        continue
+
+                    face_encodings.append(feature)
+                    counters['computed'] += 1
+                    print(f"    ✓ Image {image_number} - feature extracted")
+
+                    try:
+                        self.embedding_store.save(face_img['face_image_id'], student_internal_id, feature)
+                    except Exception as e:
+                        print(f"    ⚠ Image {image_number} - could not store embedding: {e}")
+
+                except Exception as e:
+                    print(f"    ✗ Image {image_number} - error: {e}")
+
+            if not face_encodings:
+                print(f"  ✗ No valid face encodings extracted")
+            else:
+                print(f"  ✓ SUCCESS - Loaded {len(face_encodings)} face encoding(s)")
+
+        return student_images
+
+    def find_match(self, feature: np.ndarray, threshold: float = 0.28, min_confidence_gap: float = 0.020,
+                   exact: bool = False, module_id: Optional[int] = None,
+                   fallback_to_full: bool = False) -> Optional[Tuple[str, str, float]]:
         """
         Find the best matching student for a given face feature.
 
@@ -401,25 +1269,131 @@ class FaceDatabase:
             feature: Face feature vector to match
             threshold: Minimum similarity threshold (0.28 - lowered slightly for better detection)
             min_confidence_gap: Minimum gap between best and second-best match (0.020 - balanced for stability)
+            exact: Bypass the ANN index (if any) and score every student
+            module_id: Only match students enrolled in this module. A roster of fewer than two
+                       students is decided on the full gallery (so the confidence gap still
+                       applies); a module with no loaded roster matches the full gallery
+            fallback_to_full: With module_id, retry against the whole gallery when the
+                              roster gives no confident match
 
         Returns:
             Tuple of (student_id, name, similarity) if confident match found, None otherwise
         """
-        if not self.known_faces:
+        return self.find_match_versioned(feature, threshold, min_confidence_gap, exact,
+                                         module_id, fallback_to_full)[0]
+
+    def find_match_versioned(self, feature: np.ndarray, threshold: float = 0.28,
+                             min_confidence_gap: float = 0.020, exact: bool = False,
+                             module_id: Optional[int] = None,
+                             fallback_to_full: bool = False) -> Tuple[Optional[Tuple[str, str, float]], int]:
+        """
+        Same as find_match, but also returns the version of the gallery that was searched.
+
+        Returns:
+            (match or None, gallery_version) tuple
+        """
+        # Take one reference so a concurrent refresh cannot swap the gallery mid-match
+        gallery = self.gallery
+
+        roster = self._module_roster(gallery, module_id)
+        # Rosters hold prototype rows; the gap rule needs at least two distinct students
+        enrolled = gallery.students_of(roster) if roster is not None else None
+        if enrolled is not None and len(enrolled) < 2:
+            # No runner-up on the roster to apply the confidence gap against: decide on
+            # the full gallery and keep the match only if it is a roster student
+            print(f"  Module {module_id} roster has {len(enrolled)} student(s), deciding on the full gallery")
+            match = self._match_in_gallery(gallery, feature, threshold, min_confidence_gap, exact)
+            if match is not None and not fallback_to_full and not self._on_roster(gallery, enrolled, match):
+                match = None
+            return match, gallery.version
+
+        if roster is not None:
+            print(f"  Matching against module {module_id} roster ({len(enrolled)} students)")
+            match = self._match_in_gallery(gallery, feature, threshold, min_confidence_gap, exact, rows=roster)
+            if match is not None or not fallback_to_full:
+                return match, gallery.version
+            print(f"  → No roster match, falling back to full gallery")
+
+        return self._match_in_gallery(gallery, feature, threshold, min_confidence_gap, exact), gallery.version
+
+    def find_matches_versioned(self, features: List[np.ndarray], threshold: float = 0.28,
+                               min_confidence_gap: float = 0.020, exact: bool = False,
+                               module_id: Optional[int] = None,
+                               fallback_to_full: bool = False) -> Tuple[List[Optional[Tuple[str, str, float]]], int]:
+        """
+        find_match for every face of a frame, scored against the gallery together.
+
+        Returns:
+            (one match or None per feature, gallery_version) tuple
+        """
+        gallery = self.gallery
+        matches: List[Optional[Tuple[str, str, float]]] = [None] * len(features)
+        pending = list(range(len(features)))
+
+        roster = self._module_roster(gallery, module_id)
+        enrolled = gallery.students_of(roster) if roster is not None else None
+        if enrolled is not None and len(enrolled) < 2:
+            # Same rule as find_match_versioned: full-gallery decision, roster students only
+            print(f"  Module {module_id} roster has {len(enrolled)} student(s), deciding on the full gallery")
+            tops = gallery.top2_batch(features, exact=exact)
+            for i, top in enumerate(tops):
+                match = self._decide(gallery, top, threshold, min_confidence_gap)
+                if match is not None and (fallback_to_full or self._on_roster(gallery, enrolled, match)):
+                    matches[i] = match
+            return matches, gallery.version
+
+        if roster is not None:
+            print(f"  Matching {len(features)} face(s) against module {module_id} roster ({len(enrolled)} students)")
+            tops = gallery.top2_batch([features[i] for i in pending], exact=exact, rows=roster)
+            for i, top in zip(pending, tops):
+                matches[i] = self._decide(gallery, top, threshold, min_confidence_gap)
+            if not fallback_to_full:
+                return matches, gallery.version
+            pending = [i for i in pending if matches[i] is None]
+            if pending:
+                print(f"  → No roster match for {len(pending)} face(s), falling back to full gallery")
+
+        if pending:
+            tops = gallery.top2_batch([features[i] for i in pending], exact=exact)
+            for i, top in zip(pending, tops):
+                matches[i] = self._decide(gallery, top, threshold, min_confidence_gap)
+
+        return matches, gallery.version
+
+    @staticmethod
+    def _module_roster(gallery: FaceGallery, module_id: Optional[int]) -> Optional[np.ndarray]:
+        """Gallery rows of a module's roster; None without a module or for a module with no loaded roster"""
+        if module_id is None:
             return None
+        roster = gallery.rosters.get(int(module_id))
+        if roster is None:
+            print(f"  No roster loaded for module {module_id}, matching against the full gallery")
+        return roster
 
-        # Calculate similarity scores for all students
-        similarities = []
-        for student_id, data in self.known_faces.items():
-            similarity = self.face_recognizer.cosine_similarity(feature, data['encoding'])
-            similarities.append((student_id, data['name'], similarity))
+    @staticmethod
+    def _on_roster(gallery: FaceGallery, enrolled: np.ndarray, match: Tuple[str, str, float]) -> bool:
+        """Whether a match is one of the enrolled student indices (from FaceGallery.students_of)"""
+        return any(gallery.student_ids[student] == match[0] for student in enrolled)
+
+    @classmethod
+    def _match_in_gallery(cls, gallery: FaceGallery, feature: np.ndarray, threshold: float,
+                          min_confidence_gap: float, exact: bool = False,
+                          rows: Optional[np.ndarray] = None) -> Optional[Tuple[str, str, float]]:
+        """Apply the threshold and confidence-gap rules to the top two gallery matches"""
+        if len(gallery) == 0:
+            return None
 
-        # Sort by similarity (highest first)
-        similarities.sort(key=lambda x: x[2], reverse=True)
+        # Score against every student (or the roster / ANN shortlist) in one matrix product, keep top two
+        return cls._decide(gallery, gallery.top2(feature, exact=exact, rows=rows), threshold, min_confidence_gap)
 
-        if not similarities:
+    @staticmethod
+    def _decide(gallery: FaceGallery, top: List[Tuple[int, float]], threshold: float,
+                min_confidence_gap: float) -> Optional[Tuple[str, str, float]]:
+        """Threshold and confidence-gap rules for one query's top two (student_index, similarity) pairs"""
+        if not top:
             return None
 
+        similarities = [(gallery.student_ids[i], gallery.names[i], score) for i, score in top]
         best_match = similarities[0]
         best_similarity = best_match[2]
 
@@ -449,261 +1423,1692 @@ class FaceDatabase:
 
     def get_count(self) -> int:
         """Get the number of known faces"""
-        return len(self.known_faces)
+        return len(self.gallery)
 
     def get_all_faces(self) -> List[Dict]:
         """Get list of all loaded faces"""
+        gallery = self.gallery
         faces_list = []
-        for student_id, data in self.known_faces.items():
+        for row, student_id in enumerate(gallery.student_ids):
             faces_list.append({
                 'student_id': student_id,
-                'name': data['name'],
-                'num_samples': data.get('num_samples', 1)
+                'name': gallery.names[row],
+                'num_samples': int(gallery.num_samples[row]),
+                'num_prototypes': gallery.prototype_count(row)
             })
         return sorted(faces_list, key=lambda x: x['student_id'])
 
 
 class AttendanceSession:
-    """Manages the current attendance session"""
+    """
+    Attendance for one class session (one timetable entry on one date).
+
+    Recognized students are kept in a dict, so duplicate checks are O(1). Every
+    change bumps a version; each student records the version it was added at, so
+    pollers can fetch only what changed since the version they last saw.
+    """
 
-    def __init__(self):
+    def __init__(self, key: Optional[Tuple[str, str]] = None, **session_data):
+        self.key = key
         self.session_data = {
             'date': None,
             'time': None,
             'room': None,
             'module_id': None,
-            'enrolled_count': 0,
-            'recognized_students': []
+            'enrolled_count': 0
         }
+        self.session_data.update(session_data)
+        self.recognized: Dict[str, Dict] = {}  # student_id -> record, in recognition order
+        self._versions: List[int] = []  # version of each record, in the same order
+        self.version = 0
+        self.reset_version = 0  # Version of the last start/reset; older snapshots are stale
+        self.last_activity = time.time()
         self.lock = threading.Lock()
 
     def start(self, **kwargs):
         """Start a new session"""
         with self.lock:
             self.session_data.update(kwargs)
-            self.session_data['recognized_students'] = []
+            self._clear()
+
+    def _clear(self):
+        self.recognized = {}
+        self._versions = []
+        self.version += 1
+        self.reset_version = self.version
+        self.last_activity = time.time()
 
     def add_student(self, student_id: str, name: str, confidence: float, liveness: float):
         """Add a recognized student to the session"""
         with self.lock:
             # Check if student already recognized
-            if student_id not in [s['student_id'] for s in self.session_data['recognized_students']]:
-                self.session_data['recognized_students'].append({
-                    'student_id': student_id,
-                    'name': name,
-                    'confidence': float(confidence),
-                    'liveness': float(liveness),
-                    'timestamp': datetime.now().isoformat()
-                })
-                return True
-            return False
+            if student_id in self.recognized:
+                return False
+
+            self.version += 1
+            self.recognized[student_id] = {
+                'student_id': student_id,
+                'name': name,
+                'confidence': float(confidence),
+                'liveness': float(liveness),
+                'timestamp': datetime.now().isoformat(),
+                'version': self.version
+            }
+            self._versions.append(self.version)
+            self.last_activity = time.time()
+            return True
+
+    def get_data(self, since: Optional[int] = None) -> Dict:
+        """
+        Get current session data (a copy safe to modify).
 
-    def get_data(self) -> Dict:
-        """Get current session data"""
+        Args:
+            since: Only include students recognized after this version. The result has
+                   'full': True when since predates the last reset and the client must
+                   replace, not merge, its list.
+        """
         with self.lock:
-            return self.session_data.copy()
+            full = since is None or since < self.reset_version
+            records = list(self.recognized.values())
+            if not full:
+                records = records[bisect.bisect_right(self._versions, since):]
+
+            data = dict(self.session_data)
+            data['recognized_students'] = [dict(record) for record in records]
+            data['recognized_count'] = len(self.recognized)
+            data['version'] = self.version
+            data['full'] = full
+            return data
 
     def reset(self):
         """Reset the session"""
         with self.lock:
-            self.session_data['recognized_students'] = []
+            self._clear()
 
 
-class FaceTracker:
+class SessionRegistry:
+    """
+    Concurrent attendance sessions keyed by (timetable_id, date).
+
+    Cameras covering the same class share one session; different classes never
+    touch each other's sessions. Sessions from earlier days, and sessions idle for
+    longer than idle_ttl that no camera is using, are evicted.
+    """
+
+    def __init__(self, idle_ttl: float = 6 * 3600, evict_interval: float = 60.0):
+        self.sessions: Dict[Tuple[str, str], AttendanceSession] = {}
+        self.idle_ttl = idle_ttl
+        self.evict_interval = evict_interval
+        self.lock = threading.Lock()
+        self._last_evict = 0.0
+
+    @staticmethod
+    def make_key(timetable_id, session_date=None) -> Tuple[str, str]:
+        session_date = str(session_date)[:10] if session_date else date.today().isoformat()
+        return str(timetable_id), session_date
+
+    def open(self, timetable_id, session_date=None, in_use: Optional[set] = None,
+             session_data: Optional[Dict] = None) -> AttendanceSession:
+        """
+        Session for a timetable entry on a date, created on first use.
+
+        An existing session keeps its recognized students (e.g. a second camera in
+        the same room, or scanning restarted mid-class); only its details are updated.
+        """
+        key = self.make_key(timetable_id, session_date)
+        session_data = session_data or {}
+        self.evict(in_use)
+
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = AttendanceSession(key, **session_data)
+                session.session_data.setdefault('timetable_id', timetable_id)
+                session.version = session.reset_version = 1
+                self.sessions[key] = session
+                return session
+
+        with session.lock:
+            session.session_data.update(session_data)
+            session.last_activity = time.time()
+        return session
+
+    def get(self, timetable_id, session_date=None) -> Optional[AttendanceSession]:
+        with self.lock:
+            return self.sessions.get(self.make_key(timetable_id, session_date))
+
+    def evict(self, in_use: Optional[set] = None, force: bool = False) -> int:
+        """Drop finished sessions (earlier dates, or idle and unused); returns how many"""
+        now = time.time()
+        if not force and now - self._last_evict < self.evict_interval:
+            return 0
+        self._last_evict = now
+
+        today = date.today().isoformat()
+        in_use = in_use or set()
+        with self.lock:
+            finished = [
+                key for key, session in self.sessions.items()
+                if key not in in_use and (key[1] < today or now - session.last_activity > self.idle_ttl)
+            ]
+            for key in finished:
+                del self.sessions[key]
+        return len(finished)
+
+    def summary(self) -> List[Dict]:
+        with self.lock:
+            sessions = list(self.sessions.items())
+        return [
+            {
+                'timetable_id': key[0],
+                'date': key[1],
+                'module_id': session.session_data.get('module_id'),
+                'recognized_count': len(session.recognized),
+                'version': session.version
+            }
+            for key, session in sessions
+        ]
+
+
+def attendance_status(class_start, policy: Optional[Dict], at: Optional[datetime] = None) -> str:
+    """
+    'present' or 'late' for a check-in at a given time.
+
+    class_start is the timetable start_time (MySQL TIME comes back as a timedelta);
+    policy is the module's attendance_policies row. Without both, the student is present.
+    """
+    if class_start is None or not policy:
+        return 'present'
+
+    # Convert timedelta to seconds if needed
+    if isinstance(class_start, timedelta):
+        class_start_seconds = int(class_start.total_seconds())
+    else:
+        class_start_seconds = class_start.hour * 3600 + class_start.minute * 60 + class_start.second
+
+    at = (at or datetime.now()).time()
+    minutes_late = (at.hour * 3600 + at.minute * 60 + at.second - class_start_seconds) / 60
+
+    if minutes_late <= policy['grace_period_minutes']:
+        return 'present'
+    # Past the late threshold is still late (could be 'absent' if policy requires)
+    return 'late'
+
+
+class AttendanceRules:
+    """
+    Cached inputs of attendance_status(): timetable rows (start time, module) and
+    each module's active course policy. Missing or stale (older than cache_ttl)
+    entries are fetched with one IN query per table on the caller's cursor.
+    """
+
+    def __init__(self, cache_ttl: float = 300.0):
+        self.cache_ttl = cache_ttl
+        self._timetables: Dict[int, Tuple[float, Optional[Dict]]] = {}  # timetable_id -> (fetched_at, row)
+        self._policies: Dict[int, Tuple[float, Optional[Dict]]] = {}  # module_id -> (fetched_at, policy)
+        self.lock = threading.Lock()
+
+    def _fill(self, cache: Dict, keys, sql: str, key_column: str, cursor):
+        now = time.time()
+        with self.lock:
+            missing = [k for k in set(keys) if k not in cache or now - cache[k][0] > self.cache_ttl]
+        if not missing:
+            return
+        cursor.execute(sql.format(placeholders=','.join(['%s'] * len(missing))), tuple(missing))
+        found = {row[key_column]: row for row in cursor.fetchall()}
+        with self.lock:
+            for k in missing:
+                cache[k] = (now, found.get(k))
+
+    def load(self, cursor, timetable_ids=(), module_ids=()):
+        """Make sure the given timetable entries and module policies are cached"""
+        self._fill(
+            self._timetables, [t for t in timetable_ids if t is not None],
+            "SELECT id, start_time, module_id FROM timetable WHERE id IN ({placeholders})", 'id', cursor
+        )
+        self._fill(
+            self._policies, [m for m in module_ids if m is not None],
+            """SELECT entity_id, grace_period_minutes, late_threshold_minutes
+               FROM attendance_policies
+               WHERE entity_id IN ({placeholders}) AND applies_to = 'course' AND is_active = 1""",
+            'entity_id', cursor
+        )
+
+    def timetable(self, timetable_id) -> Optional[Dict]:
+        with self.lock:
+            return self._timetables.get(timetable_id, (0, None))[1]
+
+    def status(self, timetable_id, module_id, at: Optional[datetime] = None) -> str:
+        """attendance_status() from cached rows (call load() first)"""
+        timetable = self.timetable(timetable_id)
+        with self.lock:
+            policy = self._policies.get(module_id, (0, None))[1]
+        return attendance_status(timetable['start_time'] if timetable else None, policy, at)
+
+    def clear(self):
+        with self.lock:
+            self._timetables.clear()
+            self._policies.clear()
+
+
+class AttendanceWriter:
+    """
+    Write-behind queue for automatic attendance records.
+
+    Recognitions are buffered in memory, deduplicated per (student, timetable, date),
+    and written by a background thread every flush_interval seconds as one multi-row
+    INSERT on one connection. Student ids, class start times and policies are looked
+    up once per batch (and cached), and students who already have a row for the module
+    that day are skipped. close() - also run at interpreter exit - flushes what is left.
+
+    A batch rejected by an integrity error (e.g. a timetable or module id that breaks a
+    foreign key) is retried one row at a time and the offending rows are dropped; a batch
+    that fails otherwise is re-queued, and an event is dropped after max_retries failures.
+    """
+
+    def __init__(self, flush_interval: float = 0.3, max_batch: int = 500,
+                 rules: Optional[AttendanceRules] = None, max_retries: int = 5):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.rules = rules or AttendanceRules()
+        self.max_retries = max_retries
+
+        # (student_id, timetable_id, date) -> event, in arrival order
+        self.pending: Dict[Tuple[str, Optional[int], str], Dict] = {}
+        # Keys already written (or found in the database) -> module_id, for the current date only
+        self.written: Dict[Tuple[str, Optional[int], str], int] = {}
+        self._written_date = date.today().isoformat()
+
+        self._student_ids: Dict[str, int] = {}  # student code -> students.id
+
+        self.stats = {
+            'enqueued': 0, 'deduplicated': 0, 'written': 0, 'already_marked': 0,
+            'unknown_students': 0, 'batches': 0, 'failures': 0,
+            'rejected_rows': 0, 'dropped_after_retries': 0,
+            'last_flush_lag_ms': 0.0, 'max_flush_lag_ms': 0.0, 'last_flush_ms': 0.0
+        }
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # One flush at a time (thread vs. close())
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.running = False
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop the writer thread and flush everything still queued"""
+        thread = self._thread
+        self.running = False
+        self._wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        self._thread = None
+        while self.pending and self.flush() > 0:
+            pass
+
+    def _roll_date(self, day: str):
+        """Start a new day's written set (caller holds the lock)"""
+        if day > self._written_date:
+            self.written = {}
+            self._written_date = day
+
+    def enqueue(self, student_id: str, module_id, timetable_id=None, confidence: float = 0,
+                checked_in_at: Optional[datetime] = None) -> bool:
+        """
+        Queue a recognition for writing; False if this student is already queued or
+        written for the timetable entry today.
+        """
+        checked_in_at = checked_in_at or datetime.now()
+        timetable_id = int(timetable_id) if str(timetable_id).isdigit() else None
+        key = (str(student_id), timetable_id, checked_in_at.date().isoformat())
+
+        with self.lock:
+            self._roll_date(key[2])
+            if key in self.written or key in self.pending:
+                self.stats['deduplicated'] += 1
+                # Keep the best confidence seen while the row is still queued
+                if key in self.pending:
+                    event = self.pending[key]
+                    event['confidence'] = max(event['confidence'], float(confidence or 0))
+                return False
+
+            self.pending[key] = {
+                'student_id': str(student_id),
+                'module_id': int(module_id),
+                'timetable_id': timetable_id,
+                'confidence': float(confidence or 0),
+                'checked_in_at': checked_in_at,
+                'queued_at': time.perf_counter()
+            }
+            self.stats['enqueued'] += 1
+
+        if not self.running:
+            self.start()
+        if len(self.pending) >= self.max_batch:
+            self._wakeup.set()
+        return True
+
+    def known_student(self, student_id: str) -> bool:
+        """Whether a student code exists (cached ids first, then the students table)"""
+        code = str(student_id)
+        if code in self._student_ids:
+            return True
+        row = db_utils.query_one("SELECT id FROM students WHERE student_id = %s", (code,))
+        if row:
+            self._student_ids[code] = row['id']
+        return row is not None
+
+    def mark_written(self, student_id: str, module_id, timetable_id=None):
+        """Record that a student was saved today by another path, so the writer skips them"""
+        timetable_id = int(timetable_id) if str(timetable_id).isdigit() else None
+        key = (str(student_id), timetable_id, date.today().isoformat())
+        with self.lock:
+            self._roll_date(key[2])
+            self.pending.pop(key, None)
+            self.written[key] = int(module_id)
+
+    def discard_module(self, module_id):
+        """Forget queued and written records of a module (its attendance was deleted)"""
+        module_id = int(module_id)
+        with self.lock:
+            self.pending = {k: e for k, e in self.pending.items() if e['module_id'] != module_id}
+            self.written = {k: m for k, m in self.written.items() if m != module_id}
+
+    def _run(self):
+        while self.running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self.pending:
+                self.flush()
+
+    def flush(self) -> int:
+        """Write up to max_batch queued events; returns how many were taken off the queue"""
+        with self.flush_lock:
+            with self.lock:
+                keys = list(self.pending)[:self.max_batch]
+                batch = [(key, self.pending.pop(key)) for key in keys]
+                # Count in-flight keys as written so they are not queued again meanwhile
+                self.written.update((key, event['module_id']) for key, event in batch if key[2] == self._written_date)
+            if not batch:
+                return 0
+
+            flush_start = time.perf_counter()
+            try:
+                written, already_marked, unknown = self._write(batch)
+            except mysql_errors.IntegrityError:
+                # One bad row fails the whole INSERT: write row by row and drop the bad ones
+                written = already_marked = unknown = 0
+                failed = []
+                for item in batch:
+                    try:
+                        row_written, row_marked, row_unknown = self._write([item])
+                    except mysql_errors.IntegrityError as e:
+                        with self.lock:
+                            self.stats['rejected_rows'] += 1
+                        print(f"⚠ Attendance row dropped for {item[1]['student_id']}: {e}")
+                        continue
+                    except Exception as e:
+                        failed.append(item)
+                        error = e
+                        continue
+                    written += row_written
+                    already_marked += row_marked
+                    unknown += row_unknown
+                if failed:
+                    self._requeue(failed, error)
+            except Exception as e:
+                self._requeue(batch, e)
+                return 0
+
+            lag_ms = (time.perf_counter() - min(event['queued_at'] for _, event in batch)) * 1000
+            with self.lock:
+                self.stats['written'] += written
+                self.stats['already_marked'] += already_marked
+                self.stats['unknown_students'] += unknown
+                self.stats['batches'] += 1
+                self.stats['last_flush_lag_ms'] = round(lag_ms, 1)
+                self.stats['max_flush_lag_ms'] = round(max(self.stats['max_flush_lag_ms'], lag_ms), 1)
+                self.stats['last_flush_ms'] = round((time.perf_counter() - flush_start) * 1000, 1)
+            return len(batch)
+
+    def _requeue(self, batch: List[Tuple[Tuple, Dict]], error: Exception):
+        """Put failed events back ahead of newer ones; drop those that failed max_retries times"""
+        with self.lock:
+            retry = {}
+            for key, event in batch:
+                self.written.pop(key, None)
+                event['attempts'] = event.get('attempts', 0) + 1
+                if event['attempts'] > self.max_retries:
+                    self.stats['dropped_after_retries'] += 1
+                else:
+                    retry[key] = event
+            self.pending = {**retry, **self.pending}
+            self.stats['failures'] += 1
+        print(f"⚠ Attendance write-behind flush failed ({len(batch)} events, {len(retry)} re-queued): {error}")
+
+    def _write(self, batch: List[Tuple[Tuple, Dict]]) -> Tuple[int, int, int]:
+        """One transaction for a batch; returns (written, already_marked, unknown_students)"""
+        events = [event for _, event in batch]
+        conn = db_utils.get_connection()
+        try:
+            with conn.cursor(dictionary=True) as cur:
+                codes = [code for code in {e['student_id'] for e in events} if code not in self._student_ids]
+                if codes:
+                    cur.execute(
+                        f"SELECT id, student_id FROM students WHERE student_id IN ({','.join(['%s'] * len(codes))})",
+                        tuple(codes)
+                    )
+                    self._student_ids.update({row['student_id']: row['id'] for row in cur.fetchall()})
+
+                known = [e for e in events if e['student_id'] in self._student_ids]
+                if not known:
+                    return 0, 0, len(events)
+
+                self.rules.load(cur, {e['timetable_id'] for e in known}, {e['module_id'] for e in known})
+
+                # Rows already marked (manually or by an earlier flush/save-one) for the module that day
+                internal_ids = sorted({self._student_ids[e['student_id']] for e in known})
+                days = sorted({e['checked_in_at'].date() for e in known})
+                cur.execute(
+                    f"""SELECT student_id, module_id, DATE(check_in_time) AS day
+                        FROM attendance
+                        WHERE student_id IN ({','.join(['%s'] * len(internal_ids))})
+                          AND check_in_time >= %s AND check_in_time < %s + INTERVAL 1 DAY""",
+                    (*internal_ids, days[0], days[-1])
+                )
+                existing = {(row['student_id'], row['module_id'], row['day']) for row in cur.fetchall()}
+
+                rows = []
+                for e in known:
+                    internal_id = self._student_ids[e['student_id']]
+                    day_key = (internal_id, e['module_id'], e['checked_in_at'].date())
+                    if day_key in existing:
+                        continue
+                    existing.add(day_key)  # Two timetable entries of one module on one day: first wins
+                    rows.append((
+                        internal_id, e['module_id'], e['timetable_id'], e['checked_in_at'],
+                        self.rules.status(e['timetable_id'], e['module_id'], e['checked_in_at']), e['confidence']
+                    ))
+
+                if rows:
+                    # Sent as one multi-row INSERT; the duplicate clause covers rows written
+                    # concurrently where the unique (student, module, date) key exists
+                    cur.executemany(
+                        """INSERT INTO attendance
+                               (student_id, module_id, timetable_id, check_in_time, status, face_confidence, is_manual)
+                           VALUES (%s, %s, %s, %s, %s, %s, FALSE)
+                           ON DUPLICATE KEY UPDATE
+                               face_confidence = IF(is_manual, face_confidence,
+                                                    GREATEST(COALESCE(face_confidence, 0), VALUES(face_confidence)))""",
+                        rows
+                    )
+                conn.commit()
+                return len(rows), len(known) - len(rows), len(events) - len(known)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def metrics(self) -> Dict:
+        with self.lock:
+            oldest = min((event['queued_at'] for event in self.pending.values()), default=None)
+            return {
+                **self.stats,
+                'pending': len(self.pending),
+                'oldest_pending_ms': round((time.perf_counter() - oldest) * 1000, 1) if oldest else 0.0,
+                'running': self.running
+            }
+
+
+def save_attendance_batch(timetable_id: Optional[int], module_id: Optional[int], records: List[Dict],
+                          rules: AttendanceRules,
+                          writer: Optional[AttendanceWriter] = None) -> Tuple[List[Dict], int]:
+    """
+    Save attendance for a batch of recognitions in one timetable slot.
+
+    All students are resolved with one query, status rules come from the rules cache
+    and the new rows are inserted in one transaction. Shared by the controller's and
+    main.py's save-many endpoints and the kiosk channel, so all of them apply the same
+    present/late rules.
+
+    Args:
+        timetable_id: Timetable entry (its module is used when module_id is not given)
+        module_id: Module the attendance is for
+        records: [{'student_id', 'confidence'}, ...]
+        rules: Cached class start times and late policies
+        writer: Write-behind writer to tell about the saved students, if any
+
+    Returns:
+        (results, saved): one {'student_id', 'ok', 'result'} per record, result being
+        'present' / 'late', 'already_marked' or 'not_found', and the number of rows inserted
+
+    Raises:
+        ValueError: neither module_id nor a valid timetable_id identifies the module
+    """
+    if not records:
+        return [], 0
+
+    conn = db_utils.get_connection()
+    try:
+        conn.start_transaction()
+        with conn.cursor(dictionary=True) as cur:
+            rules.load(cur, [timetable_id])
+            timetable = rules.timetable(timetable_id)
+            module_id = int(module_id or (timetable or {}).get('module_id') or 0)
+            if not module_id:
+                raise ValueError('module_id or a valid timetable_id required')
+            rules.load(cur, module_ids=[module_id])
+
+            codes = list(dict.fromkeys(str(r['student_id']) for r in records))
+            cur.execute(
+                f"SELECT id, student_id FROM students WHERE student_id IN ({','.join(['%s'] * len(codes))})",
+                tuple(codes)
+            )
+            internal_ids = {row['student_id']: row['id'] for row in cur.fetchall()}
+
+            marked = set()
+            if internal_ids:
+                cur.execute(
+                    f"""SELECT student_id FROM attendance
+                        WHERE student_id IN ({','.join(['%s'] * len(internal_ids))})
+                          AND module_id = %s
+                          AND check_in_time >= CURDATE() AND check_in_time < CURDATE() + INTERVAL 1 DAY""",
+                    (*internal_ids.values(), module_id)
+                )
+                marked = {row['student_id'] for row in cur.fetchall()}
+
+            status = rules.status(timetable_id, module_id)
+            results, rows, row_results = [], [], []
+            for record in records:
+                code = str(record['student_id'])
+                internal_id = internal_ids.get(code)
+                if internal_id is None:
+                    results.append({'student_id': code, 'ok': False, 'result': 'not_found'})
+                elif internal_id in marked:
+                    results.append({'student_id': code, 'ok': True, 'result': 'already_marked'})
+                else:
+                    marked.add(internal_id)  # The same student twice in one batch
+                    rows.append((internal_id, module_id, timetable_id, status, record.get('confidence', 0)))
+                    results.append({'student_id': code, 'ok': True, 'result': status})
+                    row_results.append(results[-1])
+
+            insert = """INSERT INTO attendance
+                            (student_id, module_id, timetable_id, status, face_confidence, is_manual)
+                        VALUES (%s, %s, %s, %s, %s, FALSE)"""
+            if rows:
+                try:
+                    cur.executemany(insert, rows)
+                except mysql_errors.IntegrityError:
+                    # Someone (usually the write-behind writer) saved a student since the check
+                    # above; the failed statement was undone, so insert row by row
+                    for row, result in zip(rows, row_results):
+                        try:
+                            cur.execute(insert, row)
+                        except mysql_errors.IntegrityError:
+                            result['result'] = 'already_marked'
+                    rows = [row for row, result in zip(rows, row_results) if result['result'] != 'already_marked']
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if writer is not None:
+        # Recognitions queued by scanning for these students are now redundant
+        for result in results:
+            if result['ok']:
+                writer.mark_written(result['student_id'], module_id, timetable_id)
+
+    return results, len(rows)
+
+
+class FaceTracker:
     """
     Tracks faces across frames to maintain temporal consistency.
     Prevents identity switching when the same face moves or changes angle.
+
+    Each track also caches its identity: a confirmed track seen in the previous
+    frame is reused for a detection at the same place, so the face is only
+    re-embedded every reverify_interval frames or when its box jumps.
+
+    Track state lives in preallocated arrays indexed by slot (boxes, centres, ages,
+    a ring buffer of recent similarities), and detections are associated with
+    tracks by geometry only - an IoU / centre-distance cost matrix solved greedily
+    or with the Hungarian algorithm - so crowded rooms stay cheap per frame.
     """
 
-    def __init__(self, max_age: int = 10):
+    def __init__(self, max_age: int = 10, reverify_interval: int = 15, jump_threshold: float = 0.5,
+                 max_distance: float = 100.0, min_iou: float = 0.3, assignment: str = 'greedy',
+                 capacity: int = 64):
         """
         Args:
             max_age: Maximum frames to keep tracking a face without detection
+            reverify_interval: Frames a confirmed identity is reused before the face is recognised again
+            jump_threshold: Centre movement between frames, as a fraction of the box size,
+                            that forces re-verification
+            max_distance: Centre distance in pixels below which a detection may continue a track
+            min_iou: Box overlap at or above which a detection may continue a track
+            assignment: 'greedy' or 'hungarian' (needs scipy, otherwise greedy is used)
+            capacity: Initial number of track slots (grows as needed)
         """
-        self.tracks = {}  # track_id -> {student_id, last_seen, position, confirmation_count, similarity_history}
-        self.next_track_id = 0
         self.max_age = max_age
         self.confirmation_threshold = 2  # Require 2 consecutive detections for stable recognition
         self.history_size = 5  # Keep last 5 similarity scores for smoothing
+        self.reverify_interval = reverify_interval
+        self.jump_threshold = jump_threshold
+        self.max_distance = max_distance
+        self.min_iou = min_iou
+        self.assignment = assignment if assignment != 'hungarian' or HUNGARIAN_SUPPORT else 'greedy'
+        self.initial_capacity = capacity
+        self.next_track_id = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        """Create empty track arrays with room for capacity tracks"""
+        self.active = np.zeros(capacity, dtype=bool)
+        self.track_ids = np.zeros(capacity, dtype=np.int64)
+        self.boxes = np.zeros((capacity, 4), dtype=np.float32)  # x, y, w, h
+        self.centers = np.zeros((capacity, 2), dtype=np.float32)
+        self.ages = np.zeros(capacity, dtype=np.int32)  # Frames since last detection
+        self.confirmations = np.zeros(capacity, dtype=np.float32)
+        self.confidences = np.zeros(capacity, dtype=np.float32)  # Mean of the similarity history
+        self.history = np.zeros((capacity, self.history_size), dtype=np.float32)
+        self.history_len = np.zeros(capacity, dtype=np.int32)
+        self.history_pos = np.zeros(capacity, dtype=np.int32)  # Next ring buffer slot to write
+        self.frames_since_verify = np.zeros(capacity, dtype=np.int32)
+        self.student_ids = np.full(capacity, None, dtype=object)
+        self.names = np.full(capacity, None, dtype=object)
+
+    def _grow(self):
+        """Double the number of track slots, keeping existing tracks"""
+        capacity = len(self.active)
+        for field in ('active', 'track_ids', 'boxes', 'centers', 'ages', 'confirmations', 'confidences',
+                      'history', 'history_len', 'history_pos', 'frames_since_verify', 'student_ids', 'names'):
+            old = getattr(self, field)
+            shape = (capacity * 2,) + old.shape[1:]
+            new = np.full(shape, None, dtype=object) if old.dtype == object else np.zeros(shape, dtype=old.dtype)
+            new[:capacity] = old
+            setattr(self, field, new)
+
+    def __len__(self) -> int:
+        return int(self.active.sum())
+
+    @staticmethod
+    def _iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+        """Pairwise IoU of two (n x 4) x, y, w, h box arrays"""
+        ax1, ay1 = boxes_a[:, 0:1], boxes_a[:, 1:2]
+        ax2, ay2 = ax1 + boxes_a[:, 2:3], ay1 + boxes_a[:, 3:4]
+        bx1, by1 = boxes_b[:, 0], boxes_b[:, 1]
+        bx2, by2 = bx1 + boxes_b[:, 2], by1 + boxes_b[:, 3]
+
+        inter_w = np.clip(np.minimum(ax2, bx2) - np.maximum(ax1, bx1), 0, None)
+        inter_h = np.clip(np.minimum(ay2, by2) - np.maximum(ay1, by1), 0, None)
+        intersection = inter_w * inter_h
+        union = boxes_a[:, 2:3] * boxes_a[:, 3:4] + boxes_b[:, 2] * boxes_b[:, 3] - intersection
+        return intersection / np.maximum(union, 1e-6)
+
+    def _associate(self, det_boxes: np.ndarray, det_centers: np.ndarray, slots: np.ndarray) -> List[Tuple[int, int]]:
+        """(detection index, track slot) pairs from the IoU / centre-distance cost matrix"""
+        iou = self._iou(det_boxes, self.boxes[slots])
+        distance = np.linalg.norm(det_centers[:, None, :] - self.centers[slots][None, :, :], axis=2)
+
+        valid = (iou >= self.min_iou) | (distance < self.max_distance)
+        cost = (1.0 - iou) + distance / self.max_distance
+
+        if self.assignment == 'hungarian':
+            rows, cols = linear_sum_assignment(np.where(valid, cost, 1e6))
+            return [(int(r), int(slots[c])) for r, c in zip(rows, cols) if valid[r, c]]
+
+        # Greedy: take the cheapest remaining pair until no valid pairs are left
+        cost = np.where(valid, cost, np.inf)
+        order = np.argsort(cost, axis=None)[:int(valid.sum())]
+        pairs, used_dets, used_tracks = [], set(), set()
+        for flat in order:
+            r, c = divmod(int(flat), len(slots))
+            if r in used_dets or c in used_tracks:
+                continue
+            used_dets.add(r)
+            used_tracks.add(c)
+            pairs.append((r, int(slots[c])))
+        return pairs
+
+    def _start_track(self, bbox, center, student_id: str, name: str, confidence: float):
+        """Put a new track in a free slot"""
+        free = np.flatnonzero(~self.active)
+        if not len(free):
+            self._grow()
+            free = np.flatnonzero(~self.active)
+        slot = free[0]
+        self.active[slot] = True
+        self.track_ids[slot] = self.next_track_id
+        self.next_track_id += 1
+        self._reset_identity(slot, student_id, name, confidence)
+        self.boxes[slot] = bbox
+        self.centers[slot] = center
+        self.ages[slot] = 0
+
+    def _reset_identity(self, slot: int, student_id: str, name: str, confidence: float):
+        """Give a track a (new) identity with a fresh similarity history"""
+        self.student_ids[slot] = student_id
+        self.names[slot] = name
+        self.confirmations[slot] = 1
+        self.confidences[slot] = confidence
+        self.history[slot] = 0
+        self.history[slot, 0] = confidence
+        self.history_len[slot] = 1
+        self.history_pos[slot] = 1 % self.history_size
+        self.frames_since_verify[slot] = 0
+
+    def _record_similarities(self, slots: np.ndarray, confidences: np.ndarray):
+        """Push one similarity per track into the ring buffers and update smoothing and confirmation"""
+        self.history[slots, self.history_pos[slots]] = confidences
+        self.history_pos[slots] = (self.history_pos[slots] + 1) % self.history_size
+        self.history_len[slots] = np.minimum(self.history_len[slots] + 1, self.history_size)
+        lengths = self.history_len[slots]
+
+        # Use average of recent similarities for stability (unwritten slots are zero)
+        self.confidences[slots] = self.history[slots].sum(axis=1) / lengths
+
+        # Check if the last three detections are consistent (not fluctuating wildly)
+        recent_idx = (self.history_pos[slots][:, None] - 1 - np.arange(3)) % self.history_size
+        recent = self.history[slots[:, None], recent_idx]
+        recent_mask = np.arange(3) < np.minimum(lengths, 3)[:, None]
+        recent_count = recent_mask.sum(axis=1)
+        recent_mean = (recent * recent_mask).sum(axis=1) / recent_count
+        recent_std = np.sqrt((((recent - recent_mean[:, None]) ** 2) * recent_mask).sum(axis=1) / recent_count)
+
+        # Low variation = stable recognition (relaxed from 0.05 to 0.08); otherwise still increment slowly
+        stable = np.minimum(self.confirmations[slots] + 1, self.confirmation_threshold + 5)
+        self.confirmations[slots] = np.where(
+            lengths >= 2,
+            np.where(recent_std < 0.08, stable, self.confirmations[slots] + 0.5),
+            self.confirmations[slots] + 1
+        )
+
+    def cached_identity(self, bbox: Tuple[int, int, int, int]) -> Optional[Tuple[str, str, float]]:
+        """
+        Identity of the confirmed track at this position, if it can be reused without recognition.
+
+        Returns:
+            (student_id, name, confidence) or None when the face must be recognised
+        """
+        x, y, w, h = bbox
+        center = np.array([x + w // 2, y + h // 2], dtype=np.float32)
+
+        # Only tracks confirmed and seen in the previous frame, and not due for re-verification
+        candidates = (self.active & (self.ages == 0)
+                      & (self.confirmations >= self.confirmation_threshold)
+                      & (self.frames_since_verify < self.reverify_interval))
+        if not candidates.any():
+            return None
+
+        distance = np.linalg.norm(self.centers - center, axis=1)
+        track_size = np.maximum(self.boxes[:, 2], self.boxes[:, 3])
+        scale = w / np.maximum(self.boxes[:, 2], 1)
+
+        # A large move or scale change between consecutive frames may be a different person
+        candidates &= (distance <= self.jump_threshold * track_size) & (scale >= 0.7) & (scale <= 1.4)
+        if not candidates.any():
+            return None
+
+        slot = int(np.argmin(np.where(candidates, distance, np.inf)))
+        return self.student_ids[slot], self.names[slot], float(self.confidences[slot])
+
+    def invalidate(self, bbox: Tuple[int, int, int, int], student_id: Optional[str] = None):
+        """Drop the confirmation of tracks near bbox whose identity differs from a fresh recognition"""
+        x, y, w, h = bbox
+        center = np.array([x + w // 2, y + h // 2], dtype=np.float32)
+
+        near = (self.active & (np.linalg.norm(self.centers - center, axis=1) < self.max_distance)
+                & (self.student_ids != student_id))
+        self.confirmations[near] = 0
+        self.frames_since_verify[near] = self.reverify_interval
+
+    def expire_identities(self):
+        """Force every track to be recognised again (e.g. after a gallery reload)"""
+        self.frames_since_verify[self.active] = self.reverify_interval
 
     def update(self, detections: List[Tuple[Tuple[int, int, int, int], str, str, float]]) -> List[Tuple[str, str, float, bool]]:
         """
         Update tracks with new detections.
 
-        Args:
-            detections: List of (bbox, student_id, name, confidence) tuples
+        Args:
+            detections: List of (bbox, student_id, name, confidence) tuples, optionally with a
+                        fifth verified flag (False when the identity came from cached_identity)
+
+        Returns:
+            List of (student_id, name, confidence, is_confirmed) for stable tracks
+        """
+        # Age existing tracks and drop the stale ones
+        self.ages[self.active] += 1
+        expired = self.active & (self.ages > self.max_age)
+        self.active[expired] = False
+        self.student_ids[expired] = None
+        self.names[expired] = None
+
+        if detections:
+            det_boxes = np.array([detection[0] for detection in detections], dtype=np.float32)
+            det_centers = det_boxes[:, :2] + det_boxes[:, 2:] // 2
+
+            slots = np.flatnonzero(self.active)
+            matched = dict(self._associate(det_boxes, det_centers, slots)) if len(slots) else {}
+
+            smooth_slots, smooth_confidences = [], []
+            for i, detection in enumerate(detections):
+                bbox, student_id, name, confidence = detection[:4]
+                verified = detection[4] if len(detection) > 4 else True
+                slot = matched.get(i)
+
+                if slot is None:
+                    self._start_track(det_boxes[i], det_centers[i], student_id, name, confidence)
+                    continue
+
+                self.ages[slot] = 0
+                self.boxes[slot] = det_boxes[i]
+                self.centers[slot] = det_centers[i]
+
+                if not verified and self.student_ids[slot] != student_id:
+                    # The cache answered from a different track than the one this box continues:
+                    # hold the identity unconfirmed and recognise the face again next frame
+                    self._reset_identity(slot, student_id, name, confidence)
+                    self.frames_since_verify[slot] = self.reverify_interval
+                elif not verified:
+                    # Identity reused from the cache - nothing new to smooth or confirm
+                    self.frames_since_verify[slot] += 1
+                elif self.student_ids[slot] != student_id:
+                    # Same face by position but recognised as someone else - start the identity over
+                    self._reset_identity(slot, student_id, name, confidence)
+                else:
+                    self.frames_since_verify[slot] = 0
+                    smooth_slots.append(slot)
+                    smooth_confidences.append(confidence)
+
+            if smooth_slots:
+                self._record_similarities(np.array(smooth_slots), np.array(smooth_confidences, dtype=np.float32))
+
+        # Return confirmed tracks only
+        confirmed = np.flatnonzero(self.active & (self.confirmations >= self.confirmation_threshold))
+        return [
+            (self.student_ids[slot], self.names[slot], float(self.confidences[slot]), True)
+            for slot in confirmed
+        ]
+
+    def reset(self):
+        """Clear all tracks"""
+        self._allocate(self.initial_capacity)
+        self.next_track_id = 0
+
+
+class FrameRateMeter:
+    """Frames per second over a sliding time window"""
+
+    def __init__(self, window: float = 2.0):
+        self.window = window
+        self.ticks = deque()
+        self.lock = threading.Lock()
+
+    def tick(self):
+        """Record one frame"""
+        now = time.perf_counter()
+        with self.lock:
+            self.ticks.append(now)
+            while self.ticks and now - self.ticks[0] > self.window:
+                self.ticks.popleft()
+
+    @property
+    def fps(self) -> float:
+        with self.lock:
+            if len(self.ticks) < 2 or time.perf_counter() - self.ticks[-1] > self.window:
+                return 0.0
+            return round((len(self.ticks) - 1) / (self.ticks[-1] - self.ticks[0]), 1)
+
+
+class CameraManager:
+    """
+    Manages camera operations.
+
+    A capture thread reads the camera continuously into a single latest-frame
+    slot; a new frame replaces the previous one whether or not it was consumed,
+    so slow consumers always get the newest frame instead of a growing backlog.
+
+    Frames come from a FrameSource (webcam, RTSP/HTTP camera, video file or
+    image directory) chosen by the source config.
+    """
+
+    def __init__(self, source_config: Union[Dict, int, str, None] = None,
+                 on_frame: Optional[Callable[[], None]] = None):
+        """
+        Args:
+            source_config: Frame source config (see create_frame_source); defaults to device 0
+            on_frame: Called by the capture thread after each new frame is in the slot
+        """
+        self.source_config = source_config
+        self.on_frame = on_frame
+        self.camera: Optional[FrameSource] = None
+        self.active = False
+        self.lock = threading.Lock()
+        self.frame_ready = threading.Condition()
+        self.latest_frame = None
+        self.frame_id = 0
+        self.capture_thread = None
+        self.capture_fps = FrameRateMeter()
+
+    def start(self) -> bool:
+        """Start the camera"""
+        if self.active:
+            self.stop()
+
+        with self.lock:
+            try:
+                self.camera = create_frame_source(self.source_config)
+                if not self.camera.open():
+                    print(f"✗ Could not open camera source: {self.camera.describe()}")
+                    self.camera.release()
+                    self.camera = None
+                    return False
+
+                self.active = True
+            except Exception as e:
+                print(f"Error starting camera: {e}")
+                return False
+
+        self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self.capture_thread.start()
+        return True
+
+    def _capture_loop(self):
+        """Read frames into the latest-frame slot until the camera is stopped"""
+        while self.active:
+            with self.lock:
+                camera = self.camera
+                if camera is None:
+                    break
+                success, frame = camera.read()
+
+            if not success:
+                if camera.exhausted:
+                    # A finite source (video file, image directory) has ended
+                    print(f"✓ Camera source finished: {camera.describe()}")
+                    self.active = False
+                    with self.frame_ready:
+                        self.frame_ready.notify_all()
+                    break
+                if camera.disconnected and self.active:
+                    # Reconnecting waits and may block on the network: keep the lock free for stop()
+                    camera.reconnect()
+                    with self.lock:
+                        if self.camera is not camera:
+                            camera.release()  # stopped while reconnecting
+                    continue
+                time.sleep(0.01)
+                continue
+
+            with self.frame_ready:
+                self.latest_frame = frame
+                self.frame_id += 1
+                self.frame_ready.notify_all()
+            self.capture_fps.tick()
+            if self.on_frame is not None:
+                self.on_frame()
+
+    def stop(self):
+        """Stop the camera"""
+        self.active = False
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+        if self.capture_thread is not None and self.capture_thread is not threading.current_thread():
+            self.capture_thread.join(timeout=2.0)
+        self.capture_thread = None
+
+        with self.lock:
+            if self.camera is not None:
+                self.camera.release()
+                self.camera = None
+                # Small delay to ensure camera is fully released
+                time.sleep(0.1)
+
+        with self.frame_ready:
+            self.latest_frame = None
+
+    def read_frame(self) -> Optional[np.ndarray]:
+        """Latest captured frame"""
+        with self.frame_ready:
+            if not self.active:
+                return None
+            return self.latest_frame
+
+    def wait_for_frame(self, after_id: int, timeout: float = 1.0) -> Tuple[int, Optional[np.ndarray]]:
+        """
+        Wait for a frame newer than after_id.
+
+        Returns:
+            (frame_id, frame), or (after_id, None) on timeout or when the camera stops
+        """
+        with self.frame_ready:
+            self.frame_ready.wait_for(lambda: self.frame_id > after_id or not self.active, timeout)
+            if not self.active or self.frame_id <= after_id or self.latest_frame is None:
+                return after_id, None
+            return self.frame_id, self.latest_frame
+
+    def is_active(self) -> bool:
+        """Check if camera is active"""
+        return self.active
+
+
+class FrameBroadcaster:
+    """
+    Publishes one camera's MJPEG frames to any number of viewers.
+
+    A single producer thread draws the recognition boxes onto each new frame and
+    JPEG-encodes it once per (quality, scale) profile that a viewer is using;
+    every viewer with that profile gets the same bytes. Frames that are visually
+    unchanged (and have the same boxes) are not re-encoded at all.
+
+    Viewers that cannot keep up (they miss published frames) are stepped down in
+    quality, and stepped back up once they keep up again.
+    """
+
+    MIN_QUALITY = 30
+
+    def __init__(self, camera_manager: CameraManager,
+                 overlays: Callable[[], List[Tuple[Tuple[int, int, int, int], Tuple[int, int, int], str]]],
+                 change_threshold: float = 1.5, keepalive: float = 1.0):
+        """
+        Args:
+            camera_manager: Camera whose latest-frame slot is broadcast
+            overlays: Returns the boxes to draw on the current frame
+            change_threshold: Mean absolute difference (0-255) of a 32x24 grey thumbnail
+                              below which a frame counts as unchanged
+            keepalive: Seconds after which an unchanged frame is published anyway
+        """
+        self.camera_manager = camera_manager
+        self.overlays = overlays
+        self.change_threshold = change_threshold
+        self.keepalive = keepalive
+
+        self.cond = threading.Condition()
+        self.profiles: Dict[Tuple[int, float], int] = {}  # (quality, scale) -> number of viewers
+        self.encoded: Dict[Tuple[int, float], bytes] = {}
+        self.seq = 0
+        self.producer = None
+        self.stream_fps = FrameRateMeter()
+        self.unchanged_frames = 0
+
+    @property
+    def viewers(self) -> int:
+        with self.cond:
+            return sum(self.profiles.values())
+
+    @staticmethod
+    def encode(frame: np.ndarray, quality: int, scale: float) -> Optional[bytes]:
+        """JPEG-encode a frame at the given quality, downscaled by scale"""
+        if scale < 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        return buffer.tobytes() if ret else None
+
+    def _add_profile(self, profile: Tuple[int, float]):
+        with self.cond:
+            self.profiles[profile] = self.profiles.get(profile, 0) + 1
+            if self.producer is None or not self.producer.is_alive():
+                self.producer = threading.Thread(target=self._produce, daemon=True)
+                self.producer.start()
+
+    def _remove_profile(self, profile: Tuple[int, float]):
+        with self.cond:
+            self.profiles[profile] -= 1
+            if not self.profiles[profile]:
+                del self.profiles[profile]
+                self.encoded.pop(profile, None)
+
+    def _produce(self):
+        """Encode each new (changed) frame once per active profile and wake the viewers"""
+        last_id = 0
+        last_thumb = None
+        last_overlays = None
+        last_publish = 0.0
+
+        while self.camera_manager.is_active():
+            with self.cond:
+                if not self.profiles:
+                    self.producer = None
+                    return
+                profiles = list(self.profiles)
+                missing = [profile for profile in profiles if profile not in self.encoded]
+
+            frame_id, frame = self.camera_manager.wait_for_frame(last_id, timeout=0.5)
+            if frame is None:
+                continue
+            last_id = frame_id
+
+            overlays = self.overlays()
+            thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 24), interpolation=cv2.INTER_AREA)
+            unchanged = (
+                not missing
+                and last_thumb is not None
+                and overlays == last_overlays
+                and time.perf_counter() - last_publish < self.keepalive
+                and cv2.absdiff(thumb, last_thumb).mean() < self.change_threshold
+            )
+            if unchanged:
+                self.unchanged_frames += 1
+                continue
+
+            if overlays:
+                frame = FacialRecognitionSystem.draw_overlays(frame.copy(), overlays)
+            encoded = {profile: self.encode(frame, *profile) for profile in profiles}
+
+            with self.cond:
+                self.encoded = {profile: data for profile, data in encoded.items() if data is not None}
+                self.seq += 1
+                self.cond.notify_all()
+
+            last_thumb, last_overlays, last_publish = thumb, overlays, time.perf_counter()
+            self.stream_fps.tick()
+
+        with self.cond:
+            self.producer = None
+            self.cond.notify_all()
+
+    def subscribe(self, quality: int = 80, scale: float = 1.0, adaptive: bool = True):
+        """
+        MJPEG multipart generator for one viewer.
+
+        Args:
+            quality: Requested JPEG quality (rounded to a multiple of 10 so viewers share encodes)
+            scale: Downscale factor (0.1 - 1.0)
+            adaptive: Lower the quality while this viewer is missing frames
+        """
+        requested = int(min(max(round(quality, -1), self.MIN_QUALITY), 100))
+        scale = round(min(max(float(scale), 0.1), 1.0), 2)
+        profile = (requested, scale)
+        self._add_profile(profile)
+
+        last_seq = 0
+        lagging = on_time = 0
+        try:
+            while self.camera_manager.is_active():
+                with self.cond:
+                    self.cond.wait_for(lambda: self.seq > last_seq or not self.camera_manager.is_active(), 1.0)
+                    if self.seq <= last_seq:
+                        continue
+                    missed = self.seq - last_seq - 1 if last_seq else 0
+                    last_seq = self.seq
+                    frame_bytes = self.encoded.get(profile)
+
+                if adaptive:
+                    lagging, on_time = (lagging + 1, 0) if missed else (0, on_time + 1)
+                    quality = profile[0]
+                    if lagging >= 3 and quality > self.MIN_QUALITY:
+                        quality -= 10
+                    elif on_time >= 30 and quality < requested:
+                        quality += 10
+                    if quality != profile[0]:
+                        self._remove_profile(profile)
+                        profile = (quality, scale)
+                        self._add_profile(profile)
+                        lagging = on_time = 0
+
+                if frame_bytes is None:
+                    continue
+
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        finally:
+            self._remove_profile(profile)
+
+
+class CameraPipeline:
+    """
+    One camera's recognition pipeline.
+
+    Owns the camera, its face tracker, attendance session, current boxes and
+    MJPEG broadcast. Models and the face gallery belong to the shared
+    FacialRecognitionSystem, and frames are recognised by the shared
+    InferenceScheduler workers.
+    """
+
+    def __init__(self, system: 'FacialRecognitionSystem', camera_id: str,
+                 source_config: Union[Dict, int, str, None], config: Dict,
+                 roi: Optional[List[List[float]]] = None):
+        self.system = system
+        self.camera_id = camera_id
+        self.source_config = source_config
+        self.roi = roi  # [[x, y, w, h], ...] fractions of the frame searched for faces (None = whole frame)
+        self.camera_manager = CameraManager(source_config, on_frame=self._frame_captured)
+        self.session = AttendanceSession()
+        self.face_tracker = FaceTracker(
+            max_age=10,  # Track faces for up to 10 frames
+            reverify_interval=config.get('track_reverify_interval', 15),
+            jump_threshold=config.get('track_jump_threshold', 0.5),
+            assignment=config.get('track_assignment', 'greedy')
+        )
+        self.scanning_active = False
+
+        # Faces recognised (embedded + matched) vs. served from a track's cached identity
+        self.recognition_stats = {'recognized': 0, 'cached': 0}
+        self._recognition_scope = None
+
+        # Recognition works on the newest captured frame; the stream draws the last
+        # known boxes, so stream and recognition rates are independent
+        self._overlays: List[Tuple[Tuple[int, int, int, int], Tuple[int, int, int], str]] = []
+        self.recognition_fps = FrameRateMeter()
+        self.recognition_skipped_frames = 0
+        self.last_processed_id = 0
+        self.in_flight = False  # A scheduler worker is recognising a frame of this camera
+
+        # One encoder per camera, shared by every MJPEG viewer
+        self.broadcaster = FrameBroadcaster(
+            self.camera_manager,
+            lambda: self._overlays if self.scanning_active else [],
+            change_threshold=config.get('stream_change_threshold', 1.5)
+        )
+
+    def _frame_captured(self):
+        """Wake an idle scheduler worker for the new frame (only while scanning)"""
+        if self.scanning_active:
+            self.system.scheduler.wake()
+
+    @property
+    def backlog(self) -> int:
+        """Frames captured since the last recognised one (0 when not scanning)"""
+        if not self.scanning_active or not self.camera_manager.is_active():
+            return 0
+        return max(0, self.camera_manager.frame_id - self.last_processed_id)
+
+    def start_scanning(self, **session_data):
+        """Open the class session in the shared registry and queue this camera's frames for recognition"""
+        timetable_id = session_data.get('timetable_id') or session_data.get('session_id') or f"camera-{self.camera_id}"
+        self.session = self.system.sessions.open(
+            timetable_id, session_data.get('date'), self.system.sessions_in_use(), session_data
+        )
+        self.last_processed_id = self.camera_manager.frame_id
+        self.scanning_active = True
+        self.system.scheduler.start()
+
+    def stop_scanning(self):
+        self.scanning_active = False
+        self._overlays = []
+
+    def _match_scope(self) -> Tuple[Optional[int], bool]:
+        """(module_id, fallback_to_full) for the current session's roster-scoped matching"""
+        session_data = self.session.get_data()
+        module_id = session_data.get('module_id')
+        fallback = session_data.get('full_gallery_fallback', self.system.full_gallery_fallback)
+        return (int(module_id) if module_id else None), bool(fallback)
+
+    def process_frame(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Process a frame with face detection and recognition.
+        Includes quality filtering and temporal tracking for improved accuracy.
+        """
+        if not self.scanning_active:
+            return frame
+
+        return FacialRecognitionSystem.draw_overlays(frame, self.analyze_frame(frame))
+
+    def analyze_frame(self, frame: np.ndarray) -> List[Tuple[Tuple[int, int, int, int], Tuple[int, int, int], str]]:
+        """
+        Detect, recognise and track the faces of a frame and update the session.
+
+        Returns:
+            (bbox, colour, label) boxes to draw for this frame
+        """
+        system = self.system
+        overlays = []
+
+        module_id, fallback_to_full = self._match_scope()
+
+        # Cached identities are only valid for the gallery and roster that produced them
+        scope = (module_id, fallback_to_full, system.face_database.version)
+        if scope != self._recognition_scope:
+            self.face_tracker.expire_identities()
+            self._recognition_scope = scope
+
+        # Detect faces
+        with system.model_pool.checkout() as (detector, _):
+            faces = detector.detect(frame, self.roi)
+
+        detections = []  # Store (bbox, student_id, name, confidence) for tracking
+        unmatched_faces = []  # Store unmatched face bboxes
+
+        if faces is not None:
+            # Filter and sort faces by detection confidence
+            valid_faces = []
+            frame_height, frame_width = frame.shape[:2]
+
+            for face in faces:
+                detection_confidence = face[14]
+
+                # Skip low-confidence detections
+                if detection_confidence <= system.confidence_threshold:
+                    continue
+
+                # Validate face geometry (filter out hands, arms, etc.)
+                if not system.face_detector.is_valid_face(face, frame_width, frame_height):
+                    continue
+
+                valid_faces.append((face, detection_confidence))
+
+            # Sort by detection confidence (highest first)
+            valid_faces.sort(key=lambda x: x[1], reverse=True)
+
+            # Faces without a reusable track identity are recognised together below
+            pending_faces = []
+            for face, detection_confidence in valid_faces:
+                x, y, w, h = face[:4].astype(int)
+
+                # A confirmed track at the same place already knows who this is
+                cached = self.face_tracker.cached_identity((x, y, w, h))
+                if cached is not None:
+                    student_id, name, confidence_pct = cached
+                    detections.append(((x, y, w, h), student_id, name, confidence_pct, False))
+                    self.recognition_stats['cached'] += 1
+                    continue
+
+                pending_faces.append(face)
+
+            if pending_faces:
+                self.recognition_stats['recognized'] += len(pending_faces)
+
+                # Extract features for all faces in one batch
+                with system.model_pool.checkout() as (_, recognizer):
+                    features = recognizer.extract_features_batch(frame, pending_faces)
+                embedded = [(face, feature) for face, feature in zip(pending_faces, features) if feature is not None]
+
+                # Match every face against the gallery in one matrix product
+                matches, _ = system.face_database.find_matches_versioned(
+                    [feature for _, feature in embedded], system.recognition_threshold,
+                    module_id=module_id, fallback_to_full=fallback_to_full
+                )
+
+                for (face, _), match in zip(embedded, matches):
+                    x, y, w, h = face[:4].astype(int)
+
+                    if match:
+                        student_id, name, similarity = match
+                        confidence_pct = system._normalize_confidence(similarity)
+
+                        # Add to detections for tracking
+                        detections.append(((x, y, w, h), student_id, name, confidence_pct, True))
+                        self.face_tracker.invalidate((x, y, w, h), student_id)
+                    else:
+                        # No match - store for "Unknown" box
+                        unmatched_faces.append((x, y, w, h))
+                        self.face_tracker.invalidate((x, y, w, h))
+
+        # Update tracker with current frame detections
+        confirmed_tracks = self.face_tracker.update(detections)
+
+        # Build a map of student_id -> bbox from current detections
+        detection_map = {det_id: det_bbox for det_bbox, det_id, *_ in detections}
+
+        # Draw boxes for ALL detections immediately (don't wait for confirmation)
+        drawn_student_ids = set()
+        for det_bbox, student_id, name, confidence_pct, *_ in detections:
+            x, y, w, h = det_bbox
+
+            # Check if this student is confirmed by tracker
+            is_confirmed = any(sid == student_id for sid, _, _, _ in confirmed_tracks)
+
+            # Green box for recognized student
+            box_color = (0, 255, 0)
+            label = f"{name} ({confidence_pct:.1f}%)"
+            overlays.append(((x, y, w, h), box_color, label))
 
-        Returns:
-            List of (student_id, name, confidence, is_confirmed) for stable tracks
-        """
-        current_frame_tracks = []
-
-        # Age existing tracks
-        for track_id in list(self.tracks.keys()):
-            self.tracks[track_id]['last_seen'] += 1
-            if self.tracks[track_id]['last_seen'] > self.max_age:
-                del self.tracks[track_id]
-
-        # Match new detections to existing tracks
-        for bbox, student_id, name, confidence in detections:
-            x, y, w, h = bbox
-            center = (x + w // 2, y + h // 2)
-
-            # Find closest existing track for this student
-            best_track_id = None
-            best_distance = float('inf')
-
-            for track_id, track_data in self.tracks.items():
-                if track_data['student_id'] == student_id:
-                    track_center = track_data['position']
-                    distance = np.sqrt((center[0] - track_center[0])**2 + (center[1] - track_center[1])**2)
-
-                    if distance < 100 and distance < best_distance:  # Within 100 pixels
-                        best_distance = distance
-                        best_track_id = track_id
-
-            if best_track_id is not None:
-                # Update existing track
-                track = self.tracks[best_track_id]
-                track['last_seen'] = 0
-                track['position'] = center
-
-                # Add to similarity history for smoothing
-                if 'similarity_history' not in track:
-                    track['similarity_history'] = []
-                track['similarity_history'].append(confidence)
-
-                # Keep only recent history
-                if len(track['similarity_history']) > self.history_size:
-                    track['similarity_history'].pop(0)
-
-                # Use average of recent similarities for stability
-                avg_confidence = np.mean(track['similarity_history'])
-                track['confidence'] = avg_confidence
-
-                # Increment confirmation count only if consistent
-                if len(track['similarity_history']) >= 2:
-                    # Check if recent detections are consistent (not fluctuating wildly)
-                    recent = track['similarity_history'][-3:] if len(track['similarity_history']) >= 3 else track['similarity_history']
-                    std_dev = np.std(recent)
-
-                    if std_dev < 0.08:  # Low variation = stable recognition (relaxed from 0.05 to 0.08)
-                        track['confirmation_count'] = min(
-                            track['confirmation_count'] + 1,
-                            self.confirmation_threshold + 5
-                        )
-                    else:
-                        # Even if variation is higher, still increment slowly
-                        track['confirmation_count'] += 0.5
-                else:
-                    track['confirmation_count'] += 1
-            else:
-                # Create new track
-                self.tracks[self.next_track_id] = {
-                    'student_id': student_id,
-                    'name': name,
-                    'position': center,
-                    'last_seen': 0,
-                    'confirmation_count': 1,
-                    'confidence': confidence,
-                    'similarity_history': [confidence]
-                }
-                self.next_track_id += 1
+            # Add to session ONLY if confirmed by tracker
+            if is_confirmed:
+                added = self.session.add_student(
+                    student_id, name,
+                    confidence_pct,
+                    100  # liveness - not used currently
+                )
+                if added:
+                    self._record_attendance(student_id, confidence_pct)
 
-        # Return confirmed tracks only
-        confirmed_tracks = []
-        for track_data in self.tracks.values():
-            if track_data['confirmation_count'] >= self.confirmation_threshold:
-                confirmed_tracks.append((
-                    track_data['student_id'],
-                    track_data['name'],
-                    track_data['confidence'],
-                    True
-                ))
+            drawn_student_ids.add(student_id)
 
-        return confirmed_tracks
+        # Orange boxes for unmatched faces
+        for x, y, w, h in unmatched_faces:
+            overlays.append(((x, y, w, h), (0, 165, 255), "Unknown"))
+
+        return overlays
+
+    def _record_attendance(self, student_id: str, confidence_pct: float):
+        """Queue a newly recognised student for the attendance table (sessions tied to a module only)"""
+        writer = self.system.attendance_writer
+        session_data = self.session.session_data
+        if writer is None or not session_data.get('module_id'):
+            return
+        writer.enqueue(
+            student_id, session_data['module_id'],
+            session_data.get('timetable_id') or session_data.get('session_id'),
+            confidence_pct
+        )
 
-    def reset(self):
-        """Clear all tracks"""
-        self.tracks = {}
-        self.next_track_id = 0
+    def recognize_latest(self) -> bool:
+        """Recognise the newest captured frame (called by a scheduler worker); False if there was none"""
+        frame_id, frame = self.camera_manager.wait_for_frame(self.last_processed_id, timeout=0)
+        if frame is None:
+            return False
 
+        if self.last_processed_id:
+            self.recognition_skipped_frames += frame_id - self.last_processed_id - 1
+        self.last_processed_id = frame_id
 
-class CameraManager:
-    """Manages camera operations"""
+        try:
+            self._overlays = self.analyze_frame(frame)
+        except Exception as e:
+            print(f"Error processing frame from camera {self.camera_id}: {e}")
+        self.recognition_fps.tick()
+        return True
 
-    def __init__(self):
-        self.camera = None
-        self.active = False
-        self.lock = threading.Lock()
+    def generate_video_stream(self, quality: int = 80, scale: float = 1.0, adaptive: bool = True):
+        """Generate video frames for streaming (one viewer of the shared broadcast)"""
+        return self.broadcaster.subscribe(quality, scale, adaptive)
+
+    def stats(self) -> Dict:
+        """Per-camera state and rates for the API"""
+        return {
+            'camera_id': self.camera_id,
+            'active': self.camera_manager.is_active(),
+            'scanning': self.scanning_active,
+            'recognition_stats': self.recognition_stats,
+            'capture_fps': self.camera_manager.capture_fps.fps,
+            'stream_fps': self.broadcaster.stream_fps.fps,
+            'viewers': self.broadcaster.viewers,
+            'unchanged_frames_skipped': self.broadcaster.unchanged_frames,
+            'recognition_fps': self.recognition_fps.fps,
+            'recognition_skipped_frames': self.recognition_skipped_frames,
+            'backlog': self.backlog
+        }
 
-    def start(self) -> bool:
-        """Start the camera"""
-        with self.lock:
-            if self.active:
-                self.stop()
 
-            try:
-                self.camera = cv2.VideoCapture(0)
-                if not self.camera.isOpened():
-                    return False
+class InferenceScheduler:
+    """
+    Shares a fixed number of recognition workers fairly between cameras.
 
-                self.active = True
-                return True
-            except Exception as e:
-                print(f"Error starting camera: {e}")
-                return False
+    Workers visit cameras round robin and take one frame (the newest) from each
+    scanning camera that has a new frame, so a busy room cannot starve the
+    others; a camera is never recognised by two workers at once. Idle workers
+    block on work_ready until a capture thread (or a worker releasing a camera)
+    calls wake(), so no CPU is spent while no frames arrive.
+    """
 
-    def stop(self):
-        """Stop the camera"""
+    def __init__(self, system: 'FacialRecognitionSystem', workers: int = 1):
+        self.system = system
+        self.workers = max(1, int(workers or 1))
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.threads: List[threading.Thread] = []
+        self.work_ready = threading.Condition()
+        self.signals = 0  # Bumped by every wake(), so a wake-up between checking and waiting is not lost
+
+    def wake(self):
+        """A camera may have a frame to recognise"""
+        with self.work_ready:
+            self.signals += 1
+            self.work_ready.notify()
+
+    def start(self):
+        """Start the worker threads if they are not running"""
         with self.lock:
-            self.active = False
-            if self.camera is not None:
-                self.camera.release()
-                self.camera = None
-                # Force cleanup on macOS
-                cv2.destroyAllWindows()
-                # Small delay to ensure camera is fully released
-                time.sleep(0.1)
-
-    def read_frame(self) -> Optional[np.ndarray]:
-        """Read a frame from the camera"""
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            for _ in range(self.workers - len(self.threads)):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _next_camera(self) -> Optional[CameraPipeline]:
+        """Next camera in round-robin order with an unrecognised frame, marked in flight"""
         with self.lock:
-            if not self.active or self.camera is None:
-                return None
+            cameras = list(self.system.cameras.values())
+            for offset in range(len(cameras)):
+                camera = cameras[(self.turn + offset) % len(cameras)]
+                if camera.in_flight or not camera.scanning_active or not camera.camera_manager.is_active():
+                    continue
+                if camera.camera_manager.frame_id <= camera.last_processed_id:
+                    continue
+                self.turn = (self.turn + offset + 1) % len(cameras)
+                camera.in_flight = True
+                return camera
+            return None
 
-            success, frame = self.camera.read()
-            return frame if success else None
+    def _work(self):
+        while True:
+            with self.work_ready:
+                seen = self.signals
+            camera = self._next_camera()
+            if camera is None:
+                with self.work_ready:
+                    self.work_ready.wait_for(lambda: self.signals != seen, timeout=1.0)
+                continue
 
-    def is_active(self) -> bool:
-        """Check if camera is active"""
-        return self.active
+            try:
+                camera.recognize_latest()
+            finally:
+                camera.in_flight = False
+                # Another worker may have skipped this camera while it was in flight
+                self.wake()
 
 
 class FacialRecognitionSystem:
-    """Main facial recognition system orchestrator"""
+    """
+    Main facial recognition system orchestrator.
+
+    Loads one set of models and one face gallery and runs any number of camera
+    pipelines on them. The single-camera attributes (camera_manager, session,
+    scanning_active, ...) refer to the default camera.
+    """
 
     def __init__(self, config: Dict):
         self.config = config
         self.face_detector = FaceDetector(
             config['yunet_model_path'],
-            config['detection_score_threshold']
+            config['detection_score_threshold'],
+            config.get('detection_policy')
         )
         self.face_recognizer = FaceRecognizer(config['face_recognition_model_path'])
-        self.face_database = FaceDatabase(self.face_recognizer)
-        self.session = AttendanceSession()
-        self.camera_manager = CameraManager()
-        self.face_tracker = FaceTracker(max_age=10)  # Track faces for up to 10 frames
-        self.scanning_active = False
+        self.face_database = FaceDatabase(
+            self.face_recognizer,
+            config.get('ann_index'),
+            storage=config.get('gallery_storage', 'float32'),
+            max_prototypes=config.get('max_prototypes_per_student', 1)
+        )
+
+        # The OpenCV detector/recognizer are not thread-safe; cameras and requests check
+        # out their own pair (the first pair is face_detector / face_recognizer above).
+        # Every inference worker needs a pair, or the workers just take turns on one
+        inference_workers = max(1, int(config.get('inference_workers') or 1))
+        self.model_pool = ModelPool(
+            self.face_detector, self.face_recognizer,
+            size=max(inference_workers, int(config.get('model_pool_size') or 1)),
+            opencv_threads=config.get('opencv_threads')
+        )
+        self.face_database.model_pool = self.model_pool
 
         # Recognition thresholds (optimized for uploaded photos)
         self.recognition_threshold = config.get('recognition_threshold', 0.25)  # Lowered for better matching
         self.confidence_threshold = config.get('confidence_threshold', 0.4)  # Lowered for easier detection
 
+        # Match against the running module's roster; only widen to every student when asked
+        self.full_gallery_fallback = config.get('full_gallery_fallback', False)
+
         # Face quality thresholds
         self.min_face_size = 40  # Minimum face width/height in pixels (further relaxed)
         self.min_sharpness = 20  # Minimum Laplacian variance for sharpness (relaxed, not used in process_frame)
 
+        # Attendance sessions of all running classes, keyed by (timetable_id, date)
+        self.sessions = SessionRegistry(idle_ttl=config.get('session_idle_ttl', 6 * 3600))
+
+        # Class start times and late policies, shared by every attendance write path
+        self.attendance_rules = AttendanceRules(config.get('attendance_rules_ttl', 300))
+
+        # Confirmed recognitions are written to the attendance table in batches
+        self.attendance_writer = AttendanceWriter(
+            flush_interval=config.get('attendance_flush_interval', 0.3),
+            rules=self.attendance_rules
+        ) if config.get('attendance_write_behind', True) else None
+
+        # camera_id -> pipeline; without a 'cameras' config there is one camera from camera_source
+        camera_configs = config.get('cameras') or {
+            'default': {'source': config.get('camera_source'), 'roi': config.get('camera_roi')}
+        }
+        self.cameras: Dict[str, CameraPipeline] = {
+            str(camera_id): CameraPipeline(self, str(camera_id), camera_config.get('source'), config,
+                                           roi=camera_config.get('roi'))
+            for camera_id, camera_config in camera_configs.items()
+        }
+        self.default_camera_id = next(iter(self.cameras))
+        self.scheduler = InferenceScheduler(self, inference_workers)
+
+    def sessions_in_use(self) -> set:
+        """Registry keys of the sessions cameras are currently scanning"""
+        return {camera.session.key for camera in self.cameras.values() if camera.scanning_active}
+
+    def camera(self, camera_id: Optional[str] = None) -> Optional[CameraPipeline]:
+        """Pipeline of a camera (the default camera when camera_id is None)"""
+        return self.cameras.get(str(camera_id) if camera_id is not None else self.default_camera_id)
+
+    @property
+    def default_camera(self) -> CameraPipeline:
+        return self.cameras[self.default_camera_id]
+
+    @property
+    def camera_manager(self) -> CameraManager:
+        return self.default_camera.camera_manager
+
+    @property
+    def session(self) -> AttendanceSession:
+        return self.default_camera.session
+
+    @property
+    def face_tracker(self) -> FaceTracker:
+        return self.default_camera.face_tracker
+
+    @property
+    def scanning_active(self) -> bool:
+        return self.default_camera.scanning_active
+
+    @scanning_active.setter
+    def scanning_active(self, value: bool):
+        self.default_camera.scanning_active = value
+
+    @property
+    def recognition_stats(self) -> Dict:
+        return self.default_camera.recognition_stats
+
     def initialize(self) -> bool:
         """Initialize all components"""
         print("=" * 60)
@@ -714,8 +3119,13 @@ class FacialRecognitionSystem:
         if not self.face_detector.detector or not self.face_recognizer.recognizer:
             return False
 
+        print(f"\nCameras: {', '.join(self.cameras)}")
+
         print("\nLoading known faces...")
-        return self.face_database.load_from_database()
+        return self.face_database.load_from_database(
+            bulk=self.config.get('face_loader_bulk', True),
+            workers=self.config.get('face_loader_workers')
+        )
 
     def _check_face_quality(self, frame: np.ndarray, bbox: Tuple[int, int, int, int]) -> Tuple[bool, str]:
         """
@@ -746,101 +3156,21 @@ class FacialRecognitionSystem:
         return True, "good"
 
     def process_frame(self, frame: np.ndarray) -> np.ndarray:
-        """
-        Process a frame with face detection and recognition.
-        Includes quality filtering and temporal tracking for improved accuracy.
-        """
-        if not self.scanning_active:
-            return frame
-
-        # Detect faces
-        faces = self.face_detector.detect(frame)
-
-        detections = []  # Store (bbox, student_id, name, confidence) for tracking
-        unmatched_faces = []  # Store unmatched face bboxes
-
-        if faces is not None:
-            # Filter and sort faces by detection confidence
-            valid_faces = []
-            frame_height, frame_width = frame.shape[:2]
-
-            for face in faces:
-                detection_confidence = face[14]
-
-                # Skip low-confidence detections
-                if detection_confidence <= self.confidence_threshold:
-                    continue
-
-                # Validate face geometry (filter out hands, arms, etc.)
-                if not self.face_detector.is_valid_face(face, frame_width, frame_height):
-                    continue
-
-                valid_faces.append((face, detection_confidence))
-
-            # Sort by confidence and only process the best detection
-            # This prevents false positives from multiple weak detections
-            valid_faces.sort(key=lambda x: x[1], reverse=True)
-
-            # Process only the top detection (highest confidence face)
-            for face, detection_confidence in valid_faces[:1]:  # Only process best match
-                x, y, w, h = face[:4].astype(int)
-
-                # Extract features
-                feature = self.face_recognizer.extract_features(frame, face)
-
-                if feature is not None:
-                    # Find matching student
-                    match = self.face_database.find_match(feature, self.recognition_threshold)
-
-                    if match:
-                        student_id, name, similarity = match
-                        confidence_pct = self._normalize_confidence(similarity)
-
-                        # Add to detections for tracking
-                        detections.append(((x, y, w, h), student_id, name, confidence_pct))
-                    else:
-                        # No match - store for "Unknown" box
-                        unmatched_faces.append((x, y, w, h))
-
-        # Update tracker with current frame detections
-        confirmed_tracks = self.face_tracker.update(detections)
-
-        # Build a map of student_id -> bbox from current detections
-        detection_map = {det_id: det_bbox for det_bbox, det_id, _, _ in detections}
-
-        # Draw boxes for ALL detections immediately (don't wait for confirmation)
-        drawn_student_ids = set()
-        for det_bbox, student_id, name, confidence_pct in detections:
-            x, y, w, h = det_bbox
-
-            # Check if this student is confirmed by tracker
-            is_confirmed = any(sid == student_id for sid, _, _, _ in confirmed_tracks)
+        """Process a frame of the default camera (see CameraPipeline.process_frame)"""
+        return self.default_camera.process_frame(frame)
 
-            # Draw green box for recognized student
-            box_color = (0, 255, 0)
-            label = f"{name} ({confidence_pct:.1f}%)"
+    def analyze_frame(self, frame: np.ndarray) -> List[Tuple[Tuple[int, int, int, int], Tuple[int, int, int], str]]:
+        """Analyze a frame for the default camera (see CameraPipeline.analyze_frame)"""
+        return self.default_camera.analyze_frame(frame)
 
+    @staticmethod
+    def draw_overlays(frame: np.ndarray,
+                      overlays: List[Tuple[Tuple[int, int, int, int], Tuple[int, int, int], str]]) -> np.ndarray:
+        """Draw (bbox, colour, label) boxes onto a frame"""
+        for (x, y, w, h), box_color, label in overlays:
             cv2.rectangle(frame, (x, y), (x + w, y + h), box_color, 2)
             cv2.putText(frame, label, (x, y-10),
                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, box_color, 2)
-
-            # Add to session ONLY if confirmed by tracker
-            if is_confirmed:
-                self.session.add_student(
-                    student_id, name,
-                    confidence_pct,
-                    100  # liveness - not used currently
-                )
-
-            drawn_student_ids.add(student_id)
-
-        # Draw orange boxes for unmatched faces
-        for x, y, w, h in unmatched_faces:
-            box_color = (0, 165, 255)  # Orange
-            cv2.rectangle(frame, (x, y), (x + w, y + h), box_color, 2)
-            cv2.putText(frame, "Unknown", (x, y-10),
-                      cv2.FONT_HERSHEY_SIMPLEX, 0.6, box_color, 2)
-
         return frame
 
     @staticmethod
@@ -862,27 +3192,9 @@ class FacialRecognitionSystem:
             # Acceptable match: 75-80%
             return 75 + ((similarity - 0.25) / 0.05) * 5
 
-    def generate_video_stream(self):
-        """Generate video frames for streaming"""
-        while self.camera_manager.is_active():
-            frame = self.camera_manager.read_frame()
-            if frame is None:
-                break
-
-            # Process frame with recognition if scanning is active
-            if self.scanning_active:
-                frame = self.process_frame(frame)
-
-            # Encode frame as JPEG
-            ret, buffer = cv2.imencode('.jpg', frame)
-            if not ret:
-                continue
-
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-
-            time.sleep(0.033)  # ~30 FPS
+    def generate_video_stream(self, quality: int = 80, scale: float = 1.0, adaptive: bool = True):
+        """Generate video frames for streaming from the default camera"""
+        return self.default_camera.generate_video_stream(quality, scale, adaptive)
 
 
 # =============================================================================
@@ -898,7 +3210,35 @@ CONFIG = {
     'face_recognition_model_path': os.path.join(os.path.dirname(__file__), 'models', 'face_recognition_sface_2021dec.onnx'),
     'detection_score_threshold': 0.5,  # Lowered from 0.6 for better face detection
     'recognition_threshold': 0.25,  # Lowered from 0.30 for better matching with uploaded photos
-    'confidence_threshold': 0.4  # Lowered from 0.5 to detect faces more easily
+    'confidence_threshold': 0.4,  # Lowered from 0.5 to detect faces more easily
+    'face_loader_bulk': True,  # Stream all face images in one query instead of one per student
+    'face_loader_workers': None,  # Decode/embedding threads for the bulk loader (None = CPU count, max 8)
+    # Approximate search for very large galleries (None = always exact); exact search is used below min_size
+    'ann_index': {'type': 'ivf', 'min_size': 20000, 'nlist': None, 'nprobe': 16},
+    'full_gallery_fallback': False,  # Retry against every student when the session module's roster has no match
+    'gallery_storage': 'float32',  # 'int8' = int8 codes only (about a quarter of the embedding memory)
+    'max_prototypes_per_student': 1,  # >1 clusters each student's photos into up to K prototypes (max-matched)
+    'track_reverify_interval': 15,  # Frames a confirmed track's identity is reused before re-recognising the face
+    'track_jump_threshold': 0.5,  # Box centre jump (fraction of box size) that forces re-recognition
+    'track_assignment': 'greedy',  # Detection-to-track assignment: 'greedy' or 'hungarian' (requires scipy)
+    'stream_change_threshold': 1.5,  # Mean thumbnail difference (0-255) below which a stream frame is not re-encoded
+    # Frame source: device index, RTSP/HTTP URL, or {'type': 'device'|'url'|'file'|'images', ...}
+    # e.g. {'type': 'file', 'path': 'lecture.mp4', 'pacing': 'fast'} to replay a recording headless
+    'camera_source': os.environ.get('FACEREC_CAMERA_SOURCE') or {'type': 'device', 'index': 0},
+    # Several cameras in one process sharing the models and gallery, e.g.
+    # {'room-101': {'source': 'rtsp://...', 'roi': [[0.6, 0.0, 0.4, 1.0]]}, 'room-102': {'source': 1}};
+    # None = one camera from camera_source
+    'cameras': None,
+    'camera_roi': None,  # Regions [[x, y, w, h], ...] (fractions of the frame) of camera_source searched for faces
+    # Working resolution, small-face tiling etc. for FaceDetector.detect (see DEFAULT_DETECTION_POLICY)
+    'detection_policy': {'working_width': 640, 'tiles': True, 'tile_size': 1280, 'tile_scale': None},
+    'inference_workers': 1,  # Recognition workers shared round robin by all scanning cameras
+    'model_pool_size': int(os.environ.get('FACEREC_MODEL_POOL_SIZE', '1')),  # Detector/recognizer pairs (at least inference_workers)
+    'opencv_threads': None,  # cv2.setNumThreads (None = CPU count / model_pool_size)
+    'session_idle_ttl': 6 * 3600,  # Seconds an unused class session is kept in memory after its last activity
+    'attendance_write_behind': True,  # Batch automatic attendance writes (scanning and save-one) in the background
+    'attendance_flush_interval': 0.3,  # Seconds between write-behind flushes
+    'attendance_rules_ttl': 300  # Seconds timetable start times and late policies are cached
 }
 
 # Initialize the facial recognition system
@@ -912,14 +3252,20 @@ def health_check():
         'status': 'ok',
         'message': 'Facial Recognition Controller running',
         'models_initialized': recognition_system.face_detector.detector is not None,
-        'known_faces': recognition_system.face_database.get_count()
+        'known_faces': recognition_system.face_database.get_count(),
+        'gallery_version': recognition_system.face_database.version,
+        'model_pool': recognition_system.model_pool.stats(),
+        'attendance_flush_lag_ms': (recognition_system.attendance_writer.metrics()['last_flush_lag_ms']
+                                    if recognition_system.attendance_writer else None)
     }), 200
 
 
-def update_camera_device_status(status: str):
+def update_camera_device_status(status: str, camera_id: Optional[str] = None):
     """Update camera device status in devices table"""
     try:
         device_id = 'facial-recognition-camera'
+        if camera_id and camera_id != recognition_system.default_camera_id:
+            device_id = f"facial-recognition-camera-{camera_id}"
         now = datetime.now()
 
         # Check if device exists
@@ -941,80 +3287,150 @@ def update_camera_device_status(status: str):
             db_utils.execute_update(
                 """INSERT INTO devices (id, name, type, status, last_seen, created_at)
                    VALUES (%s, %s, %s, %s, %s, %s)""",
-                (device_id, 'Facial Recognition Camera', 'camera', status, now, now)
+                (device_id, f"Facial Recognition Camera {camera_id or ''}".strip(), 'camera', status, now, now)
             )
     except Exception as e:
         print(f"Error updating camera device status: {e}")
 
 
+def get_request_camera() -> Optional[CameraPipeline]:
+    """Camera addressed by ?camera_id= or a JSON camera_id (the default camera otherwise)"""
+    payload = request.get_json(silent=True) or {}
+    return recognition_system.camera(request.args.get('camera_id') or payload.get('camera_id'))
+
+
+def camera_not_found():
+    return jsonify({'ok': False, 'error': 'Unknown camera_id'}), 404
+
+
+def request_id(payload: Dict, *keys: str) -> Optional[int]:
+    """
+    First of the given id fields (e.g. 'module_id', 'class_id') as an int, None when absent.
+
+    Raises ValueError for a non-numeric value so the route can answer 400.
+    """
+    value = next((payload.get(key) for key in keys if payload.get(key)), None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {keys[0]}: {value}')
+
+
+@app.route('/api/facial-recognition/cameras', methods=['GET'])
+def list_cameras():
+    """State, frame rates and recognition backlog of every camera"""
+    return jsonify({
+        'ok': True,
+        'default_camera_id': recognition_system.default_camera_id,
+        'inference_workers': recognition_system.scheduler.workers,
+        'cameras': [camera.stats() for camera in recognition_system.cameras.values()]
+    })
+
+
 @app.route('/api/facial-recognition/camera/start', methods=['POST'])
 def start_camera():
     """Start the camera feed"""
-    if recognition_system.camera_manager.start():
-        update_camera_device_status('online')
-        return jsonify({'ok': True, 'message': 'Camera started successfully'})
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    if camera.camera_manager.start():
+        update_camera_device_status('online', camera.camera_id)
+        return jsonify({'ok': True, 'message': 'Camera started successfully', 'camera_id': camera.camera_id})
     return jsonify({'ok': False, 'error': 'Failed to open camera'}), 500
 
 
 @app.route('/api/facial-recognition/camera/stop', methods=['POST'])
 def stop_camera():
     """Stop the camera feed"""
-    recognition_system.scanning_active = False
-    recognition_system.camera_manager.stop()
-    update_camera_device_status('offline')
-    return jsonify({'ok': True, 'message': 'Camera stopped successfully'})
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    camera.stop_scanning()
+    camera.camera_manager.stop()
+    update_camera_device_status('offline', camera.camera_id)
+    return jsonify({'ok': True, 'message': 'Camera stopped successfully', 'camera_id': camera.camera_id})
 
 
 @app.route('/api/facial-recognition/camera/status', methods=['GET'])
 def camera_status():
     """Get current camera status"""
-    is_active = recognition_system.camera_manager.is_active()
-    return jsonify({
-        'ok': True,
-        'active': is_active,
-        'scanning': recognition_system.scanning_active
-    })
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    return jsonify(dict(camera.stats(), ok=True))
 
 
 @app.route('/api/facial-recognition/camera/feed')
 def camera_feed():
-    """Video streaming route"""
-    if not recognition_system.camera_manager.is_active():
+    """Video streaming route (?camera_id=&quality=30-100&scale=0.1-1.0&adaptive=0|1)"""
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    if not camera.camera_manager.is_active():
         return jsonify({'ok': False, 'error': 'Camera not active'}), 400
 
-    return Response(recognition_system.generate_video_stream(),
+    try:
+        quality = int(request.args.get('quality', 80))
+        scale = float(request.args.get('scale', 1.0))
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'quality and scale must be numbers'}), 400
+    adaptive = request.args.get('adaptive', '1') not in ('0', 'false')
+
+    return Response(camera.generate_video_stream(quality, scale, adaptive),
                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
 @app.route('/api/facial-recognition/scanning/start', methods=['POST'])
 def start_scanning():
     """Start facial recognition scanning"""
-    if not recognition_system.camera_manager.is_active():
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    if not camera.camera_manager.is_active():
         return jsonify({'ok': False, 'error': 'Camera not active'}), 400
 
     payload = request.get_json() or {}
-    recognition_system.session.start(**payload)
-    recognition_system.scanning_active = True
+    payload.pop('camera_id', None)
+    camera.start_scanning(**payload)
 
     return jsonify({
         'ok': True,
         'message': 'Scanning started',
-        'session': recognition_system.session.get_data()
+        'camera_id': camera.camera_id,
+        'session': camera.session.get_data()
     })
 
 
 @app.route('/api/facial-recognition/scanning/stop', methods=['POST'])
 def stop_scanning():
     """Stop facial recognition scanning"""
-    recognition_system.scanning_active = False
-    return jsonify({'ok': True, 'message': 'Scanning stopped'})
+    camera = get_request_camera()
+    if camera is None:
+        return camera_not_found()
+
+    camera.stop_scanning()
+    return jsonify({'ok': True, 'message': 'Scanning stopped', 'camera_id': camera.camera_id})
 
 
 @app.route('/api/facial-recognition/faces/refresh', methods=['POST'])
 def refresh_faces():
     """Reload face encodings from database"""
+    payload = request.get_json(silent=True) or {}
+    full_reload = bool(payload.get('full', False))
+
     def background_load():
-        recognition_system.face_database.load_from_database()
+        recognition_system.face_database.load_from_database(
+            bulk=CONFIG.get('face_loader_bulk', True),
+            workers=CONFIG.get('face_loader_workers'),
+            incremental=not full_reload
+        )
 
     thread = threading.Thread(target=background_load, daemon=True)
     thread.start()
@@ -1022,10 +3438,48 @@ def refresh_faces():
     return jsonify({
         'ok': True,
         'message': 'Face refresh started in background',
-        'count': recognition_system.face_database.get_count()
+        'count': recognition_system.face_database.get_count(),
+        'version': recognition_system.face_database.version
     })
 
 
+@app.route('/api/facial-recognition/faces/upload', methods=['POST'])
+def upload_faces():
+    """Store face photos for a student and compute their embeddings"""
+    student_code = request.form.get('student_id')
+    files = request.files.getlist('photos')
+
+    if not student_code or not files:
+        return jsonify({'ok': False, 'error': 'student_id and photos required'}), 400
+
+    try:
+        student = db_utils.query_one(
+            "SELECT id FROM students WHERE student_id = %s",
+            (student_code,)
+        )
+        if not student:
+            return jsonify({'ok': False, 'error': 'Student not found'}), 404
+
+        stored = []
+        failed = []
+        for file in files:
+            face_image_id = recognition_system.face_database.add_face_image(student['id'], file.read())
+            if face_image_id is None:
+                failed.append(file.filename)
+            else:
+                stored.append(face_image_id)
+
+        return jsonify({
+            'ok': bool(stored),
+            'stored': len(stored),
+            'face_image_ids': stored,
+            'failed': failed
+        }), 200 if stored else 400
+
+    except Exception as e:
+        return jsonify({'ok': False, 'error': str(e)}), 500
+
+
 @app.route('/api/facial-recognition/faces/list', methods=['GET'])
 def list_loaded_faces():
     """Get list of currently loaded face encodings"""
@@ -1033,23 +3487,49 @@ def list_loaded_faces():
     return jsonify({
         'ok': True,
         'count': len(faces),
-        'faces': faces
+        'faces': faces,
+        'version': recognition_system.face_database.version,
+        'watermark': recognition_system.face_database.watermark,
+        'load_stats': recognition_system.face_database.last_load_stats,
+        'storage': recognition_system.face_database.storage,
+        'memory_bytes': recognition_system.face_database.gallery.memory_bytes()
     })
 
 
 @app.route('/api/facial-recognition/session', methods=['GET'])
 def get_session():
-    """Get current session data with database-synced attendance status"""
-    session_data = recognition_system.session.get_data()
+    """
+    Get current session data with database-synced attendance status.
 
-    # Sync attendance status from database for all recognized students today
+    The session is chosen by ?timetable_id=&date= or, by default, the camera's
+    current one. With ?since=<version> only students recognized after that
+    version are returned (merge them unless the response has 'full': true).
+    """
+    timetable_id = request.args.get('timetable_id')
+    if timetable_id:
+        session = recognition_system.sessions.get(timetable_id, request.args.get('date'))
+        if session is None:
+            return jsonify({'ok': False, 'error': 'No live session for this timetable'}), 404
+    else:
+        camera = get_request_camera()
+        if camera is None:
+            return camera_not_found()
+        session = camera.session
+
+    since = request.args.get('since', type=int)
+    session_data = session.get_data(since)
+
+    # Sync attendance status from database for the recognized students in this response
     if session_data.get('recognized_students'):
-        # Get all attendance records from today
+        student_ids = [student['student_id'] for student in session_data['recognized_students']]
+        placeholders = ', '.join(['%s'] * len(student_ids))
         db_records = db_utils.query_all(
-            """SELECT s.student_id, a.status
+            f"""SELECT s.student_id, a.status
                FROM attendance a
                JOIN students s ON a.student_id = s.id
-               WHERE DATE(a.check_in_time) = CURDATE()"""
+               WHERE DATE(a.check_in_time) = CURDATE()
+               AND s.student_id IN ({placeholders})""",
+            tuple(student_ids)
         )
 
         # Create a map of student_id -> status from database
@@ -1068,20 +3548,52 @@ def get_session():
     })
 
 
+@app.route('/api/facial-recognition/sessions/live', methods=['GET'])
+def list_live_sessions():
+    """Attendance sessions currently held in memory, one per (timetable, date)"""
+    evicted = recognition_system.sessions.evict(recognition_system.sessions_in_use(), force=True)
+    return jsonify({
+        'ok': True,
+        'evicted': evicted,
+        'sessions': recognition_system.sessions.summary()
+    })
+
+
 @app.route('/api/facial-recognition/attendance/save-one', methods=['POST'])
 def save_single_attendance():
-    """Save a single attendance record"""
+    """
+    Save a single attendance record.
+
+    With the write-behind writer enabled the record is queued and written within
+    attendance_flush_interval (the response cannot report the final status).
+    """
     payload = request.get_json() or {}
 
     student_id = payload.get('student_id')
-    timetable_id = payload.get('timetable_id')  # Get timetable_id directly from request
-    module_id = payload.get('module_id')
     confidence = payload.get('confidence', 0)
+    try:
+        timetable_id = request_id(payload, 'timetable_id')  # Get timetable_id directly from request
+        module_id = request_id(payload, 'module_id', 'class_id')
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
 
     if not student_id or not module_id:
         return jsonify({'ok': False, 'error': 'student_id and module_id required'}), 400
 
     try:
+        writer = recognition_system.attendance_writer
+        if writer is not None:
+            if not writer.known_student(student_id):
+                return jsonify({'ok': False, 'error': 'Student not found'}), 404
+            if not writer.enqueue(student_id, module_id, timetable_id, confidence):
+                return jsonify({'ok': True, 'message': 'Attendance already marked', 'already_marked': True})
+            return jsonify({
+                'ok': True,
+                'message': 'Attendance queued',
+                'student_id': student_id,
+                'queued': True
+            })
+
         # Get student internal ID
         student_data = db_utils.query_one(
             "SELECT id FROM students WHERE student_id = %s",
@@ -1122,45 +3634,19 @@ def save_single_attendance():
         )
 
         # Calculate attendance status based on arrival time
-        from datetime import datetime, timedelta
-        status = 'present'  # Default to present
-
-        if timetable_data and policy:
-            # Get class start time
-            class_start = timetable_data['start_time']
-
-            # Convert timedelta to seconds if needed
-            if isinstance(class_start, timedelta):
-                class_start_seconds = int(class_start.total_seconds())
-            else:
-                class_start_seconds = class_start.hour * 3600 + class_start.minute * 60 + class_start.second
-
-            # Get current time in seconds
-            now = datetime.now().time()
-            current_seconds = now.hour * 3600 + now.minute * 60 + now.second
-
-            # Calculate minutes late
-            seconds_late = current_seconds - class_start_seconds
-            minutes_late = seconds_late / 60
-
-            grace_period = policy['grace_period_minutes']
-            late_threshold = policy['late_threshold_minutes']
-
-            # Determine status
-            if minutes_late <= grace_period:
-                status = 'present'
-            elif minutes_late <= late_threshold:
-                status = 'late'
-            else:
-                status = 'late'  # Still mark as late (could be 'absent' if policy requires)
+        status = attendance_status(timetable_data['start_time'] if timetable_data else None, policy)
 
         # Insert attendance record with calculated status
-        db_utils.execute(
-            """INSERT INTO attendance
-               (student_id, module_id, timetable_id, status, face_confidence, is_manual)
-               VALUES (%s, %s, %s, %s, %s, FALSE)""",
-            (student_data['id'], module_id, timetable_id, status, confidence)
-        )
+        try:
+            db_utils.execute(
+                """INSERT INTO attendance
+                   (student_id, module_id, timetable_id, status, face_confidence, is_manual)
+                   VALUES (%s, %s, %s, %s, %s, FALSE)""",
+                (student_data['id'], module_id, timetable_id, status, confidence)
+            )
+        except mysql_errors.IntegrityError:
+            # Saved by another request since the check above (unique student/module/date key)
+            return jsonify({'ok': True, 'message': 'Attendance already marked', 'already_marked': True})
 
         return jsonify({
             'ok': True,
@@ -1173,6 +3659,49 @@ def save_single_attendance():
         return jsonify({'ok': False, 'error': str(e)}), 500
 
 
+@app.route('/api/facial-recognition/attendance/save-many', methods=['POST'])
+def save_many_attendance():
+    """
+    Save attendance for a batch of recognitions in one timetable slot.
+
+    Body: {timetable_id, module_id, records: [{student_id, confidence}, ...]}
+    Returns a result per student: 'present' / 'late', 'already_marked' or 'not_found'
+    (see save_attendance_batch).
+    """
+    payload = request.get_json() or {}
+
+    try:
+        timetable_id = request_id(payload, 'timetable_id', 'session_id')
+        module_id = request_id(payload, 'module_id', 'class_id')
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    records = payload.get('records') or payload.get('students') or []
+
+    if not isinstance(records, list) or not all(isinstance(r, dict) and r.get('student_id') for r in records):
+        return jsonify({'ok': False, 'error': 'records must be a list of {student_id, confidence}'}), 400
+    if not records:
+        return jsonify({'ok': True, 'results': [], 'saved': 0})
+
+    try:
+        results, saved = save_attendance_batch(timetable_id, module_id, records,
+                                               recognition_system.attendance_rules,
+                                               recognition_system.attendance_writer)
+        return jsonify({'ok': True, 'results': results, 'saved': saved})
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'ok': False, 'error': str(e)}), 500
+
+
+@app.route('/api/facial-recognition/attendance/writer', methods=['GET'])
+def attendance_writer_status():
+    """Write-behind queue metrics (queue depth, flush lag, batches)"""
+    writer = recognition_system.attendance_writer
+    if writer is None:
+        return jsonify({'ok': True, 'enabled': False})
+    return jsonify({'ok': True, 'enabled': True, **writer.metrics()})
+
+
 @app.route('/api/facial-recognition/attendance/today', methods=['GET'])
 def get_today_attendance():
     """Get today's attendance for a specific class"""
@@ -1233,6 +3762,9 @@ def reset_attendance():
     try:
         today = date.today()
 
+        if recognition_system.attendance_writer is not None:
+            recognition_system.attendance_writer.discard_module(module_id)
+
         # Delete all attendance records for today
         db_utils.execute(
             """DELETE FROM attendance
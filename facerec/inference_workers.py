@@ -0,0 +1,502 @@
+"""
+Out-of-process inference workers for /identify
+Image decoding, face detection and SFace embedding run in dedicated worker processes
+fed through per-worker request queues; the web tier only enqueues, waits and matches
+the returned embedding against the in-memory gallery
+"""
+
+import atexit
+import base64
+import itertools
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class InferenceQueueFull(Exception):
+    """More requests are pending than the pool accepts (HTTP 429)"""
+
+
+class InferenceUnavailable(Exception):
+    """No worker can take the request, or its worker died while handling it (HTTP 503)"""
+
+
+def decode_image(image_data) -> Optional[np.ndarray]:
+    """Decode a base64 image (optionally a data URL) or raw bytes into a BGR frame"""
+    if isinstance(image_data, str):
+        # Remove data URL prefix if present
+        if ',' in image_data:
+            image_data = image_data.split(',')[1]
+        image_data = base64.b64decode(image_data)
+    nparr = np.frombuffer(image_data, np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+
+# Smallest side, in pixels, of a client-supplied face crop worth embedding
+MIN_CROP_SIZE = 32
+# Largest side of a client-supplied crop with landmarks; anything bigger is a frame, not a face
+MAX_CROP_SIZE = 1024
+# Eye distance of a landmarked crop as a fraction of its width; outside it the face does not fill the crop
+CROP_EYE_DISTANCE_RANGE = (0.15, 0.8)
+
+
+def parse_landmarks(value) -> np.ndarray:
+    """
+    Five (x, y) face landmarks as a 5 x 2 array, in YuNet order: right eye, left eye,
+    nose tip, right and left mouth corners.
+
+    Accepts [[x, y], ...], a flat list of 10 numbers, or the same as a JSON or
+    comma-separated string. Raises ValueError for anything else.
+    """
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip().startswith('[') else value.split(',')
+    try:
+        points = np.asarray(value, dtype=np.float32).reshape(-1)
+    except (TypeError, ValueError):
+        raise ValueError('landmarks must be five (x, y) points')
+    if points.size != 10 or not np.all(np.isfinite(points)):
+        raise ValueError('landmarks must be five (x, y) points')
+    return points.reshape(5, 2)
+
+
+def check_landmarked_crop(width: int, height: int, landmarks: np.ndarray) -> Optional[str]:
+    """Why a client face crop and its landmarks are implausible, or None if they can be aligned"""
+    if min(width, height) < MIN_CROP_SIZE:
+        return 'Face crop too small'
+    if max(width, height) > MAX_CROP_SIZE:
+        return 'Face crop too large'
+    if not 0.5 <= height / width <= 2.0:
+        return 'Face crop aspect ratio is not plausible for a face'
+
+    xs, ys = landmarks[:, 0], landmarks[:, 1]
+    if xs.min() < 0 or ys.min() < 0 or xs.max() >= width or ys.max() >= height:
+        return 'Landmarks lie outside the crop'
+
+    right_eye, left_eye, nose, right_mouth, left_mouth = landmarks
+    low, high = CROP_EYE_DISTANCE_RANGE
+    if not low * width <= float(np.linalg.norm(left_eye - right_eye)) <= high * width:
+        return 'Eye distance does not fit a face filling the crop'
+    # Eyes above the nose above the mouth (upright or moderately tilted heads)
+    if not (right_eye[1] + left_eye[1]) / 2 < nose[1] < (right_mouth[1] + left_mouth[1]) / 2:
+        return 'Landmarks are not in face order'
+    return None
+
+
+def embed_landmarked_crop(recognizer, crop: np.ndarray, landmarks) -> Dict:
+    """
+    Embed a face the client already found: align the crop by its landmarks and run SFace,
+    with no detection pass. Returns a detect_and_embed-style result.
+    """
+    try:
+        points = parse_landmarks(landmarks)
+    except ValueError as e:
+        return {'ok': False, 'status': 400, 'error': str(e), 'faces_found': 0}
+    height, width = crop.shape[:2]
+    error = check_landmarked_crop(width, height, points)
+    if error:
+        return {'ok': False, 'status': 400, 'error': error, 'faces_found': 0}
+
+    # A YuNet-style face row for alignCrop: box, landmarks, score
+    face = np.concatenate([[0, 0, width, height], points.reshape(-1), [1.0]]).astype(np.float32)
+    feature = recognizer.extract_features(crop, face)
+    if feature is None:
+        return {'ok': False, 'status': 400, 'error': 'Could not extract face features', 'faces_found': 1}
+    return {'ok': True, 'faces_found': 1, 'bbox': [0, 0, width, height], 'feature': feature}
+
+
+def _largest_face(detector, frame: np.ndarray):
+    """(result, face_roi): the largest detected face, or an error result and None"""
+    faces = detector.detect(frame)
+    if faces is None or len(faces) == 0:
+        return {'ok': False, 'status': 400, 'error': 'No face detected in image', 'faces_found': 0}, None
+
+    # Get the largest/clearest face
+    largest_face = max(faces, key=lambda f: f[2] * f[3])  # By area (width * height)
+    x, y, w, h = map(int, largest_face[:4])
+
+    # Extract face region
+    face_roi = frame[max(0, y):y + h, max(0, x):x + w]
+    if face_roi.size == 0:
+        return {'ok': False, 'status': 400, 'error': 'Could not extract face region', 'faces_found': len(faces)}, None
+    return {'ok': True, 'faces_found': len(faces), 'bbox': [x, y, w, h]}, face_roi
+
+
+def detect_and_embed(detector, recognizer, frame: np.ndarray) -> Dict:
+    """
+    Detect faces, crop the largest one and embed it.
+
+    Returns {'ok': True, 'faces_found', 'bbox', 'feature'} or
+    {'ok': False, 'status', 'error', 'faces_found'} with the HTTP status /identify answers.
+    """
+    result, face_roi = _largest_face(detector, frame)
+    if face_roi is None:
+        return result
+
+    # Get face feature/encoding using pre-cropped face image (works without landmarks)
+    feature = recognizer.extract_features_from_image(face_roi)
+    if feature is None:
+        return {'ok': False, 'status': 400, 'error': 'Could not extract face features',
+                'faces_found': result['faces_found']}
+
+    result['feature'] = feature
+    return result
+
+
+def detect_and_embed_all(detector, recognizer, frame: np.ndarray) -> Dict:
+    """
+    Detect every plausible face of a frame and embed them aligned, in one SFace batch.
+
+    Returns {'ok': True, 'faces_found', 'faces': [{'bbox', 'feature'}, ...]}; faces
+    that could not be embedded are left out.
+    """
+    detected = detector.detect(frame)
+    if detected is None or len(detected) == 0:
+        return {'ok': True, 'faces_found': 0, 'faces': []}
+
+    height, width = frame.shape[:2]
+    valid = [face for face in detected if detector.is_valid_face(face, width, height)]
+    features = recognizer.extract_features_batch(frame, valid)
+    return {
+        'ok': True,
+        'faces_found': len(valid),
+        'faces': [
+            {'bbox': [int(v) for v in face[:4]], 'feature': feature}
+            for face, feature in zip(valid, features) if feature is not None
+        ]
+    }
+
+
+def embed_items(detector, recognizer, items: List[Tuple[str, object]]) -> List[Dict]:
+    """
+    detect_and_embed for a batch of ('frame' | 'crop' | 'faces' | 'aligned', image) items.
+
+    Frames go through detection and give their largest face; crops are used as
+    they are. All those faces are then embedded in one SFace batch. 'faces' items
+    give every face of the frame (detect_and_embed_all); 'aligned' items are
+    (crop, landmarks) pairs for embed_landmarked_crop. Returns one result per item.
+    """
+    results: List[Dict] = []
+    faces = []  # (result index, face image)
+    for kind, image_data in items:
+        landmarks = None
+        if kind == 'aligned':
+            image_data, landmarks = image_data
+        try:
+            image = decode_image(image_data)
+        except Exception:
+            image = None
+        if image is None:
+            results.append({'ok': False, 'status': 400, 'error': 'Invalid image data'})
+            continue
+
+        if kind == 'faces':
+            results.append(detect_and_embed_all(detector, recognizer, image))
+            continue
+        if kind == 'aligned':
+            results.append(embed_landmarked_crop(recognizer, image, landmarks))
+            continue
+        if kind == 'crop':
+            height, width = image.shape[:2]
+            if min(height, width) < MIN_CROP_SIZE:
+                results.append({'ok': False, 'status': 400, 'error': 'Face crop too small'})
+                continue
+            result, face_roi = {'ok': True, 'faces_found': 1, 'bbox': [0, 0, width, height]}, image
+        else:
+            result, face_roi = _largest_face(detector, image)
+
+        results.append(result)
+        if face_roi is not None:
+            faces.append((len(results) - 1, face_roi))
+
+    features = recognizer.extract_features_from_images([face for _, face in faces])
+    for (index, _), feature in zip(faces, features):
+        if feature is None:
+            results[index] = {'ok': False, 'status': 400, 'error': 'Could not extract face features',
+                              'faces_found': results[index]['faces_found']}
+        else:
+            results[index]['feature'] = feature
+    return results
+
+
+def _load_models(detector_path: str, recognizer_path: str, score_threshold: float,
+                 detection_policy: Optional[Dict] = None):
+    """
+    Detector/recognizer for a worker, built from the model files alone.
+
+    Only facerec.face_models is imported: importing the controller would build a
+    whole FacialRecognitionSystem (gallery, model pool, process-wide thread count)
+    in every worker.
+    """
+    from facerec.face_models import FaceDetector, FaceRecognizer
+
+    return FaceDetector(detector_path, score_threshold, detection_policy), FaceRecognizer(recognizer_path)
+
+
+def _worker_main(worker_id: int, detector_path: str, recognizer_path: str, score_threshold: float,
+                 detection_policy: Optional[Dict], opencv_threads: int,
+                 requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    """Worker process: load the models once, then serve requests until told to stop (None)"""
+    try:
+        detector, recognizer = _load_models(detector_path, recognizer_path, score_threshold, detection_policy)
+        if detector.detector is None or recognizer.recognizer is None:
+            raise RuntimeError('face models did not load')
+    except Exception as e:
+        results.put(('failed', worker_id, str(e)))
+        return
+    # After loading, so nothing imported or created above can change it again
+    cv2.setNumThreads(opencv_threads)
+    results.put(('ready', worker_id, None))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, deadline, image_data = message
+
+        # The caller has already given up on this one; do not spend inference on it
+        if time.time() > deadline:
+            results.put(('done', worker_id, (request_id, {'ok': False, 'status': 504, 'error': 'expired'})))
+            continue
+
+        if isinstance(image_data, list):
+            # Batch of ('frame' | 'crop' | 'faces' | 'aligned', image) items
+            try:
+                result = {'ok': True, 'items': embed_items(detector, recognizer, image_data)}
+            except Exception as e:
+                result = {'ok': False, 'status': 500, 'error': str(e)}
+            results.put(('done', worker_id, (request_id, result)))
+            continue
+
+        try:
+            frame = decode_image(image_data)
+        except Exception:
+            frame = None
+        try:
+            if frame is None:
+                result = {'ok': False, 'status': 400, 'error': 'Invalid image data'}
+            else:
+                result = detect_and_embed(detector, recognizer, frame)
+        except Exception as e:
+            result = {'ok': False, 'status': 500, 'error': str(e)}
+        results.put(('done', worker_id, (request_id, result)))
+
+
+class InferenceWorkerPool:
+    """
+    Pool of inference processes with bounded admission and health restarts.
+
+    Each worker has its own request queue, so the pool always knows which requests
+    a worker holds: a request goes to the ready worker with the fewest in flight,
+    and is refused with InferenceQueueFull once max_pending requests are waiting.
+    A monitor thread restarts workers that exit, and terminates and restarts any
+    worker stuck on one request for longer than hang_timeout; their requests fail
+    with InferenceUnavailable. Workers are spawned, not forked, so they start
+    without the web process's threads and OpenCV state.
+    """
+
+    def __init__(self, detector_path: str, recognizer_path: str, score_threshold: float = 0.6,
+                 processes: int = 2, max_pending: int = 16, opencv_threads: int = 1,
+                 hang_timeout: float = 30.0, detection_policy: Optional[Dict] = None):
+        self.detector_path = detector_path
+        self.recognizer_path = recognizer_path
+        self.score_threshold = score_threshold
+        self.detection_policy = detection_policy
+        self.processes = max(1, int(processes))
+        self.max_pending = max(1, int(max_pending))
+        self.opencv_threads = max(1, int(opencv_threads))
+        self.hang_timeout = hang_timeout
+
+        self.context = multiprocessing.get_context('spawn')
+        self.results = None
+        self.workers: List[Dict] = []
+        self._request_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.running = False
+
+        self.stats_data = {
+            'completed': 0, 'rejected': 0, 'unavailable': 0, 'timeouts': 0,
+            'restarts': 0, 'crashes': 0, 'hangs': 0, 'latency_ms_total': 0.0
+        }
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.results = self.context.Queue()
+            self.workers = [
+                {'id': i, 'process': None, 'queue': None, 'in_flight': {}, 'ready': False,
+                 'restart_delay': 1.0, 'restart_at': 0.0}
+                for i in range(self.processes)
+            ]
+            for worker in self.workers:
+                self._spawn(worker)
+
+        threading.Thread(target=self._collect, name='inference-results', daemon=True).start()
+        threading.Thread(target=self._monitor, name='inference-monitor', daemon=True).start()
+        atexit.register(self.close)
+
+    def _spawn(self, worker: Dict):
+        """Start (or restart) a worker process; caller holds the lock"""
+        worker['queue'] = self.context.Queue()
+        worker['ready'] = False
+        worker['process'] = self.context.Process(
+            target=_worker_main,
+            args=(worker['id'], self.detector_path, self.recognizer_path, self.score_threshold,
+                  self.detection_policy, self.opencv_threads, worker['queue'], self.results),
+            name=f"inference-worker-{worker['id']}",
+            daemon=True
+        )
+        worker['process'].start()
+
+    def _fail_in_flight(self, worker: Dict, reason: str):
+        """Fail every request a worker held; caller holds the lock"""
+        for future, _ in worker['in_flight'].values():
+            if not future.done():
+                future.set_exception(InferenceUnavailable(reason))
+        worker['in_flight'] = {}
+
+    def submit(self, image_data, timeout: float) -> Future:
+        """
+        Queue an image for a worker; the Future resolves to a detect_and_embed() result.
+        A list of ('frame' | 'crop' | 'faces' | 'aligned', image) items resolves to {'ok': True, 'items': embed_items()}.
+        """
+        future: Future = Future()
+        with self.lock:
+            if not self.running:
+                raise InferenceUnavailable('Inference workers are not running')
+            pending = sum(len(worker['in_flight']) for worker in self.workers)
+            if pending >= self.max_pending:
+                self.stats_data['rejected'] += 1
+                raise InferenceQueueFull(f"{pending} recognition requests already pending")
+
+            ready = [worker for worker in self.workers if worker['ready'] and worker['process'].is_alive()]
+            if not ready:
+                self.stats_data['unavailable'] += 1
+                raise InferenceUnavailable('No inference worker is ready')
+            worker = min(ready, key=lambda w: len(w['in_flight']))
+
+            request_id = next(self._request_ids)
+            worker['in_flight'][request_id] = (future, time.time())
+            worker['queue'].put((request_id, time.time() + timeout, image_data))
+        return future
+
+    def run(self, image_data, timeout: float = 5.0) -> Dict:
+        """
+        Submit an image and wait for its result.
+
+        Raises InferenceQueueFull, InferenceUnavailable, or TimeoutError when no
+        result arrives within timeout seconds.
+        """
+        start = time.perf_counter()
+        future = self.submit(image_data, timeout)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.stats_data['timeouts'] += 1
+            raise TimeoutError(f"Recognition did not finish within {timeout}s")
+
+        with self.lock:
+            self.stats_data['completed'] += 1
+            self.stats_data['latency_ms_total'] += (time.perf_counter() - start) * 1000
+        return result
+
+    def _collect(self):
+        """Route worker messages: readiness, load failures and request results"""
+        while self.running:
+            try:
+                kind, worker_id, payload = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            with self.lock:
+                worker = self.workers[worker_id]
+                if kind == 'ready':
+                    worker['ready'] = True
+                    worker['restart_delay'] = 1.0
+                elif kind == 'failed':
+                    print(f"✗ Inference worker {worker_id} could not start: {payload}")
+                elif kind == 'done':
+                    request_id, result = payload
+                    entry = worker['in_flight'].pop(request_id, None)
+                    if entry is not None and not entry[0].done():
+                        entry[0].set_result(result)
+
+    def _monitor(self):
+        """Restart workers that died or hang on a request"""
+        while self.running:
+            time.sleep(1.0)
+            now = time.time()
+            with self.lock:
+                if not self.running:
+                    break
+                for worker in self.workers:
+                    process = worker['process']
+                    if process.is_alive():
+                        oldest = min((started for _, started in worker['in_flight'].values()), default=None)
+                        if oldest is None or now - oldest <= self.hang_timeout:
+                            continue
+                        print(f"⚠ Inference worker {worker['id']} stuck for {now - oldest:.0f}s, restarting")
+                        self.stats_data['hangs'] += 1
+                        process.terminate()
+                        process.join(timeout=2)
+                        self._fail_in_flight(worker, 'Inference worker hung and was restarted')
+                        worker['restart_at'] = now
+                    elif worker['restart_at'] == 0.0:
+                        print(f"⚠ Inference worker {worker['id']} exited (code {process.exitcode}), restarting")
+                        self.stats_data['crashes'] += 1
+                        self._fail_in_flight(worker, 'Inference worker crashed')
+                        # Back off if the worker keeps dying at startup (e.g. models missing)
+                        worker['restart_at'] = now + (0 if worker['ready'] else worker['restart_delay'])
+                        worker['restart_delay'] = min(worker['restart_delay'] * 2, 60.0)
+                        worker['ready'] = False
+
+                    if worker['restart_at'] and now >= worker['restart_at']:
+                        worker['restart_at'] = 0.0
+                        self.stats_data['restarts'] += 1
+                        self._spawn(worker)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            completed = self.stats_data['completed']
+            return {
+                'processes': self.processes,
+                'ready': sum(1 for worker in self.workers if worker['ready']),
+                'pending': sum(len(worker['in_flight']) for worker in self.workers),
+                'max_pending': self.max_pending,
+                'completed': completed,
+                'rejected': self.stats_data['rejected'],
+                'unavailable': self.stats_data['unavailable'],
+                'timeouts': self.stats_data['timeouts'],
+                'restarts': self.stats_data['restarts'],
+                'crashes': self.stats_data['crashes'],
+                'hangs': self.stats_data['hangs'],
+                'avg_latency_ms': round(self.stats_data['latency_ms_total'] / completed, 1) if completed else 0.0
+            }
+
+    def close(self):
+        """Stop the workers (pending requests fail with InferenceUnavailable)"""
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            for worker in self.workers:
+                self._fail_in_flight(worker, 'Inference workers stopped')
+                try:
+                    worker['queue'].put(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            worker['process'].join(timeout=2)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
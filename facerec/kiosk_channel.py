@@ -0,0 +1,239 @@
+"""
+Kiosk WebSocket channel
+One persistent connection per kiosk: the browser streams binary JPEG frames and the
+server pushes back per-frame recognitions, attendance results and session changes.
+Frames that arrive while the previous one is still being recognised replace it, so a
+fast client never builds a backlog, and a FaceTracker per connection confirms identities
+across that kiosk's frames
+"""
+
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from facerec.facial_recognition_controller import FaceTracker
+
+
+class KioskConnection:
+    """
+    State and worker thread for one kiosk WebSocket.
+
+    The socket handler thread only receives: binary messages are frames and go into
+    a one-frame slot, text messages are JSON commands ({"type": "hello", "module_id",
+    "fallback_to_full"} or {"type": "ping"}). A worker thread recognises whatever frame
+    is in the slot, confirms faces with the connection's tracker, saves newly confirmed
+    students and polls the current session. Every message the server sends is JSON:
+
+      session         the timetable session the kiosk is marking (on connect and on change)
+      frame           faces of one recognised frame, with frame ids dropped since the last one
+      recognized      a confirmed student was marked present/late
+      already_marked  a confirmed student already had attendance for this module today
+      busy            sent by the server instead of serving when all kiosk slots are taken
+      error / pong
+
+    The callables keep this class free of Flask and database code:
+      embed(frame_bytes)                          -> detect_and_embed_all() result (may raise)
+      match(features, module_id, fallback)        -> one (student_id, name, similarity) or None per feature
+      current_session()                           -> session dict (timetable_id, module_id, ...) or None
+      save(timetable_id, module_id, records)      -> [{'student_id', 'ok', 'result'}, ...]
+    """
+
+    def __init__(self, ws, embed: Callable, match: Callable, current_session: Callable, save: Callable,
+                 session_poll_interval: float = 30.0, max_frame_bytes: int = 2 * 1024 * 1024):
+        self.ws = ws
+        self.embed = embed
+        self.match = match
+        self.current_session = current_session
+        self.save = save
+        self.session_poll_interval = session_poll_interval
+        self.max_frame_bytes = max_frame_bytes
+
+        self.tracker = FaceTracker(max_age=5)
+        self.session: Optional[Dict] = None
+        self.module_override = None
+        self.fallback_to_full = False
+        self.marked = set()  # student ids with attendance in this session
+
+        # Latest-frame slot: the worker always takes the newest frame
+        self.condition = threading.Condition()
+        self.frame: Optional[bytes] = None
+        self.frame_id = 0
+        self.dropped = 0
+        self.closed = False
+        self.send_lock = threading.Lock()
+
+    def send(self, message: Dict) -> bool:
+        """Send one JSON message; False once the socket is gone"""
+        try:
+            with self.send_lock:
+                self.ws.send(json.dumps(message))
+            return True
+        except Exception:
+            self.close()
+            return False
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def serve(self):
+        """Run the connection until the client disconnects (blocks the socket handler)"""
+        worker = threading.Thread(target=self._work, name='kiosk-recognition', daemon=True)
+        worker.start()
+        try:
+            while not self.closed:
+                message = self.ws.receive()
+                if message is None:
+                    break
+                if isinstance(message, (bytes, bytearray)):
+                    self._offer_frame(bytes(message))
+                else:
+                    self._command(message)
+        except Exception:
+            pass  # connection closed by the client or the server
+        finally:
+            self.close()
+            worker.join(timeout=5)
+
+    def _offer_frame(self, frame: bytes):
+        if len(frame) > self.max_frame_bytes:
+            self.send({'type': 'error', 'error': f'Frame larger than {self.max_frame_bytes} bytes'})
+            return
+        with self.condition:
+            if self.frame is not None:
+                # The worker has not reached the previous frame yet - replace it
+                self.dropped += 1
+            self.frame = frame
+            self.frame_id += 1
+            self.condition.notify()
+
+    def _command(self, text: str):
+        try:
+            command = json.loads(text)
+        except ValueError:
+            self.send({'type': 'error', 'error': 'Text messages must be JSON'})
+            return
+        kind = command.get('type')
+        if kind == 'ping':
+            self.send({'type': 'pong', 'time': time.time()})
+        elif kind == 'hello':
+            module_id = command.get('module_id') or command.get('class_id')
+            try:
+                module_id = int(module_id) if module_id else None
+            except (TypeError, ValueError):
+                self.send({'type': 'error', 'error': f'Invalid module_id: {module_id}'})
+                return
+            with self.condition:
+                self.module_override = module_id
+                self.fallback_to_full = str(command.get('fallback_to_full', False)).lower() in ('1', 'true', 'yes')
+                self.session = None  # re-announce the session with the new scope
+                self.condition.notify()
+        else:
+            self.send({'type': 'error', 'error': f'Unknown message type: {kind}'})
+
+    def _work(self):
+        last_poll = 0.0
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closed or self.frame is not None or self.session is None,
+                    timeout=max(0.0, last_poll + self.session_poll_interval - time.monotonic())
+                )
+                if self.closed:
+                    return
+                frame, frame_id, dropped = self.frame, self.frame_id, self.dropped
+                self.frame, self.dropped = None, 0
+
+            if self.session is None or time.monotonic() - last_poll >= self.session_poll_interval:
+                last_poll = time.monotonic()
+                self._refresh_session()
+            if frame is not None:
+                try:
+                    self._recognize(frame, frame_id, dropped)
+                except Exception as e:
+                    self.send({'type': 'error', 'frame_id': frame_id, 'error': str(e)})
+
+    @staticmethod
+    def _session_key(session: Optional[Dict]):
+        session = session or {}
+        return session.get('timetable_id'), session.get('module_id'), session.get('date')
+
+    def _refresh_session(self):
+        """Push the current session when it changed; a new session starts tracking and marking over"""
+        try:
+            session = dict(self.current_session() or {})
+        except Exception:
+            session = {}
+        if self.module_override:
+            session['module_id'] = self.module_override
+
+        if self.session is not None and session == self.session:
+            return
+        if self._session_key(session) != self._session_key(self.session):
+            self.tracker.reset()
+            self.marked = set()
+        self.session = session
+        self.send({'type': 'session', 'session': session or None})
+
+    def _recognize(self, frame: bytes, frame_id: int, dropped: int):
+        start = time.perf_counter()
+        result = self.embed(frame)
+        if not result['ok']:
+            self.send({'type': 'error', 'frame_id': frame_id, 'error': result['error']})
+            return
+
+        session = self.session or {}  # a hello may clear it while this frame is in flight
+        module_id = session.get('module_id')
+        faces = result['faces']
+        matches = self.match([face['feature'] for face in faces], module_id, self.fallback_to_full) if faces else []
+
+        detections, unknown = [], []
+        for face, match in zip(faces, matches):
+            x, y, w, h = face['bbox']
+            if match:
+                student_id, name, similarity = match
+                detections.append(((x, y, w, h), student_id, name, float(similarity)))
+            else:
+                unknown.append([x, y, w, h])
+        confirmed = {student_id for student_id, _, _, _ in self.tracker.update(detections)}
+
+        self.send({
+            'type': 'frame',
+            'frame_id': frame_id,
+            'dropped': dropped,
+            'faces_found': result['faces_found'],
+            'faces': [
+                {'bbox': list(bbox), 'student': {'student_id': student_id, 'name': name},
+                 'confidence': confidence, 'confirmed': student_id in confirmed}
+                for bbox, student_id, name, confidence in detections
+            ],
+            'unknown': unknown,
+            'inference_ms': round((time.perf_counter() - start) * 1000, 1)
+        })
+
+        newly_confirmed = [d for d in detections if d[1] in confirmed and d[1] not in self.marked]
+        if newly_confirmed and module_id:
+            self._mark(session, newly_confirmed)
+
+    def _mark(self, session: Dict, detections: List):
+        """Save attendance for newly confirmed students and acknowledge each one"""
+        students = {student_id: (name, confidence) for _, student_id, name, confidence in detections}
+        records = [{'student_id': student_id, 'confidence': confidence}
+                   for student_id, (_, confidence) in students.items()]
+        results = self.save(session.get('timetable_id'), session.get('module_id'), records)
+        for result in results:
+            student_id = result['student_id']
+            name, confidence = students.get(student_id, (None, None))
+            student = {'student_id': student_id, 'name': name}
+            if result['result'] == 'already_marked':
+                self.marked.add(student_id)
+                self.send({'type': 'already_marked', 'student': student})
+            elif result['ok']:
+                self.marked.add(student_id)
+                self.send({'type': 'recognized', 'student': student, 'status': result['result'],
+                           'confidence': confidence})
+            else:
+                # Not marked: the next frame that confirms this student saves again
+                self.send({'type': 'error', 'student': student, 'error': result['result']})
@@ -10,11 +10,14 @@ Usage:
 
 import os
 import json
-import base64
+import multiprocessing
+import threading
+import time
 from datetime import date, datetime
 from flask import Flask, jsonify, send_from_directory, request
 from flask_cors import CORS
 from common.db_utils import get_connection
+from mysql.connector import errors as mysql_errors
 import bcrypt
 
 # Lazy imports for heavy dependencies (OpenCV, NumPy)
@@ -26,9 +29,18 @@ FACIAL_RECOGNITION_AVAILABLE = False
 FaceDetector = None
 FaceRecognizer = None
 FaceDatabase = None
+ModelPool = None
+recognition_system = None
+save_attendance_batch = None
 
 try:
-    from facerec.facial_recognition_controller import FaceDetector, FaceRecognizer, FaceDatabase
+    from facerec.facial_recognition_controller import FaceDetector, FaceRecognizer, FaceDatabase, ModelPool
+    # Same present/late rules (and their cache) as the controller's attendance endpoints
+    from facerec.facial_recognition_controller import recognition_system, save_attendance_batch
+    from facerec.inference_workers import (InferenceWorkerPool, InferenceQueueFull, InferenceUnavailable,
+                                           decode_image, detect_and_embed, embed_items,
+                                           embed_landmarked_crop, parse_landmarks)
+    from facerec.kiosk_channel import KioskConnection
     FACIAL_RECOGNITION_AVAILABLE = True
     print("✓ Facial recognition modules imported from package 'facerec'")
 except Exception as e:
@@ -39,6 +51,16 @@ except Exception as e:
     class FaceDetector: pass
     class FaceRecognizer: pass
     class FaceDatabase: pass
+    class ModelPool: pass
+    class InferenceQueueFull(Exception): pass
+    class InferenceUnavailable(Exception): pass
+
+# Optional WebSocket support for the kiosk channel
+try:
+    from flask_sock import Sock
+    WEBSOCKET_SUPPORT = True
+except ImportError:
+    WEBSOCKET_SUPPORT = False
 
 # Create Flask app with static and template folders
 app = Flask(__name__, 
@@ -47,6 +69,7 @@ app = Flask(__name__,
             template_folder='common')
 CORS(app, origins="*", supports_credentials=True, allow_headers="*", 
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"])
+sock = Sock(app) if WEBSOCKET_SUPPORT else None
 
 # ============================================================================
 # FACIAL RECOGNITION INITIALIZATION
@@ -56,10 +79,54 @@ CORS(app, origins="*", supports_credentials=True, allow_headers="*",
 face_detector = None
 face_recognizer = None
 student_faces = None
+model_pool = None
+inference_pool = None
+
+# Detector/recognizer pairs shared by concurrent /identify requests (one request per pair at a time)
+FR_MODEL_POOL_SIZE = int(os.getenv('FR_MODEL_POOL_SIZE', '2'))
+# OpenCV threads for the whole process (unset = CPU count / pool size)
+FR_OPENCV_THREADS = os.getenv('FR_OPENCV_THREADS')
+# Seconds an /identify request waits for a free model pair before giving up
+FR_MODEL_WAIT_TIMEOUT = float(os.getenv('FR_MODEL_WAIT_TIMEOUT', '10'))
+# Most frames/crops one /identify/batch request may carry
+FR_IDENTIFY_BATCH_MAX = int(os.getenv('FR_IDENTIFY_BATCH_MAX', '8'))
+# Inference processes for /identify (0 = run recognition inside the web worker)
+FR_INFERENCE_PROCESSES = int(os.getenv('FR_INFERENCE_PROCESSES', '2'))
+# Requests waiting for or inside inference processes before /identify answers 429
+FR_INFERENCE_MAX_PENDING = int(os.getenv('FR_INFERENCE_MAX_PENDING', '16'))
+# Seconds /identify waits for its inference result before answering 504
+FR_INFERENCE_TIMEOUT = float(os.getenv('FR_INFERENCE_TIMEOUT', '5'))
+
+
+def _detection_policy_from_env() -> dict:
+    """FR_DETECTION_POLICY as a dict; a malformed value falls back to the default policy"""
+    try:
+        policy = json.loads(os.getenv('FR_DETECTION_POLICY') or '{}')
+    except ValueError as e:
+        print(f"⚠ Ignoring FR_DETECTION_POLICY (invalid JSON: {e})")
+        return {}
+    if not isinstance(policy, dict):
+        print("⚠ Ignoring FR_DETECTION_POLICY (expected a JSON object)")
+        return {}
+    return policy
+
+
+# Overrides of the face detection policy as JSON, e.g. '{"working_width": 480, "tile_scale": 1.5}'
+# (see DEFAULT_DETECTION_POLICY in facerec/face_models.py)
+FR_DETECTION_POLICY = _detection_policy_from_env()
+
+# Seconds between current-session checks on a kiosk WebSocket
+FR_WS_SESSION_POLL = float(os.getenv('FR_WS_SESSION_POLL', '30'))
+# Largest binary frame a kiosk WebSocket accepts
+FR_WS_MAX_FRAME_BYTES = int(os.getenv('FR_WS_MAX_FRAME_BYTES', str(2 * 1024 * 1024)))
+# Kiosk WebSockets served at once; each holds a server thread for its lifetime, so keep this
+# well below gunicorn's --threads (further kiosks are told to poll /identify instead)
+FR_WS_MAX_CONNECTIONS = int(os.getenv('FR_WS_MAX_CONNECTIONS', '4'))
+kiosk_slots = threading.BoundedSemaphore(max(1, FR_WS_MAX_CONNECTIONS))
 
 def init_facial_recognition():
     """Initialize facial recognition system"""
-    global face_detector, face_recognizer, student_faces
+    global face_detector, face_recognizer, student_faces, model_pool, inference_pool
     
     if not FACIAL_RECOGNITION_AVAILABLE:
         print("⚠ Facial recognition module not available - will use demo mode")
@@ -79,7 +146,7 @@ def init_facial_recognition():
         print(f"[FR-INIT] Face detector model exists: {os.path.exists(face_detection_model)}")
         try:
             if os.path.exists(face_detection_model):
-                face_detector = FaceDetector(face_detection_model)
+                face_detector = FaceDetector(face_detection_model, policy=FR_DETECTION_POLICY)
                 print("✓ Face detector initialized")
             else:
                 print(f"⚠ Face detection model not found: {face_detection_model}")
@@ -102,11 +169,26 @@ def init_facial_recognition():
             import traceback
             traceback.print_exc()
         
+        if face_detector and face_recognizer:
+            model_pool = ModelPool(face_detector, face_recognizer, size=FR_MODEL_POOL_SIZE,
+                                   opencv_threads=FR_OPENCV_THREADS)
+            print(f"✓ Model pool: up to {model_pool.size} instance(s), {model_pool.opencv_threads} OpenCV thread(s)")
+
+        if face_detector and face_recognizer and FR_INFERENCE_PROCESSES > 0 and inference_pool is None:
+            inference_pool = InferenceWorkerPool(
+                face_detector.model_path, face_recognizer.model_path, face_detector.score_threshold,
+                processes=FR_INFERENCE_PROCESSES, max_pending=FR_INFERENCE_MAX_PENDING,
+                hang_timeout=max(30.0, FR_INFERENCE_TIMEOUT * 3), detection_policy=face_detector.policy
+            )
+            inference_pool.start()
+            print(f"✓ Inference workers: {FR_INFERENCE_PROCESSES} process(es), up to {FR_INFERENCE_MAX_PENDING} pending")
+
         # Initialize student face database
         try:
             if face_recognizer:
                 print("[FR-INIT] Loading student faces from database...")
                 student_faces = FaceDatabase(face_recognizer)
+                student_faces.model_pool = model_pool
                 loaded_count = student_faces.load_from_database()
                 if loaded_count:
                     print(f"✓ Loaded {student_faces.get_count()} student faces from database")
@@ -133,12 +215,15 @@ def health():
     """Health endpoint for load balancer"""
     return jsonify({'status': 'ok', 'service': 'attendance-system'}), 200
 
-# Ensure facial recognition initializes under WSGI (e.g., gunicorn/EB)
-try:
-    print("[Startup] Initializing facial recognition (import time)...")
-    init_facial_recognition()
-except Exception as e:
-    print(f"⚠ Facial recognition init error: {e}")
+# Ensure facial recognition initializes under WSGI (e.g., gunicorn/EB).
+# Inference worker processes re-import this module when started with `python main.py`;
+# they load their own models and must not start the app's.
+if multiprocessing.parent_process() is None:
+    try:
+        print("[Startup] Initializing facial recognition (import time)...")
+        init_facial_recognition()
+    except Exception as e:
+        print(f"⚠ Facial recognition init error: {e}")
 
 @app.route('/health/db', methods=['GET'])
 def health_db():
@@ -1339,6 +1424,24 @@ def facial_recognition_session():
     }), 200
 
 
+def _current_session_payload(session):
+    """Kiosk-facing view of a _get_current_timetable() row."""
+    return {
+        'session_id': session['timetable_id'],
+        'timetable_id': session['timetable_id'],
+        'module_id': session['module_id'],
+        'class_id': session['module_id'],  # Backward compatibility
+        'module_code': session['module_code'],
+        'module_name': session['module_name'],
+        'date': str(date.today()),
+        'time': str(session['start_time']) if session['start_time'] else None,
+        'end_time': str(session['end_time']) if session['end_time'] else None,
+        'room': session['room'],
+        'enrolled_count': int(session['enrolled_count'] or 0),
+        'is_live': True,
+    }
+
+
 @app.route('/api/facial-recognition/sessions/current', methods=['GET'])
 def facial_recognition_sessions_current():
     """Return the current (or next) timetable session for today."""
@@ -1347,23 +1450,7 @@ def facial_recognition_sessions_current():
         if not session:
             return jsonify({'ok': False, 'message': 'No sessions scheduled for today'}), 200
 
-        return jsonify({
-            'ok': True,
-            'session': {
-                'session_id': session['timetable_id'],
-                'timetable_id': session['timetable_id'],
-                'module_id': session['module_id'],
-                'class_id': session['module_id'],  # Backward compatibility
-                'module_code': session['module_code'],
-                'module_name': session['module_name'],
-                'date': str(date.today()),
-                'time': str(session['start_time']) if session['start_time'] else None,
-                'end_time': str(session['end_time']) if session['end_time'] else None,
-                'room': session['room'],
-                'enrolled_count': int(session['enrolled_count'] or 0),
-                'is_live': True,
-            },
-        }), 200
+        return jsonify({'ok': True, 'session': _current_session_payload(session)}), 200
     except Exception as e:
         return jsonify({'ok': False, 'message': 'Session lookup failed', 'error': str(e)}), 200
 
@@ -1399,13 +1486,18 @@ def facial_recognition_attendance_save_one():
             return jsonify({'ok': False, 'error': 'Module not found'}), 404
 
         # Insert attendance
-        cursor.execute(
-            """
-            INSERT INTO attendance (student_id, module_id, timetable_id, status, face_confidence, is_manual)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            """,
-            (student_pk, module_id, timetable_id, 'present', confidence, False),
-        )
+        try:
+            cursor.execute(
+                """
+                INSERT INTO attendance (student_id, module_id, timetable_id, status, face_confidence, is_manual)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """,
+                (student_pk, module_id, timetable_id, 'present', confidence, False),
+            )
+        except mysql_errors.IntegrityError:
+            # Already saved for this module today (unique student/module/date key)
+            conn.rollback()
+            return jsonify({'ok': True, 'message': 'Attendance already marked', 'already_marked': True}), 200
         conn.commit()
 
         return jsonify({'ok': True, 'status': 'present'}), 200
@@ -1418,6 +1510,49 @@ def facial_recognition_attendance_save_one():
             conn.close()
 
 
+def _request_id(params, *keys):
+    """First of the given id parameters (e.g. 'module_id', 'class_id') as an int, None when absent.
+
+    Raises ValueError for a non-numeric value so the route can answer 400.
+    """
+    value = next((params.get(key) for key in keys if params.get(key)), None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {keys[0]}: {value}')
+
+
+@app.route('/api/facial-recognition/attendance/save-many', methods=['POST'])
+def facial_recognition_attendance_save_many():
+    """Persist attendance for a batch of recognized students in one timetable slot.
+
+    Body: {timetable_id, module_id, records: [{student_id, confidence}, ...]}.
+    Returns a result per student: 'present'/'late', 'already_marked' or 'not_found'.
+    """
+    if save_attendance_batch is None:
+        return jsonify({'ok': False, 'error': 'Facial recognition package not available on server'}), 503
+    data = request.get_json() or {}
+    try:
+        timetable_id = _request_id(data, 'timetable_id', 'session_id')
+        module_id = _request_id(data, 'module_id', 'class_id')
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    try:
+        records = data.get('records') or data.get('students') or []
+
+        if not isinstance(records, list) or not all(isinstance(r, dict) and r.get('student_id') for r in records):
+            return jsonify({'ok': False, 'error': 'records must be a list of {student_id, confidence}'}), 400
+
+        results, saved = save_attendance_batch(timetable_id, module_id, records, recognition_system.attendance_rules)
+        return jsonify({'ok': True, 'results': results, 'saved': saved}), 200
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'ok': False, 'error': str(e)}), 500
+
+
 @app.route('/api/facial-recognition/attendance/today', methods=['GET'])
 def facial_recognition_attendance_today():
     """Return today's attendance for a given class (class_id query param)."""
@@ -1547,6 +1682,40 @@ def facial_recognition_timetable_all():
         if conn:
             conn.close()
 
+@app.route('/api/facial-recognition/models/status', methods=['GET'])
+def facial_recognition_models_status():
+    """Model pool usage: instances loaded/in use and how long /identify waits for one."""
+    if not model_pool:
+        return jsonify({'ok': False, 'error': 'Facial recognition not initialized on server'}), 200
+    return jsonify({
+        'ok': True,
+        'model_pool': model_pool.stats(),
+        'inference_workers': inference_pool.stats() if inference_pool else None
+    }), 200
+
+# Binary frame bodies accepted by /identify besides JSON with a base64 data URL
+IDENTIFY_BINARY_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'application/octet-stream')
+
+
+def _identify_request_payload():
+    """Parameters and image of an /identify request.
+
+    JSON bodies carry the image (or `crop`) as a base64 (data URL) string. Raw image bodies
+    (image/jpeg, ...) and multipart uploads (an `image` file part) carry the encoded
+    bytes, which are decoded directly; their parameters come from the query string
+    and, for multipart, the form fields.
+    """
+    if request.mimetype in IDENTIFY_BINARY_TYPES:
+        return request.args, request.get_data(cache=False)
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image') or next(iter(request.files.values()), None)
+        params = request.args.to_dict()
+        params.update(request.form.to_dict())
+        return params, upload.read() if upload else None
+    data = request.get_json(silent=True) or {}
+    return data, data.get('image') or data.get('crop')
+
+
 @app.route('/api/facial-recognition/identify', methods=['POST'])
 def facial_recognition_identify():
     """Identify student from face image using AI facial recognition"""
@@ -1568,15 +1737,27 @@ def facial_recognition_identify():
             np = None
     
     try:
-        data = request.get_json()
-        image_data = data.get('image')
-        confidence_threshold = data.get('confidence', 0.5)
+        data, image_data = _identify_request_payload()
+        confidence_threshold = float(data.get('confidence', 0.5))
+        # Limit matching to the running module's roster when the kiosk knows it
+        try:
+            module_id = _request_id(data, 'module_id', 'class_id')
+        except ValueError as e:
+            return jsonify({'ok': False, 'error': str(e)}), 400
+        fallback_to_full = str(data.get('fallback_to_full', False)).lower() in ('1', 'true', 'yes')
+        # A client that found the face itself sends the crop plus five landmarks; detection is skipped
+        landmarks = data.get('landmarks')
         
         if not image_data:
             return jsonify({'ok': False, 'error': 'No image provided'}), 400
+        if landmarks is not None:
+            try:
+                landmarks = parse_landmarks(landmarks).tolist()
+            except ValueError as e:
+                return jsonify({'ok': False, 'error': str(e)}), 400
         
         # Check if facial recognition is available
-        if not FACIAL_RECOGNITION_AVAILABLE or not all([face_detector, face_recognizer, student_faces]):
+        if not FACIAL_RECOGNITION_AVAILABLE or not all([face_detector, face_recognizer, student_faces, model_pool]):
             print(f"[IDENTIFY] FR check - FACIAL_RECOGNITION_AVAILABLE={FACIAL_RECOGNITION_AVAILABLE}, detector={face_detector}, recognizer={face_recognizer}, student_faces={student_faces}")
             return jsonify({
                 'ok': False,
@@ -1606,63 +1787,69 @@ def facial_recognition_identify():
                 }), 200
         
         print("[IDENTIFY] Processing frame...")
-        # Decode base64 image
-        try:
-            # Remove data URL prefix if present
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if frame is None:
-                return jsonify({'ok': False, 'error': 'Invalid image data'}), 400
-            
-            print(f"[IDENTIFY] Frame decoded: {frame.shape}")
-        except Exception as e:
-            print(f"[IDENTIFY] Error decoding image: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'ok': False, 'error': 'Failed to decode image'}), 400
-        
-        # Detect faces in the image
-        print(f"[IDENTIFY] Detecting faces...")
-        faces = face_detector.detect(frame)
-        print(f"[IDENTIFY] Faces detected: {len(faces) if faces else 0}")
-        
-        if faces is None or len(faces) == 0:
-            return jsonify({
-                'ok': False,
-                'error': 'No face detected in image',
-                'faces_found': 0
-            }), 400
-        
-        # Get the largest/clearest face
-        largest_face = max(faces, key=lambda f: f[2] * f[3])  # By area (width * height)
-        x, y, w, h = map(int, largest_face[:4])
-        
-        # Extract face region
-        face_roi = frame[y:y+h, x:x+w]
-        
-        if face_roi.size == 0:
-            return jsonify({
-                'ok': False,
-                'error': 'Could not extract face region'
-            }), 400
-        
-        # Get face feature/encoding using pre-cropped face image (works without landmarks)
-        face_feature = face_recognizer.extract_features_from_image(face_roi)
-        
-        if face_feature is None:
+        if inference_pool is not None:
+            # Decode, detect and embed in an inference process; this worker only waits
+            try:
+                inference_start = time.perf_counter()
+                if landmarks is not None:
+                    batch = inference_pool.run([('aligned', (image_data, landmarks))], timeout=FR_INFERENCE_TIMEOUT)
+                    result = batch['items'][0] if batch['ok'] else batch
+                else:
+                    result = inference_pool.run(image_data, timeout=FR_INFERENCE_TIMEOUT)
+            except InferenceQueueFull as e:
+                response = jsonify({'ok': False, 'error': 'Recognition queue full, try again', 'detail': str(e)})
+                response.headers['Retry-After'] = '1'
+                return response, 429
+            except InferenceUnavailable as e:
+                return jsonify({'ok': False, 'error': 'Recognition unavailable, try again', 'detail': str(e)}), 503
+            except TimeoutError as e:
+                return jsonify({'ok': False, 'error': str(e)}), 504
+            timing = {'inference_ms': round((time.perf_counter() - inference_start) * 1000, 1)}
+        else:
+            # Decode base64 image
+            try:
+                frame = decode_image(image_data)
+                if frame is None:
+                    return jsonify({'ok': False, 'error': 'Invalid image data'}), 400
+                print(f"[IDENTIFY] Frame decoded: {frame.shape}")
+            except Exception as e:
+                print(f"[IDENTIFY] Error decoding image: {e}")
+                import traceback
+                traceback.print_exc()
+                return jsonify({'ok': False, 'error': 'Failed to decode image'}), 400
+
+            # Detect and embed on a model pair of our own; concurrent requests use other pairs
+            try:
+                wait_start = time.perf_counter()
+                models = model_pool.acquire(timeout=FR_MODEL_WAIT_TIMEOUT)
+            except TimeoutError:
+                return jsonify({'ok': False, 'error': 'Recognition busy, try again'}), 503
+            timing = {'model_wait_ms': round((time.perf_counter() - wait_start) * 1000, 2)}
+
+            try:
+                if landmarks is not None:
+                    result = embed_landmarked_crop(models[1], frame, landmarks)
+                else:
+                    result = detect_and_embed(*models, frame)
+            finally:
+                model_pool.release(models)
+
+        print(f"[IDENTIFY] Faces detected: {result.get('faces_found', 0)}")
+        if not result['ok']:
             return jsonify({
                 'ok': False,
-                'error': 'Could not extract face features'
-            }), 400
-        
+                'error': result['error'],
+                'faces_found': result.get('faces_found', 0)
+            }), result['status']
+        face_feature = result['feature']
+
         # Find matching student
         # Use tuned thresholds from controller: threshold=0.25 for better matching
-        match = student_faces.find_match(face_feature, threshold=0.25, min_confidence_gap=0.02)
+        match, gallery_version = student_faces.find_match_versioned(
+            face_feature, threshold=0.25, min_confidence_gap=0.02,
+            module_id=module_id,
+            fallback_to_full=fallback_to_full
+        )
         
         if match:
             student_id, name, similarity = match
@@ -1673,12 +1860,15 @@ def facial_recognition_identify():
                     'name': name
                 },
                 'confidence': float(similarity),
+                'gallery_version': gallery_version,
+                **timing,
                 'message': 'Face matched successfully'
             }), 200
         else:
             return jsonify({
                 'ok': False,
                 'error': 'No matching student found',
+                'gallery_version': gallery_version,
                 'message': 'Face not recognized in database'
             }), 400
     
@@ -1688,6 +1878,163 @@ def facial_recognition_identify():
         traceback.print_exc()
         return jsonify({'ok': False, 'error': str(e)}), 500
 
+@app.route('/api/facial-recognition/identify/batch', methods=['POST'])
+def facial_recognition_identify_batch():
+    """Identify students in a burst of frames and/or pre-cropped faces.
+
+    multipart/form-data with up to FR_IDENTIFY_BATCH_MAX file parts: parts named
+    `frame...` are full frames (largest face is used), parts named `crop...` are
+    face crops. module_id / fallback_to_full come from form fields or the query.
+    All faces are embedded in one batch and matched in one gallery product; the
+    response has a result per item plus `best`, the highest-scoring student across
+    the burst with the number of items that agreed on them.
+    """
+    try:
+        if not FACIAL_RECOGNITION_AVAILABLE or not all([face_detector, face_recognizer, student_faces, model_pool]):
+            return jsonify({'ok': False, 'error': 'Facial recognition not initialized on server'}), 200
+
+        params = request.args.to_dict()
+        params.update(request.form.to_dict())
+        try:
+            module_id = _request_id(params, 'module_id', 'class_id')
+        except ValueError as e:
+            return jsonify({'ok': False, 'error': str(e)}), 400
+        fallback_to_full = str(params.get('fallback_to_full', False)).lower() in ('1', 'true', 'yes')
+
+        items = [
+            ('crop' if name.startswith('crop') else 'frame', upload.read())
+            for name, upload in request.files.items(multi=True)
+        ]
+        if not items:
+            return jsonify({'ok': False, 'error': 'No frames or crops provided'}), 400
+        if len(items) > FR_IDENTIFY_BATCH_MAX:
+            return jsonify({'ok': False, 'error': f'At most {FR_IDENTIFY_BATCH_MAX} frames or crops per request'}), 413
+
+        start = time.perf_counter()
+        if inference_pool is not None:
+            try:
+                batch = inference_pool.run(items, timeout=FR_INFERENCE_TIMEOUT)
+            except InferenceQueueFull as e:
+                response = jsonify({'ok': False, 'error': 'Recognition queue full, try again', 'detail': str(e)})
+                response.headers['Retry-After'] = '1'
+                return response, 429
+            except InferenceUnavailable as e:
+                return jsonify({'ok': False, 'error': 'Recognition unavailable, try again', 'detail': str(e)}), 503
+            except TimeoutError as e:
+                return jsonify({'ok': False, 'error': str(e)}), 504
+            if not batch['ok']:
+                return jsonify({'ok': False, 'error': batch['error']}), batch['status']
+            embedded = batch['items']
+        else:
+            try:
+                models = model_pool.acquire(timeout=FR_MODEL_WAIT_TIMEOUT)
+            except TimeoutError:
+                return jsonify({'ok': False, 'error': 'Recognition busy, try again'}), 503
+            try:
+                embedded = embed_items(*models, items)
+            finally:
+                model_pool.release(models)
+
+        # One gallery matrix product for every face of the burst
+        with_feature = [i for i, item in enumerate(embedded) if item['ok']]
+        matches, gallery_version = student_faces.find_matches_versioned(
+            [embedded[i]['feature'] for i in with_feature], threshold=0.25, min_confidence_gap=0.02,
+            module_id=module_id,
+            fallback_to_full=fallback_to_full
+        )
+        match_of = dict(zip(with_feature, matches))
+
+        results = []
+        votes = {}  # student_id -> (best similarity, items that matched them, name)
+        for index, ((kind, _), item) in enumerate(zip(items, embedded)):
+            result = {'index': index, 'kind': kind, 'faces_found': item.get('faces_found', 0)}
+            match = match_of.get(index)
+            if not item['ok']:
+                result.update({'ok': False, 'error': item['error']})
+            elif match is None:
+                result.update({'ok': False, 'error': 'No matching student found', 'bbox': item['bbox']})
+            else:
+                student_id, name, similarity = match
+                result.update({
+                    'ok': True,
+                    'student': {'student_id': student_id, 'name': name},
+                    'confidence': float(similarity),
+                    'bbox': item['bbox']
+                })
+                best_similarity, count, _ = votes.get(student_id, (0.0, 0, name))
+                votes[student_id] = (max(best_similarity, float(similarity)), count + 1, name)
+            results.append(result)
+
+        # Fuse the burst: best score wins
+        best = None
+        if votes:
+            student_id, (similarity, count, name) = max(votes.items(), key=lambda v: v[1][0])
+            best = {'student': {'student_id': student_id, 'name': name}, 'confidence': similarity, 'votes': count}
+
+        return jsonify({
+            'ok': best is not None,
+            'best': best,
+            'results': results,
+            'gallery_version': gallery_version,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+        }), 200
+
+    except Exception as e:
+        print(f"Error in facial recognition batch identify: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'ok': False, 'error': str(e)}), 500
+
+def _embed_kiosk_frame(frame_bytes):
+    """Every face of a kiosk frame, embedded in an inference process or on a pooled model pair."""
+    try:
+        if inference_pool is not None:
+            batch = inference_pool.run([('faces', frame_bytes)], timeout=FR_INFERENCE_TIMEOUT)
+            return batch['items'][0] if batch['ok'] else batch
+        with model_pool.checkout(timeout=FR_MODEL_WAIT_TIMEOUT) as models:
+            return embed_items(*models, [('faces', frame_bytes)])[0]
+    except (InferenceQueueFull, InferenceUnavailable, TimeoutError) as e:
+        return {'ok': False, 'error': f'Recognition busy, frame skipped: {e}'}
+
+
+def _match_kiosk_faces(features, module_id, fallback_to_full):
+    matches, _ = student_faces.find_matches_versioned(
+        features, threshold=0.25, min_confidence_gap=0.02,
+        module_id=int(module_id) if module_id else None,
+        fallback_to_full=fallback_to_full
+    )
+    return matches
+
+
+def _kiosk_current_session():
+    session = _get_current_timetable()
+    return _current_session_payload(session) if session else None
+
+
+if sock is not None:
+    @sock.route('/api/facial-recognition/ws')
+    def facial_recognition_ws(ws):
+        """Kiosk channel: binary JPEG frames in, recognitions / attendance / session changes out.
+
+        See facerec.kiosk_channel.KioskConnection for the message protocol.
+        """
+        if not FACIAL_RECOGNITION_AVAILABLE or not all([face_detector, face_recognizer, student_faces, model_pool]):
+            ws.send(json.dumps({'type': 'error', 'error': 'Facial recognition not initialized on server'}))
+            return
+        # Never let kiosks take every request thread
+        if not kiosk_slots.acquire(blocking=False):
+            ws.send(json.dumps({'type': 'busy', 'error': 'All kiosk connections are in use, use /identify'}))
+            return
+        try:
+            KioskConnection(
+                ws, _embed_kiosk_frame, _match_kiosk_faces, _kiosk_current_session,
+                lambda timetable_id, module_id, records: save_attendance_batch(
+                    timetable_id, module_id, records, recognition_system.attendance_rules)[0],
+                session_poll_interval=FR_WS_SESSION_POLL, max_frame_bytes=FR_WS_MAX_FRAME_BYTES
+            ).serve()
+        finally:
+            kiosk_slots.release()
+
 # ============================================================================
 # MAIN ENTRY POINT
 # ============================================================================
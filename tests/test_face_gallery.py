@@ -0,0 +1,84 @@
+"""
+Roster matching with multi-prototype galleries (max_prototypes > 1)
+Run from the project root: python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from facerec.facial_recognition_controller import FaceDatabase, FaceGallery
+
+
+def _database(module_rosters):
+    """Three students with three prototypes each; s1 is a near twin of s0"""
+    rng = np.random.default_rng(7)
+    centres = rng.normal(size=(3, 128)).astype(np.float32)
+    centres[1] = centres[0] + 0.05 * rng.normal(size=128)
+    vectors = [centre + 0.01 * rng.normal(size=(3, 128)).astype(np.float32) for centre in centres]
+    ids = ['s0', 's1', 's2']
+    gallery = FaceGallery.build(ids, ids, np.full(3, 3), vectors, module_rosters=module_rosters)
+
+    database = FaceDatabase.__new__(FaceDatabase)
+    database.gallery = gallery
+    return database, centres
+
+
+def test_single_student_roster_keeps_gap_check():
+    database, centres = _database({10: ['s0']})
+    assert len(database.gallery.rosters[10]) == 3  # prototype rows, one student
+
+    # s1 is almost as close as s0 across the full gallery: no confident match
+    match, _ = database.find_match_versioned(centres[0], 0.25, 0.02, module_id=10)
+    assert match is None
+    matches, _ = database.find_matches_versioned([centres[0]], 0.25, 0.02, module_id=10)
+    assert matches == [None]
+
+
+def test_single_student_roster_rejects_other_students():
+    database, centres = _database({10: ['s0']})
+    gallery = database.gallery
+    enrolled = gallery.students_of(gallery.rosters[10])
+    assert list(enrolled) == [0]
+    assert not FaceDatabase._on_roster(gallery, enrolled, ('s1', 's1', 1.0))
+    assert not FaceDatabase._on_roster(gallery, enrolled, ('s2', 's2', 1.0))
+
+    match, _ = database.find_match_versioned(centres[2], 0.25, 0.02, module_id=10)
+    assert match is None
+    matches, _ = database.find_matches_versioned([centres[2]], 0.25, 0.02, module_id=10)
+    assert matches == [None]
+
+    match, _ = database.find_match_versioned(centres[2], 0.25, 0.02, module_id=10, fallback_to_full=True)
+    assert match[0] == 's2'
+
+
+def test_roster_of_two_students_matches_within_roster():
+    database, centres = _database({11: ['s0', 's2']})
+    match, _ = database.find_match_versioned(centres[0], 0.25, 0.02, module_id=11)
+    assert match[0] == 's0'
+    matches, _ = database.find_matches_versioned([centres[0], centres[2]], 0.25, 0.02, module_id=11)
+    assert [m[0] for m in matches] == ['s0', 's2']
+
+
+class _ShortlistIndex:
+    """IVF stand-in whose shortlist is fixed to the given gallery rows"""
+
+    def __init__(self, rows):
+        self.rows = np.asarray(rows)
+
+    def search(self, query, nprobe=None):
+        return self.rows
+
+
+def test_single_student_shortlist_falls_back_to_exact_search():
+    database, centres = _database(None)
+    gallery = database.gallery
+    gallery.index = _ShortlistIndex([0, 1, 2])  # only s0's prototypes are probed
+
+    # The runner-up s1 sits outside the shortlist; the gap must still be checked against it
+    best = gallery.top2(centres[0])
+    assert [gallery.student_ids[student] for student, _ in best] == ['s0', 's1']
+    match, _ = database.find_match_versioned(centres[0], 0.25, 0.02)
+    assert match is None